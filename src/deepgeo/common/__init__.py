@@ -1 +1 @@
-__all__ = ['filesystem', 'geofunctions', 'visualization', 'utils']
\ No newline at end of file
+__all__ = ['filesystem', 'geofunctions', 'raster_writer', 'visualization', 'utils']
\ No newline at end of file
@@ -153,6 +153,9 @@ def write_pred_chips(output_path, base_raster, pred_struct, chip_key='predict',
     out_ds = driver.Create(output_path, x_size, y_size, num_bands, data_type)
     out_ds.SetGeoTransform((x_start, pixel_width, 0, y_start, 0, pixel_height))
     out_ds.SetProjection(srs.ExportToWkt())
+    if pred_struct.get(chip_key + '_metadata') is not None:
+        # E.g. the encoding of quantized probabilities, read back by quantization.decode_probabilities.
+        out_ds.SetMetadata(pred_struct[chip_key + '_metadata'])
 
     for i in range(1, num_bands + 1):
         out_band = out_ds.GetRasterBand(i)
@@ -1,18 +1,278 @@
+import concurrent.futures
+import csv
 import gdal
+import multiprocessing
+import ogr
 import os
-import sklearn
 import sys
 import numpy as np
-import sklearn.metrics as metrics
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+import common.quantization as quant
 import common.visualization as vis
 
 
-def compute_quality_metrics(labels, predictions, params, probabilities=None, classes_ignore=[0]):
+def _valid_pixels(labels, predictions, num_classes, classes_ignore):
+    labels = np.asarray(labels).ravel().astype(np.int64)
+    predictions = np.asarray(predictions).ravel().astype(np.int64)
+    valid = (labels >= 0) & (labels < num_classes) & (predictions >= 0) & (predictions < num_classes)
+    if len(classes_ignore) > 0:
+        valid &= ~np.isin(labels, classes_ignore)
+        predictions = np.where(predictions == 0, 1, predictions)  # TODO: Find a better way to solve this problem
+    return labels, predictions, valid
+
+
+class ConfusionMatrix(object):
+    """ Confusion matrix accumulated block by block, with np.bincount(labels * K + predictions).
+
+    The blocks can come from different chips or scenes, and accumulators of different workers can be merged, so a
+    whole scene is evaluated in one pass, with memory bounded by the size of the blocks. The pixels whose label is
+    in classes_ignore (or out of the range of the classes) are not counted.
+
+    Args:
+        num_classes (int): Number of classes (K), including the ignored ones.
+        classes_ignore (list): Labels of the pixels excluded from the evaluation.
+    """
+    def __init__(self, num_classes, classes_ignore=[0]):
+        self.num_classes = num_classes
+        self.classes_ignore = list(classes_ignore)
+        self.matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    def update(self, labels, predictions):
+        """ Adds a block of labels and the corresponding predictions (arrays of the same size, of any shape). """
+        labels, predictions, valid = _valid_pixels(labels, predictions, self.num_classes, self.classes_ignore)
+        self.matrix += np.bincount(labels[valid] * self.num_classes + predictions[valid],
+                                   minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
+        return self
+
+    def merge(self, other):
+        self.matrix += other.matrix
+        return self
+
+    def classes(self):
+        return [clazz for clazz in range(self.num_classes) if clazz not in self.classes_ignore]
+
+    def total(self):
+        return int(self.matrix.sum())
+
+    def metrics(self):
+        """ Derives the quality metrics of the accumulated pixels.
+
+        Returns:
+            A dict with the f1_score, precision, recall, iou and support of each class (not ignored), and the overall
+            accuracy, kappa and normalized confusion matrix (rows: true labels, columns: predictions).
+        """
+        classes = self.classes()
+        true_positives = np.diag(self.matrix)[classes].astype(np.float64)
+        labels_count = self.matrix.sum(axis=1)[classes].astype(np.float64)
+        predictions_count = self.matrix.sum(axis=0)[classes].astype(np.float64)
+        total = float(self.total())
+
+        metrics_dict = {}
+        metrics_dict['precision'] = _safe_divide(true_positives, predictions_count)
+        metrics_dict['recall'] = _safe_divide(true_positives, labels_count)
+        metrics_dict['f1_score'] = _safe_divide(2 * metrics_dict['precision'] * metrics_dict['recall'],
+                                                metrics_dict['precision'] + metrics_dict['recall'])
+        metrics_dict['iou'] = _safe_divide(true_positives, labels_count + predictions_count - true_positives)
+        metrics_dict['support'] = labels_count.astype(np.int64)
+        metrics_dict['accuracy'] = np.trace(self.matrix) / total if total > 0 else 0.
+
+        expected = np.sum(self.matrix.sum(axis=1) * self.matrix.sum(axis=0).astype(np.float64)) / total ** 2 \
+            if total > 0 else 0.
+        metrics_dict['kappa'] = (metrics_dict['accuracy'] - expected) / (1. - expected) if expected < 1 else 0.
+
+        confusion_matrix = self.matrix[np.ix_(classes, classes)].astype(np.float64)
+        metrics_dict['confusion_matrix'] = _safe_divide(confusion_matrix, confusion_matrix.sum(axis=1)[:, np.newaxis])
+        return metrics_dict
+
+
+class ZonalConfusionMatrix(object):
+    """ One confusion matrix per zone (e.g. municipality or WRS tile), accumulated block by block with a single
+    np.bincount of the combined zone, label and prediction index. The pixels with a negative zone are not counted.
+
+    Args:
+        num_classes (int): Number of classes, including the ignored ones.
+        classes_ignore (list): Labels of the pixels excluded from the evaluation.
+    """
+    def __init__(self, num_classes, classes_ignore=[0]):
+        self.num_classes = num_classes
+        self.classes_ignore = list(classes_ignore)
+        self.matrices = {}
+
+    def update(self, zones, labels, predictions):
+        """ Adds a block of zone ids, labels and predictions (arrays of the same size). """
+        labels, predictions, valid = _valid_pixels(labels, predictions, self.num_classes, self.classes_ignore)
+        zones = np.asarray(zones).ravel().astype(np.int64)
+        valid &= zones >= 0
+        zone_ids, zone_index = np.unique(zones[valid], return_inverse=True)
+        matrix_size = self.num_classes ** 2
+        counts = np.bincount(zone_index * matrix_size + labels[valid] * self.num_classes + predictions[valid],
+                             minlength=len(zone_ids) * matrix_size)
+        counts = counts.reshape(len(zone_ids), self.num_classes, self.num_classes)
+        for zone, matrix in zip(zone_ids, counts):
+            self.zone_matrix(int(zone)).matrix += matrix
+        return self
+
+    def zone_matrix(self, zone):
+        if zone not in self.matrices:
+            self.matrices[zone] = ConfusionMatrix(self.num_classes, self.classes_ignore)
+        return self.matrices[zone]
+
+    def merge(self, other):
+        for zone, confusion_matrix in other.matrices.items():
+            self.zone_matrix(zone).merge(confusion_matrix)
+        return self
+
+    def table(self, class_names, zone_names=None):
+        """ Builds one row of metrics for each zone: the number of pixels, the accuracy, the kappa, the mean
+        f1-score and IoU, and the f1-score and IoU of each class.
+
+        Args:
+            class_names (list): Names of all the classes.
+            zone_names (list): Optional names of the zones, indexed by the zone ids.
+        """
+        rows = []
+        for zone in sorted(self.matrices):
+            confusion_matrix = self.matrices[zone]
+            metrics_dict = confusion_matrix.metrics()
+            row = {'zone': zone_names[zone] if zone_names is not None else zone,
+                   'pixels': confusion_matrix.total(),
+                   'accuracy': metrics_dict['accuracy'],
+                   'kappa': metrics_dict['kappa'],
+                   'mean_f1_score': float(np.mean(metrics_dict['f1_score'])),
+                   'mean_iou': float(np.mean(metrics_dict['iou']))}
+            for i, class_index in enumerate(confusion_matrix.classes()):
+                row['f1_score_' + str(class_names[class_index])] = metrics_dict['f1_score'][i]
+                row['iou_' + str(class_names[class_index])] = metrics_dict['iou'][i]
+            rows.append(row)
+        return rows
+
+
+def _safe_divide(numerator, denominator, default=0.):
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype=np.float64),
+                                                 np.asarray(denominator, dtype=np.float64))
+    return np.divide(numerator, denominator, out=np.full(numerator.shape, default), where=denominator != 0)
+
+
+def _trapezoid(x, y):
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2.))
+
+
+class BinnedCurves(object):
+    """ ROC and precision-recall curves of each class, computed from histograms of the probabilities.
+
+    The probabilities of the positive (label == class) and negative pixels are counted in num_bins fixed bins, so
+    the curves are accumulated block by block in linear time, and their size does not depend on the number of pixels.
+    The bin edges are the thresholds of the curves, and the areas under the curves are computed by the trapezoidal
+    rule.
+
+    Args:
+        num_classes (int): Number of classes, including the ignored ones.
+        classes_ignore (list): Labels of the pixels excluded from the evaluation.
+        num_bins (int): Number of thresholds.
+    """
+    def __init__(self, num_classes, classes_ignore=[0], num_bins=1000):
+        self.num_classes = num_classes
+        self.classes_ignore = list(classes_ignore)
+        self.num_bins = num_bins
+        # Histograms of the probabilities of each class, for the negative (0) and the positive (1) pixels.
+        self.histograms = np.zeros((num_classes, 2, num_bins), dtype=np.int64)
+
+    def update(self, labels, probabilities):
+        """ Adds a block of labels and the corresponding probabilities (the last axis has one value per class). """
+        labels = np.asarray(labels).ravel().astype(np.int64)
+        probabilities = np.asarray(probabilities).reshape(-1, self.num_classes)
+        valid = (labels >= 0) & (labels < self.num_classes)
+        if len(self.classes_ignore) > 0:
+            valid &= ~np.isin(labels, self.classes_ignore)
+        labels = labels[valid]
+        probabilities = probabilities[valid]
+
+        bins = np.clip((probabilities * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        classes = np.arange(self.num_classes)
+        positive = labels[:, np.newaxis] == classes
+        index = classes * 2 * self.num_bins + positive * self.num_bins + bins
+        self.histograms += np.bincount(index.ravel(), minlength=self.histograms.size).reshape(self.histograms.shape)
+        return self
+
+    def merge(self, other):
+        self.histograms += other.histograms
+        return self
+
+    def roc_curve(self, class_index):
+        """ Returns the false positive rates, the true positive rates and the (decreasing) thresholds, as in
+        sklearn.metrics.roc_curve.
+        """
+        thresholds = np.arange(self.num_bins - 1, -1, -1) / float(self.num_bins)
+        false_positives = np.cumsum(self.histograms[class_index, 0, ::-1])
+        true_positives = np.cumsum(self.histograms[class_index, 1, ::-1])
+        fpr = np.concatenate([[0.], _safe_divide(false_positives, false_positives[-1])])
+        tpr = np.concatenate([[0.], _safe_divide(true_positives, true_positives[-1])])
+        return fpr, tpr, np.concatenate([[1.], thresholds])
+
+    def precision_recall_curve(self, class_index):
+        """ Returns the precisions, the recalls and the (increasing) thresholds, as in
+        sklearn.metrics.precision_recall_curve.
+        """
+        thresholds = np.arange(self.num_bins) / float(self.num_bins)
+        false_positives = np.cumsum(self.histograms[class_index, 0, ::-1])[::-1]
+        true_positives = np.cumsum(self.histograms[class_index, 1, ::-1])[::-1]
+        precision = _safe_divide(true_positives, true_positives + false_positives, default=1.)
+        recall = _safe_divide(true_positives, true_positives[0])
+        return np.concatenate([precision, [1.]]), np.concatenate([recall, [0.]]), thresholds
+
+    def metrics(self, class_names):
+        """ Computes the curves and their areas for each class which is not ignored.
+
+        Args:
+            class_names (list): Names of all the classes.
+
+        Returns:
+            A dict with the roc_curve, prec_rec_curve, auc_roc and auc_pr, each one a dict by class name.
+        """
+        metrics_dict = {'roc_curve': {}, 'prec_rec_curve': {}, 'auc_roc': {}, 'auc_pr': {}}
+        for class_index, clazz in enumerate(class_names):
+            if class_index in self.classes_ignore:
+                continue
+            fpr, tpr, thresholds = self.roc_curve(class_index)
+            precision, recall, pr_thresholds = self.precision_recall_curve(class_index)
+            metrics_dict['roc_curve'][clazz] = (fpr, tpr, thresholds)
+            metrics_dict['prec_rec_curve'][clazz] = (precision, recall, pr_thresholds)
+            metrics_dict['auc_roc'][clazz] = _trapezoid(fpr, tpr)
+            metrics_dict['auc_pr'][clazz] = -_trapezoid(recall, precision)
+        return metrics_dict
+
+
+def classification_report(metrics_dict, class_names, digits=4):
+    """ Formats the per-class metrics of ConfusionMatrix.metrics as a table, like sklearn's classification_report. """
+    width = max([len(name) for name in class_names] + [len('weighted avg')])
+    header = ['precision', 'recall', 'f1-score', 'support']
+    row_fmt = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}' + os.linesep
+    report = '{:>{width}s} '.format('', width=width) + ' '.join(['{:>9}'.format(h) for h in header]) + os.linesep * 2
+    for i, name in enumerate(class_names):
+        report += row_fmt.format(name, metrics_dict['precision'][i], metrics_dict['recall'][i],
+                                 metrics_dict['f1_score'][i], metrics_dict['support'][i], width=width, digits=digits)
+    support = np.sum(metrics_dict['support'])
+    report += os.linesep
+    report += ('{:>{width}s} ' + ' {:>9}' * 2 + ' {:>9.{digits}f} {:>9}' + os.linesep).format(
+        'accuracy', '', '', metrics_dict['accuracy'], support, width=width, digits=digits)
+    weights = metrics_dict['support'] / support if support > 0 else np.zeros(len(class_names))
+    for name, average in [('macro avg', np.mean), ('weighted avg', lambda values: np.sum(values * weights))]:
+        report += row_fmt.format(name, average(metrics_dict['precision']), average(metrics_dict['recall']),
+                                 average(metrics_dict['f1_score']), support, width=width, digits=digits)
+    return report
+
+
+def compute_quality_metrics(labels, predictions, params, probabilities=None, classes_ignore=[0],
+                            block_size=2 ** 20, num_bins=1000):
+    """ Computes the quality metrics of the predictions. The confusion matrix (and, with the probabilities, the
+    binned curves) are accumulated in blocks of block_size pixels, and all the metrics are derived from them. The
+    binned curves need temporaries of block_size x num_classes values, so the default block is about the 1024 x 1024
+    windows of evaluate_scene.
+    """
     class_names = params['class_names'].copy()
-    labels = labels.flatten()
-    predictions = predictions.flatten()
+    labels = labels.ravel()
+    predictions = predictions.ravel()
     if probabilities is not None:
         if len(probabilities.shape) < 4:
             probabilities = np.expand_dims(probabilities, axis=0)
@@ -20,49 +280,30 @@ def compute_quality_metrics(labels, predictions, params, probabilities=None, cla
     # else:
     #     probabilities = predictions
 
-    for value in classes_ignore:
-        predictions = np.delete(predictions, np.where(labels == value))
-        print('UNIQUE Predictions: ', np.unique(predictions))
-        predictions[predictions == 0] = 1  # TODO: Find a better way to solve this problem
-        if probabilities is not None:
-            probabilities = np.delete(probabilities, np.where(labels == value), axis=0)
-        labels = np.delete(labels, np.where(labels == value))
+    confusion_matrix = ConfusionMatrix(len(class_names), classes_ignore)
+    curves = BinnedCurves(len(class_names), classes_ignore, num_bins) if probabilities is not None else None
+    for start in range(0, labels.size, block_size):
+        confusion_matrix.update(labels[start:start + block_size], predictions[start:start + block_size])
+        if curves is not None:
+            curves.update(labels[start:start + block_size], probabilities[start:start + block_size])
+    return quality_report(confusion_matrix, params, curves)
+
+
+def quality_report(confusion_matrix, params, curves=None):
+    """ Derives the metrics of the accumulated ConfusionMatrix (and BinnedCurves), and formats the report.
+
+    Returns:
+        The dict of metrics and the report string.
+    """
+    class_names = params['class_names'].copy()
+    for value in confusion_matrix.classes_ignore:
         del class_names[value]
 
-    labels_to_use = []
-    for clazz in class_names:
-        labels_to_use.append(params['class_names'].index(clazz))
- 
-    metrics_dict = {}
-    with sklearn.utils.parallel_backend('multiprocessing'):
-    # with sklearn.externals.joblib.parallel_backend('multiprocessing'):
-        metrics_dict['f1_score'] = metrics.f1_score(labels, predictions, labels=labels_to_use, average=None)
-        metrics_dict['precision'] = metrics.precision_score(labels, predictions, average=None)
-        metrics_dict['recall'] = metrics.recall_score(labels, predictions, average=None)
-        metrics_dict['accuracy'] = metrics.accuracy_score(labels, predictions)
-        metrics_dict['classification_report'] = metrics.classification_report(labels, predictions,
-                                                                                 target_names=class_names,
-                                                                                 digits=4)
-
-        if probabilities is not None:
-            metrics_dict['prec_rec_curve'] = {}
-            for clazz in class_names:
-                cl_index = params['class_names'].index(clazz)
-                metrics_dict['prec_rec_curve'][clazz] = metrics.precision_recall_curve(labels,
-                                                                                       probabilities[:, cl_index],
-                                                                                       pos_label=cl_index)
-
-            metrics_dict['roc_curve'] = {}
-            metrics_dict['auc_roc'] = {}
-            for clazz in class_names:
-                cl_index = params['class_names'].index(clazz)
-                metrics_dict['roc_curve'][clazz] = metrics.roc_curve(labels,
-                                                                     probabilities[:, cl_index],
-                                                                     pos_label=cl_index)
-                metrics_dict['auc_roc'][clazz] = metrics.auc(metrics_dict['roc_curve'][clazz][0], metrics_dict['roc_curve'][clazz][1])
-
-        confusion_matrix = metrics.confusion_matrix(labels, predictions, labels=labels_to_use)
-        metrics_dict['confusion_matrix'] = confusion_matrix.astype('float') / confusion_matrix.sum(axis=1)[:, np.newaxis]
+    metrics_dict = confusion_matrix.metrics()
+    metrics_dict['classification_report'] = classification_report(metrics_dict, class_names)
+
+    if curves is not None:
+        metrics_dict.update(curves.metrics(params['class_names']))
 
     out_str = ''
     out_str += 'F1-Score:' + os.linesep
@@ -77,11 +318,18 @@ def compute_quality_metrics(labels, predictions, params, probabilities=None, cla
     for i in range(0, len(metrics_dict['recall'])):
         out_str += '  - ' + str(class_names[i]) + ': ' + str(metrics_dict['recall'][i]) + os.linesep
 
+    out_str += 'IoU:' + os.linesep
+    for i in range(0, len(metrics_dict['iou'])):
+        out_str += '  - ' + str(class_names[i]) + ': ' + str(metrics_dict['iou'][i]) + os.linesep
+
     out_str += 'Accuracy: ' + str(metrics_dict['accuracy']) + os.linesep
+    out_str += 'Kappa: ' + str(metrics_dict['kappa']) + os.linesep
 
-    if probabilities is not None:
+    if curves is not None:
         for clazz, val in metrics_dict['auc_roc'].items():
-            out_str += 'AUC-ROC {}: {}'.format(clazz, metrics_dict['auc_roc']) + os.linesep
+            out_str += 'AUC-ROC {}: {}'.format(clazz, val) + os.linesep
+        for clazz, val in metrics_dict['auc_pr'].items():
+            out_str += 'AUC-PR {}: {}'.format(clazz, val) + os.linesep
 
     out_str += 'Classification Report:' + os.linesep + str(metrics_dict['classification_report']) + os.linesep
     out_str += 'Confusion Matrix:' + os.linesep + str(metrics_dict['confusion_matrix']) + os.linesep
@@ -89,40 +337,123 @@ def compute_quality_metrics(labels, predictions, params, probabilities=None, cla
     return metrics_dict, out_str
 
 
-def evaluate_classification(prediction_path, ground_truth_path, params, prediction_prob=None,
-                            out_dir=None, file_sufix='', classes_ignore=[0]):
-    pred_ds = gdal.Open(prediction_path)
-    pred_arr = pred_ds.ReadAsArray()
-    pred_size_x, pred_size_y = pred_arr.shape
+def _pixel_offset(pred_ds, truth_ds):
+    pred_transform = pred_ds.GetGeoTransform()
+    truth_transform = truth_ds.GetGeoTransform()
+    if not np.allclose([pred_transform[1], pred_transform[5]], [truth_transform[1], truth_transform[5]]):
+        raise ValueError('The prediction and the ground truth must have the same pixel size.')
+    offset_x = int(round((pred_transform[0] - truth_transform[0]) / truth_transform[1]))
+    offset_y = int(round((pred_transform[3] - truth_transform[3]) / truth_transform[5]))
+    return offset_x, offset_y
+
+
+def aligned_windows(pred_ds, truth_ds, block_size=1024):
+    """ Splits the area covered by both the prediction and the ground truth in windows of block_size pixels.
+
+    The rasters are aligned by their geotransforms, so a prediction smaller than the ground truth (due to the overlap
+    of the network) is matched to the right pixels of the truth.
 
+    Returns:
+        A generator of pairs of windows (x_offset, y_offset, x_size, y_size), in the prediction and in the truth.
+    """
+    offset_x, offset_y = _pixel_offset(pred_ds, truth_ds)
+    start_x = max(0, -offset_x)
+    start_y = max(0, -offset_y)
+    end_x = min(pred_ds.RasterXSize, truth_ds.RasterXSize - offset_x)
+    end_y = min(pred_ds.RasterYSize, truth_ds.RasterYSize - offset_y)
+    for y in range(start_y, end_y, block_size):
+        for x in range(start_x, end_x, block_size):
+            size_x = min(block_size, end_x - x)
+            size_y = min(block_size, end_y - y)
+            yield (x, y, size_x, size_y), (x + offset_x, y + offset_y, size_x, size_y)
+
+
+def evaluate_scene(prediction_path, ground_truth_path, params, prediction_prob=None, classes_ignore=[0],
+                   block_size=1024, num_bins=1000):
+    """ Accumulates the confusion matrix (and the binned curves, with the probabilities) of a classified scene,
+    reading aligned windows of the prediction, the probabilities and the ground truth.
+
+    Returns:
+        The ConfusionMatrix and the BinnedCurves (None without the probabilities).
+    """
+    num_classes = len(params['class_names'])
+    confusion_matrix = ConfusionMatrix(num_classes, classes_ignore)
+    curves = None
+
+    pred_ds = gdal.Open(prediction_path)
+    truth_ds = gdal.Open(ground_truth_path)
+    prob_ds = None
     if prediction_prob is not None:
         prob_ds = gdal.Open(prediction_prob)
-        prob_arr = prob_ds.ReadAsArray()
-        prob_arr = np.rollaxis(prob_arr, 0, 3)
+        prob_metadata = prob_ds.GetMetadata()
+        curves = BinnedCurves(num_classes, classes_ignore, num_bins)
+    pred_band = pred_ds.GetRasterBand(1)
+    truth_band = truth_ds.GetRasterBand(1)
 
-    truth_ds = gdal.Open(ground_truth_path)
-    truth_arr = truth_ds.ReadAsArray()
-    truth_size_x, truth_size_y = truth_arr.shape
-
-    if pred_size_x != truth_size_x:
-        diff_x = truth_size_x - pred_size_x
-        diff_y = truth_size_y - pred_size_y
-        start_x = 0 + round(diff_x / 2)
-        end_x = truth_size_x - round(diff_x / 2)
-        start_y = 0 + round(diff_y / 2)
-        end_y = truth_size_y - round(diff_y / 2)
-        truth_arr = truth_arr[start_x:end_x, start_y:end_y]
+    for pred_window, truth_window in aligned_windows(pred_ds, truth_ds, block_size):
+        labels = truth_band.ReadAsArray(*truth_window)
+        confusion_matrix.update(labels, pred_band.ReadAsArray(*pred_window))
+        if prob_ds is not None:
+            encoded = np.moveaxis(prob_ds.ReadAsArray(*pred_window).reshape(prob_ds.RasterCount, -1), 0, -1)
+            curves.update(labels, quant.decode_probabilities(encoded, prob_metadata))
+
+    pred_ds = None
+    truth_ds = None
+    prob_ds = None
+    return confusion_matrix, curves
+
+
+def _as_list(paths):
+    return [paths] if paths is None or isinstance(paths, str) else list(paths)
+
+
+def evaluate_classification(prediction_path, ground_truth_path, params, prediction_prob=None,
+                            out_dir=None, file_sufix='', classes_ignore=[0], block_size=1024, num_bins=1000,
+                            num_workers=None):
+    """ Evaluates classified scenes against their ground truths, and writes the report and the plots to out_dir.
+
+    The rasters are read in aligned windows of block_size pixels, so the memory does not depend on the size of the
+    scenes. With lists of paths, the pairs of scenes are evaluated in parallel by num_workers processes (default: one
+    per CPU), and their metrics are merged in a single report.
+
+    Args:
+        prediction_path (str or list): Classified raster(s).
+        ground_truth_path (str or list): Ground truth raster(s), one for each prediction.
+        params (dict): Must contain class_names.
+        prediction_prob (str or list): Optional probability raster(s), one band per class, or encoded by
+            quantization.encode_probabilities (decoded with the metadata of the raster).
+    """
+    predictions = _as_list(prediction_path)
+    truths = _as_list(ground_truth_path)
+    probabilities = _as_list(prediction_prob) if prediction_prob is not None else [None] * len(predictions)
+    if len(truths) != len(predictions) or len(probabilities) != len(predictions):
+        raise ValueError('Each prediction must have a ground truth (and a probability raster, if any).')
+
+    scenes = list(zip(predictions, truths, probabilities))
+    if len(scenes) == 1:
+        results = [evaluate_scene(*scenes[0], params, classes_ignore=classes_ignore, block_size=block_size,
+                                  num_bins=num_bins)]
+    else:
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+            futures = [executor.submit(evaluate_scene, pred, truth, params, prob, classes_ignore, block_size,
+                                       num_bins) for pred, truth, prob in scenes]
+            results = [future.result() for future in futures]
+
+    confusion_matrix, curves = results[0]
+    for scene_matrix, scene_curves in results[1:]:
+        confusion_matrix.merge(scene_matrix)
+        if curves is not None:
+            curves.merge(scene_curves)
 
     out_str = ''
     out_str += '<<------------------------------------------------------------>>' + os.linesep
     out_str += '<<---------------- Classification Results -------------------->>' + os.linesep
     out_str += '<<------------------------------------------------------------>>' + os.linesep
 
-    if prediction_prob is not None:
-        metrics_dict, report_str = compute_quality_metrics(truth_arr, pred_arr, params, prob_arr,
-                                                      classes_ignore=classes_ignore)
-    else:
-        metrics_dict, report_str = compute_quality_metrics(truth_arr, pred_arr, params, classes_ignore=classes_ignore)
+    metrics_dict, report_str = quality_report(confusion_matrix, params, curves)
 
     out_str += report_str
 
@@ -149,3 +480,121 @@ def evaluate_classification(prediction_path, ground_truth_path, params, predicti
         vis.plot_roc_curve(metrics_dict['roc_curve'], aucroc_curve_path)
         vis.plot_precision_recall_curve(metrics_dict['prec_rec_curve'], fig_path=prec_rec_path)
 
+
+    return metrics_dict
+
+
+def _zones_layer(zones_path, zone_field):
+    """ Copies the polygons to an in-memory layer with an integer zone_id, one for each value of zone_field, so they
+    can be burnt into rasters. Returns the in-memory data source, its layer and the names of the zones.
+    """
+    zones_ds = ogr.Open(zones_path)
+    zones_layer = zones_ds.GetLayer()
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    mem_layer = mem_ds.CreateLayer('zones', zones_layer.GetSpatialRef(), zones_layer.GetGeomType())
+    mem_layer.CreateField(ogr.FieldDefn('zone_id', ogr.OFTInteger))
+
+    zone_names = []
+    zone_ids = {}
+    for feature in zones_layer:
+        name = feature.GetField(zone_field)
+        if name not in zone_ids:
+            zone_ids[name] = len(zone_names)
+            zone_names.append(name)
+        mem_feature = ogr.Feature(mem_layer.GetLayerDefn())
+        mem_feature.SetGeometry(feature.GetGeometryRef().Clone())
+        mem_feature.SetField('zone_id', zone_ids[name])
+        mem_layer.CreateFeature(mem_feature)
+    zones_ds = None
+    return mem_ds, mem_layer, zone_names
+
+
+def _rasterize_zones(zones_layer, pred_ds, window):
+    x_offset, y_offset, x_size, y_size = window
+    transform = pred_ds.GetGeoTransform()
+    mem_raster = gdal.GetDriverByName('MEM').Create('', x_size, y_size, 1, gdal.GDT_Int32)
+    mem_raster.SetProjection(pred_ds.GetProjection())
+    mem_raster.SetGeoTransform((transform[0] + x_offset * transform[1], transform[1], 0,
+                                transform[3] + y_offset * transform[5], 0, transform[5]))
+    mem_raster.GetRasterBand(1).Fill(-1)
+    gdal.RasterizeLayer(mem_raster, [1], zones_layer, options=['ATTRIBUTE=zone_id'])
+    return mem_raster.ReadAsArray()
+
+
+def _read_zones(zones_ds, pred_ds, window):
+    """ Reads the zones of a window of the prediction. The pixels out of the zone raster, or with its no data value,
+    get the zone -1.
+    """
+    offset_x, offset_y = _pixel_offset(pred_ds, zones_ds)
+    x_offset, y_offset, x_size, y_size = window
+    zones = np.full((y_size, x_size), -1, dtype=np.int64)
+    start_x = max(0, x_offset + offset_x)
+    start_y = max(0, y_offset + offset_y)
+    end_x = min(zones_ds.RasterXSize, x_offset + offset_x + x_size)
+    end_y = min(zones_ds.RasterYSize, y_offset + offset_y + y_size)
+    if end_x > start_x and end_y > start_y:
+        band = zones_ds.GetRasterBand(1)
+        values = band.ReadAsArray(start_x, start_y, end_x - start_x, end_y - start_y).astype(np.int64)
+        if band.GetNoDataValue() is not None:
+            values[values == band.GetNoDataValue()] = -1
+        zones[start_y - y_offset - offset_y:end_y - y_offset - offset_y,
+              start_x - x_offset - offset_x:end_x - x_offset - offset_x] = values
+    return zones
+
+
+def write_zonal_table(rows, out_path):
+    """ Writes the rows of ZonalConfusionMatrix.table to a Parquet file (if out_path ends with .parquet, requires
+    pandas and pyarrow) or to a CSV file.
+    """
+    if out_path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(out_path, index=False)
+        return
+    fieldnames = list(rows[0].keys()) if len(rows) > 0 else ['zone']
+    with open(out_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter=';')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def evaluate_zones(prediction_path, ground_truth_path, zones_path, params, out_path=None, zone_field=None,
+                   classes_ignore=[0], block_size=1024):
+    """ Evaluates a classified scene by zone (e.g. municipality or WRS tile), in a single streaming pass.
+
+    The zones are a raster of integer zone ids, aligned by its geotransform (negative ids or its no data value mean
+    no zone), or, with zone_field, a polygon layer burnt window by window, with one zone per value of zone_field.
+
+    Args:
+        prediction_path (str): Classified raster.
+        ground_truth_path (str): Ground truth raster.
+        zones_path (str): Zone raster or polygon layer.
+        params (dict): Must contain class_names.
+        out_path (str): Optional table of metrics per zone (.csv or .parquet).
+        zone_field (str): Field of the polygons with the zone name. If None, zones_path is a raster.
+
+    Returns:
+        The ZonalConfusionMatrix and the rows of the table.
+    """
+    zonal_matrix = ZonalConfusionMatrix(len(params['class_names']), classes_ignore)
+    pred_ds = gdal.Open(prediction_path)
+    truth_ds = gdal.Open(ground_truth_path)
+    pred_band = pred_ds.GetRasterBand(1)
+    truth_band = truth_ds.GetRasterBand(1)
+    zone_names = None
+    if zone_field is not None:
+        zones_ds, zones_layer, zone_names = _zones_layer(zones_path, zone_field)
+    else:
+        zones_ds = gdal.Open(zones_path)
+
+    for pred_window, truth_window in aligned_windows(pred_ds, truth_ds, block_size):
+        if zone_field is not None:
+            zones = _rasterize_zones(zones_layer, pred_ds, pred_window)
+        else:
+            zones = _read_zones(zones_ds, pred_ds, pred_window)
+        zonal_matrix.update(zones, truth_band.ReadAsArray(*truth_window), pred_band.ReadAsArray(*pred_window))
+
+    rows = zonal_matrix.table(params['class_names'], zone_names)
+    if out_path is not None:
+        write_zonal_table(rows, out_path)
+    zones_ds = None
+    return zonal_matrix, rows
@@ -0,0 +1,104 @@
+# This file contains functions to store the probabilities of the classification in compact forms, and read them back
+import numpy as np
+
+prob_formats = ['float32', 'uint8', 'top_k']
+extra_bands = ['confidence', 'entropy']
+
+
+def check_format(prob_format, extra_band=None):
+    if prob_format not in prob_formats:
+        raise ValueError('Unknown probability format: ' + str(prob_format) + '. Options: ' + ', '.join(prob_formats))
+    if extra_band is not None and extra_band not in extra_bands:
+        raise ValueError('Unknown extra band: ' + str(extra_band) + '. Options: ' + ', '.join(extra_bands))
+
+
+def quantize(values):
+    """ Scales values in [0, 1] to uint8 (0-255). """
+    return np.round(np.clip(values, 0., 1.) * 255).astype(np.uint8)
+
+
+def dequantize(values):
+    return values.astype(np.float32) / 255
+
+
+def confidence(probabilities):
+    """ Probability of the predicted class. """
+    return np.max(probabilities, axis=-1)
+
+
+def entropy(probabilities):
+    """ Entropy of the probabilities, normalized to [0, 1] by the entropy of the uniform distribution. """
+    num_classes = probabilities.shape[-1]
+    probabilities = np.clip(probabilities.astype(np.float32), 1e-12, 1.)
+    return -np.sum(probabilities * np.log(probabilities), axis=-1) / np.log(num_classes)
+
+
+def encode_probabilities(probabilities, prob_format='uint8', top_k=3, extra_band=None):
+    """ Encodes the probabilities (..., num_classes) in a compact form.
+
+    Formats:
+        - float32: the probabilities, unchanged.
+        - uint8: the probabilities scaled to 0-255, one band per class.
+        - top_k: the top_k most probable classes, followed by their probabilities scaled to 0-255 (2 * top_k bands).
+    The extra band (confidence or entropy, scaled to 0-255 if the format is not float32) is appended as the last band.
+
+    Returns:
+        The encoded array (..., bands) and its metadata (a dict of strings, stored in the raster by write_pred_chips),
+        which decode_probabilities needs to read it back.
+    """
+    check_format(prob_format, extra_band)
+    num_classes = probabilities.shape[-1]
+    metadata = {'prob_format': prob_format, 'num_classes': str(num_classes)}
+
+    if prob_format == 'float32':
+        bands = [probabilities.astype(np.float32)]
+    elif prob_format == 'uint8':
+        bands = [quantize(probabilities)]
+    else:
+        top_k = min(top_k, num_classes)
+        classes = np.argsort(-probabilities, axis=-1, kind='stable')[..., :top_k]
+        scores = np.take_along_axis(probabilities, classes, axis=-1)
+        bands = [classes.astype(np.uint8), quantize(scores)]
+        metadata['top_k'] = str(top_k)
+
+    if extra_band is not None:
+        band = confidence(probabilities) if extra_band == 'confidence' else entropy(probabilities)
+        band = band.astype(np.float32) if prob_format == 'float32' else quantize(band)
+        bands.append(np.expand_dims(band, -1))
+        metadata['extra_band'] = extra_band
+
+    return np.concatenate(bands, axis=-1), metadata
+
+
+def decode_probabilities(encoded, metadata=None):
+    """ Decodes the probabilities (..., num_classes, float32) from an array encoded by encode_probabilities.
+
+    Without metadata (or prob_format in it), the array is taken as float32 probabilities. In the top_k format, the
+    probability left by the top k classes is shared evenly among the other classes.
+    """
+    if metadata is None or 'prob_format' not in metadata:
+        return encoded.astype(np.float32)
+    check_format(metadata['prob_format'], metadata.get('extra_band'))
+    num_classes = int(metadata['num_classes'])
+
+    if metadata['prob_format'] == 'float32':
+        return encoded[..., :num_classes].astype(np.float32)
+    if metadata['prob_format'] == 'uint8':
+        return dequantize(encoded[..., :num_classes])
+
+    top_k = int(metadata['top_k'])
+    classes = encoded[..., :top_k].astype(np.int64)
+    scores = dequantize(encoded[..., top_k:(2 * top_k)])
+    remaining = np.clip(1. - np.sum(scores, axis=-1, keepdims=True), 0., 1.)
+    share = remaining / (num_classes - top_k) if num_classes > top_k else 0.
+    probabilities = np.broadcast_to(share, encoded.shape[:-1] + (num_classes,)).astype(np.float32).copy()
+    np.put_along_axis(probabilities, classes, scores, axis=-1)
+    return probabilities
+
+
+def decode_extra_band(encoded, metadata):
+    """ Gets the confidence or entropy band of an encoded array, in [0, 1]. """
+    if metadata is None or 'extra_band' not in metadata:
+        return None
+    band = encoded[..., -1]
+    return band.astype(np.float32) if metadata['prob_format'] == 'float32' else dequantize(band)
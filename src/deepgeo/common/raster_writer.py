@@ -0,0 +1,312 @@
+# This file contains functions to write rasters in tiled and compressed GeoTIFFs, block by block
+import numpy as np
+import os
+import queue
+import sys
+import threading
+from osgeo import gdal
+from osgeo import gdal_array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+import common.utils as utils
+
+
+default_params = {'data_type': None,
+                  'tiled': True,
+                  'block_size': 256,
+                  'compress': 'DEFLATE',
+                  'predictor': None,
+                  'num_threads': 'ALL_CPUS',
+                  'interleave': 'PIXEL',
+                  'bigtiff': 'IF_SAFER',
+                  'overviews': None,
+                  'overview_resampling': 'NEAREST',
+                  'no_data': None}
+
+_compressions_with_predictor = ['DEFLATE', 'LZW', 'ZSTD', 'LZMA']
+
+
+def _get_params(params):
+    if params is None:
+        params = {}
+    return utils.check_dict_parameters(dict(params), default=default_params)
+
+
+def _numpy_2_gdal_type(dtype):
+    if np.dtype(dtype) == np.bool_:
+        return gdal.GDT_Byte
+    return gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+
+
+def _default_predictor(data_type):
+    numpy_type = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+    if numpy_type is not None and np.issubdtype(numpy_type, np.floating):
+        return 3
+    return 2
+
+
+def creation_options(data_type, params=None):
+    """ Builds the GeoTIFF creation options from the writer parameters.
+
+    Args:
+        data_type (int): GDAL data type of the raster. Used to choose the compression predictor.
+        params (dict): Writer parameters. See default_params.
+
+    Returns:
+        A list of GeoTIFF creation options.
+    """
+    params = _get_params(params)
+    options = ['BIGTIFF=' + str(params['bigtiff']),
+               'INTERLEAVE=' + str(params['interleave'])]
+
+    if params['tiled']:
+        options += ['TILED=YES',
+                    'BLOCKXSIZE=' + str(params['block_size']),
+                    'BLOCKYSIZE=' + str(params['block_size'])]
+
+    if params['compress'] is not None:
+        options.append('COMPRESS=' + str(params['compress']))
+        options.append('NUM_THREADS=' + str(params['num_threads']))
+        if str(params['compress']).upper() in _compressions_with_predictor:
+            predictor = params['predictor']
+            if predictor is None:
+                predictor = _default_predictor(data_type)
+            options.append('PREDICTOR=' + str(predictor))
+
+    return options
+
+
+def create_raster(out_path, x_size, y_size, num_bands, data_type, geo_transform, projection, params=None,
+                  band_names=None):
+    """ Creates a tiled and compressed GeoTIFF, setting its georeference only once.
+
+    Args:
+        out_path (str): Path to the output file.
+        x_size (int): Number of columns.
+        y_size (int): Number of rows.
+        num_bands (int): Number of bands.
+        data_type (int): GDAL data type of the bands.
+        geo_transform (tuple): Geotransform of the output.
+        projection (str): Projection of the output, as WKT.
+        params (dict): Writer parameters. See default_params.
+        band_names (list): Optional descriptions of the bands.
+
+    Returns:
+        The created GDAL dataset, opened for writing.
+    """
+    params = _get_params(params)
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(out_path, x_size, y_size, num_bands, data_type,
+                           options=creation_options(data_type, params))
+    out_ds.SetGeoTransform(geo_transform)
+    out_ds.SetProjection(projection)
+
+    for band in range(1, num_bands + 1):
+        out_band = out_ds.GetRasterBand(band)
+        if params['no_data'] is not None:
+            out_band.SetNoDataValue(params['no_data'])
+        if band_names is not None:
+            out_band.SetDescription(band_names[band - 1])
+
+    return out_ds
+
+
+def _read_strip(source, row_start, num_rows, no_data):
+    if isinstance(source, gdal.Dataset):
+        strip = source.ReadAsArray(0, row_start, source.RasterXSize, num_rows)
+        if strip.ndim == 2:
+            strip = np.expand_dims(strip, 0)
+        return strip
+
+    strip = source[row_start:(row_start + num_rows)]
+    if np.ma.isMaskedArray(strip):
+        strip = np.ma.filled(strip, no_data if no_data is not None else strip.fill_value)
+    if strip.ndim == 2:
+        strip = np.expand_dims(strip, -1)
+    return np.moveaxis(strip, -1, 0)
+
+
+def write_blocks(out_ds, source, params=None):
+    """ Writes a source to an opened raster, strip by strip.
+
+    Each strip has the height of one row of tiles, so each tile is compressed and written only once, and only one
+    strip of the source is in memory at a time.
+
+    Args:
+        out_ds (gdal.Dataset): Raster opened for writing, e.g. by create_raster.
+        source: A numpy array (rows x cols [x bands], it can be masked) or a GDAL dataset, which is read lazily.
+        params (dict): Writer parameters. See default_params.
+    """
+    params = _get_params(params)
+    y_size = out_ds.RasterYSize
+    x_size = out_ds.RasterXSize
+    num_bands = out_ds.RasterCount
+    band_list = list(range(1, num_bands + 1))
+    data_type = out_ds.GetRasterBand(1).DataType
+    numpy_type = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+    block_rows = params['block_size']
+
+    for row_start in range(0, y_size, block_rows):
+        num_rows = min(block_rows, y_size - row_start)
+        strip = _read_strip(source, row_start, num_rows, params['no_data'])
+        strip = np.ascontiguousarray(strip, dtype=numpy_type)
+        out_ds.WriteRaster(0, row_start, x_size, num_rows, strip.tobytes(),
+                           buf_xsize=x_size, buf_ysize=num_rows, buf_type=data_type, band_list=band_list)
+
+
+def build_overviews(out_ds, levels, resampling='NEAREST'):
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+    out_ds.BuildOverviews(resampling, list(levels))
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+
+
+def write_raster(out_path, source, geo_transform, projection, params=None, band_names=None):
+    """ Writes a raster to a tiled and compressed GeoTIFF.
+
+    Args:
+        out_path (str): Path to the output file.
+        source: A numpy array (rows x cols [x bands], it can be masked), a GDAL dataset, or the path to a raster
+            (e.g. a VRT). Datasets and paths are read lazily, strip by strip.
+        geo_transform (tuple): Geotransform of the output.
+        projection (str): Projection of the output, as WKT.
+        params (dict): Writer parameters. See default_params.
+        band_names (list): Optional descriptions of the bands.
+    """
+    params = _get_params(params)
+    if isinstance(source, str):
+        source = gdal.Open(source)
+
+    if isinstance(source, gdal.Dataset):
+        y_size, x_size, num_bands = source.RasterYSize, source.RasterXSize, source.RasterCount
+        source_type = source.GetRasterBand(1).DataType
+    else:
+        y_size, x_size = source.shape[0], source.shape[1]
+        num_bands = source.shape[2] if source.ndim > 2 else 1
+        source_type = _numpy_2_gdal_type(source.dtype)
+
+    data_type = params['data_type'] if params['data_type'] is not None else source_type
+    if isinstance(data_type, str):
+        data_type = gdal.GetDataTypeByName(data_type)
+    out_ds = create_raster(out_path, x_size, y_size, num_bands, data_type, geo_transform, projection, params,
+                           band_names)
+    write_blocks(out_ds, source, params)
+
+    if params['overviews'] is not None:
+        build_overviews(out_ds, params['overviews'], params['overview_resampling'])
+
+    out_ds.FlushCache()
+    out_ds = None
+
+
+class AsyncPredictionWriter(object):
+    """ Writes the predictions of the windows of a raster to tiled and compressed GeoTIFFs, in a background thread.
+
+    The batches are passed through a bounded queue, so the prediction of the next batches runs while the previous ones
+    are compressed and written, and at most max_queue batches are held in memory (put blocks when the queue is full).
+    The outputs are created already cropped to the network output (the base raster without overlap / 2 pixels at each
+    side), so they need no clip after the prediction.
+
+    Args:
+        base_raster (str): Path to the classified raster, which gives the size and the georeference of the outputs.
+        output_paths (dict): Output path of each key of the batches, e.g. {'predict': ..., 'probabilities': ...}.
+        overlap (tuple): Overlap of the windows (see SequentialChipGenerator), i.e. the border lost by the network.
+        max_queue (int): Maximum number of batches waiting to be written.
+        params (dict): Writer parameters. See default_params.
+
+    Example:
+        with AsyncPredictionWriter(base_raster, {'predict': out_path}, chip_struct['overlap']) as writer:
+            for batch in batches:
+                writer.put(batch)  # {'coords': [...], 'predict': array (chips x rows x cols x bands)}
+    """
+    def __init__(self, base_raster, output_paths, overlap=(0, 0), max_queue=4, params=None):
+        self.output_paths = output_paths
+        self.params = _get_params(params)
+        self.row_offset = int(round(overlap[0] / 2))
+        self.col_offset = int(round(overlap[1] / 2))
+
+        base_ds = gdal.Open(base_raster)
+        x_start, pixel_width, x_rotation, y_start, y_rotation, pixel_height = base_ds.GetGeoTransform()
+        self.geo_transform = (x_start + self.col_offset * pixel_width + self.row_offset * x_rotation, pixel_width,
+                              x_rotation, y_start + self.col_offset * y_rotation + self.row_offset * pixel_height,
+                              y_rotation, pixel_height)
+        self.projection = base_ds.GetProjectionRef()
+        self.x_size = base_ds.RasterXSize - 2 * self.col_offset
+        self.y_size = base_ds.RasterYSize - 2 * self.row_offset
+        base_ds = None
+
+        self.datasets = {}
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name='AsyncPredictionWriter', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not hide the exception of the prediction with an error of the writer.
+        self.close(raise_error=exc_type is None)
+        return False
+
+    def _open(self, key, chips, metadata):
+        num_bands = chips.shape[-1] if chips.ndim == 4 else 1
+        out_ds = create_raster(self.output_paths[key], self.x_size, self.y_size, num_bands,
+                               _numpy_2_gdal_type(chips.dtype), self.geo_transform, self.projection, self.params)
+        if metadata is not None:
+            # E.g. the encoding of quantized probabilities, read back by quantization.decode_probabilities.
+            out_ds.SetMetadata(metadata)
+        self.datasets[key] = out_ds
+        return out_ds
+
+    def _write(self, batch):
+        for key in self.output_paths:
+            chips = np.asarray(batch[key])
+            out_ds = self.datasets.get(key)
+            if out_ds is None:
+                out_ds = self._open(key, chips, batch.get(key + '_metadata'))
+            data_type = out_ds.GetRasterBand(1).DataType
+            band_list = list(range(1, out_ds.RasterCount + 1))
+            for chip, coord in zip(chips, batch['coords']):
+                if chip.ndim == 2:
+                    chip = np.expand_dims(chip, -1)
+                rows, cols, _ = chip.shape
+                # The window starts overlap / 2 pixels before its output, and so does the base raster.
+                data = np.ascontiguousarray(np.moveaxis(chip, -1, 0),
+                                            dtype=gdal_array.GDALTypeCodeToNumericTypeCode(data_type))
+                out_ds.WriteRaster(int(coord['left_col']), int(coord['upper_row']), cols, rows, data.tobytes(),
+                                   buf_xsize=cols, buf_ysize=rows, buf_type=data_type, band_list=band_list)
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is None:
+                try:
+                    self._write(batch)
+                except Exception as error:
+                    # Keep consuming the queue, so put does not block, and raise the error in the main thread.
+                    self.error = error
+
+    def put(self, batch):
+        """ Queues a batch: a dict with the window coords and, for each key of output_paths, an array of chips
+        (with the optional metadata of the output in key + '_metadata'). Blocks while the queue is full.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(batch)
+
+    def close(self, raise_error=True):
+        """ Waits for the queued batches to be written, and closes the outputs. """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        for key in list(self.datasets):
+            self.datasets[key].FlushCache()
+            self.datasets[key] = None
+        self.datasets = {}
+        if raise_error and self.error is not None:
+            raise self.error
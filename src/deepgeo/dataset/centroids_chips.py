@@ -4,15 +4,58 @@ import sys
 import numpy as np
 import geopandas
 import rasterio
+import shapely.geometry
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import common.utils as utils
 
 
+def read_centroids(path, layer=None, bbox=None):
+    """ Reads the centroids from a vector file (Shapefile, GeoPackage, ...) or from a GeoParquet file.
+
+    Args:
+        path (str): Path to the file with the centroids.
+        layer (str): Optional layer of the file (e.g. for GeoPackages with several layers).
+        bbox (tuple): Optional (min_x, min_y, max_x, max_y). Only the centroids within it are returned. The filter
+            uses the spatial index of the file when it exists and the R-tree of the GeoDataFrame otherwise.
+
+    Returns:
+        A GeoDataFrame with the centroids.
+    """
+    if os.path.splitext(path)[1].lower() in ['.parquet', '.geoparquet']:
+        points = geopandas.read_parquet(path)
+    elif layer is not None:
+        points = geopandas.read_file(path, layer=layer, bbox=bbox)
+    else:
+        points = geopandas.read_file(path, bbox=bbox)
+
+    if bbox is not None and len(points) > 0:
+        points = points.iloc[np.sort(points.sindex.query(shapely.geometry.box(*bbox)))]
+    return points
+
+
+def points_to_pixels(x, y, transform):
+    """ Converts map coordinates to (row, col) positions through the inverse of the raster affine transform.
+
+    Args:
+        x (numpy.ndarray): X coordinates.
+        y (numpy.ndarray): Y coordinates.
+        transform (affine.Affine): Affine transform of the raster. Rotation terms are taken into account.
+
+    Returns:
+        An array (number of points x 2) of int64 with the (row, col) of the pixels containing the points.
+    """
+    inv = ~transform
+    cols = np.floor(inv.a * x + inv.b * y + inv.c).astype(np.int64)
+    rows = np.floor(inv.d * x + inv.e * y + inv.f).astype(np.int64)
+    return np.stack([rows, cols], axis=-1)
+
+
 class CentroidsChipGenerator(object):
     mandatory_params = ['raster_array', 'labels_array', 'win_size', 'shp_path', 'labels_tif']
     default_params = {'class_of_interest': None,
-                      'remove_no_data': None}
+                      'remove_no_data': None,
+                      'layer': None}
 
     def __init__(self, params):
         params = utils.check_dict_parameters(params, self.mandatory_params, self.default_params)
@@ -24,72 +67,47 @@ class CentroidsChipGenerator(object):
         # self.class_names = params['class_names']
         self.shp_path = params['shp_path']
         self.labels_tif = params['labels_tif']
+        self.layer = params['layer']
+
+        with rasterio.open(self.labels_tif) as labels:
+            self.transform = labels.transform
+            self.bounds = tuple(labels.bounds)
+            self.height = labels.height
+            self.width = labels.width
 
     def compute_indexes(self):
-        # opens the shapefile and get points coordinates
-        shp = geopandas.read_file(self.shp_path)
-        coordinates = np.zeros([len(shp),2], dtype=np.float64)
-        coordinates[:,0] = shp['geometry'].x
-        coordinates[:,1] = shp['geometry'].y
-
-        # open labels raster to get its diemnsions and bounding box
-        labels = rasterio.open(self.labels_tif)
-        box = labels.bounds
-        delta_x = box[2]-box[0] 
-        delta_y = box[3]-box[1]
-
-        # converts the points coordinates to image coordinates
-        samples = np.zeros([len(coordinates), 3], dtype=np.int64)
-        samples[:,0] = (np.asarray((coordinates[:,1]-box[1])*labels.height/delta_y, dtype=np.int64)*-1)+labels.height
-        samples[:,1] = np.asarray((coordinates[:,0]-box[0])*labels.width/delta_x, dtype=np.int64)
-        
-        # checks if the chips to be created are completely within the images
-        check1 = samples[:,1]+(self.win_size/2)>=labels.width
-        check2 = samples[:,1]-(self.win_size/2)<0
-        check3 = samples[:,0]+(self.win_size/2)>=labels.height
-        check4 = samples[:,0]-(self.win_size/2)<0
+        # reads only the centroids within the labels raster and converts them to image coordinates
+        points = read_centroids(self.shp_path, self.layer, self.bounds)
+        samples = points_to_pixels(points.geometry.x.values, points.geometry.y.values, self.transform)
 
-        check = check1+check2+check3+check4
+        # checks if the chips to be created are completely within the images
+        upper_rows, left_cols = self.compute_windows_origin(samples)
+        check = (upper_rows < 0) | (left_cols < 0) | (upper_rows + self.win_size > self.height) | \
+                (left_cols + self.win_size > self.width)
 
-        print('%d valid chips found, %d invalid chips (out of bounds).' % (len(check)-np.sum(check), np.sum(check)))
+        print('%d valid chips found, %d invalid chips (out of bounds).' % (len(check) - np.sum(check), np.sum(check)))
         print('Proceeding with valid chips...')
 
         # final result
         self.ij_samples = samples[np.invert(check)]
 
-    def compute_window_coords(self, coord):
-        window_coords = {}
-        window_coords['upper_row'] = coord[0] - math.floor(self.win_size / 2)
-        window_coords['lower_row'] = coord[0] + math.ceil(self.win_size / 2)
-        window_coords['right_col'] = coord[1] + math.floor(self.win_size / 2)
-        window_coords['left_col']  = coord[1] - math.ceil(self.win_size / 2)
-
-        # TODO: Review this. Is there a better way to do this?
-        if window_coords['upper_row'] < 0:
-            window_coords['upper_row'] = 0
-            window_coords['lower_row'] = self.win_size
-        if window_coords['left_col'] < 0:
-            window_coords['left_col'] = 0
-            window_coords['right_col'] = self.win_size
-        if window_coords['lower_row'] > self.labeled_img.shape[0]:
-            window_coords['lower_row'] = self.labeled_img.shape[0]
-            window_coords['upper_row'] = window_coords['lower_row'] - self.win_size
-        if window_coords['right_col'] > self.labeled_img.shape[1]:
-            window_coords['right_col'] = self.labeled_img.shape[1]
-            window_coords['left_col'] = window_coords['right_col'] - self.win_size
-
-        return window_coords
-
-    def extract_windows(self, coord):
-        window = self.compute_window_coords(coord)
-        sample_img = self.ref_img[window['upper_row']:window['lower_row'], window['left_col']:window['right_col']]
-        sample_label = self.labeled_img[window['upper_row']:window['lower_row'], window['left_col']:window['right_col']]
-
-        return sample_img, sample_label, window
+    def compute_windows_origin(self, samples):
+        upper_rows = samples[:, 0] - math.floor(self.win_size / 2)
+        left_cols = samples[:, 1] - math.ceil(self.win_size / 2)
+        return upper_rows, left_cols
 
     def generate_chips(self):
         self.compute_indexes()
-        samples_img, samples_label, windows = [np.asarray(a) for a in zip(*map(self.extract_windows, self.ij_samples))]
+        upper_rows, left_cols = self.compute_windows_origin(self.ij_samples)
+        offsets = np.arange(self.win_size)
+        rows = upper_rows[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        cols = left_cols[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+
+        samples_img = np.asarray(np.ma.getdata(self.ref_img[rows, cols]))
+        samples_label = np.asarray(np.ma.getdata(self.labeled_img[rows, cols]))
+        windows = [{'upper_row': int(upper), 'lower_row': int(upper + self.win_size),
+                    'left_col': int(left), 'right_col': int(left + self.win_size)}
+                   for upper, left in zip(upper_rows, left_cols)]
         return {'chips': samples_img,
                 'labels': samples_label,
-                'coords': windows}
\ No newline at end of file
+                'coords': windows}
@@ -0,0 +1,148 @@
+import numpy as np
+import tensorflow as tf
+import geopandas as gpd
+import os
+import sys
+from affine import Affine
+from shapely.geometry import Polygon
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../"))
+import common.utils as utils
+import common.filesystem as fs
+import dataset.dataset_generator as dsgen
+import dataset.utils as dsutils
+
+
+def grid_blocks(chips_struct, params):
+    """ Assigns each chip to a square block of a regular grid, in pixels, of its scene. The chips which cross the
+    borders of the blocks are assigned to the block -1.
+    """
+    return dsutils.chip_block_ids(chips_struct['coords'], params['block_size'], chips_struct.get('scene'))
+
+
+def chip_footprints(coords, transform):
+    """ Computes the extents of the chips in map coordinates, given the transform of their scene.
+
+    Args:
+        coords (list): Windows of the chips, as returned by the chips generators.
+        transform (affine.Affine or tuple): Transform of the scene, as an Affine or a GDAL geotransform.
+
+    Returns:
+        A list of shapely polygons with the footprint of each chip.
+    """
+    if not isinstance(transform, Affine):
+        transform = Affine.from_gdal(*transform)
+    return [Polygon([transform * (coord[col_key], coord[row_key])
+                     for row_key, col_key in [('upper_row', 'left_col'), ('upper_row', 'right_col'),
+                                              ('lower_row', 'right_col'), ('lower_row', 'left_col')]])
+            for coord in coords]
+
+
+def polygon_blocks(chips_struct, params):
+    """ Assigns each chip to the polygon of a layer (e.g. regions or tiles) which contains its whole footprint.
+
+    The polygons are read from params['polygons'], and the transforms of the scenes from params['transforms']. If
+    params['field'] is given, the polygons with the same value of that attribute form a single block. Chips which are
+    not inside a single polygon (outside all of them, or crossing their borders) are assigned to the block -1, and
+    are not written to any fold.
+    """
+    polygons = gpd.read_file(params['polygons'])
+    transforms = params['transforms']
+    if transforms is None:
+        raise AttributeError('Mandatory argument "transforms" does not exists in parameters!')
+    coords = chips_struct['coords']
+    scenes = chips_struct.get('scene', np.zeros(len(coords), dtype=np.int32))
+
+    blocks = np.full(len(coords), -1, dtype=np.int64)
+    if params['field'] is None:
+        polygon_ids = np.arange(len(polygons))
+    else:
+        polygon_ids = np.unique(polygons[params['field']].values, return_inverse=True)[1].reshape(-1)
+    for scene in np.unique(scenes):
+        positions = np.flatnonzero(scenes == scene)
+        footprints = gpd.GeoSeries(chip_footprints([coords[pos] for pos in positions], transforms[scene]),
+                                   crs=polygons.crs)
+        chip_poly, poly = polygons.sindex.query(footprints, predicate='within')
+        # A chip inside overlapping polygons stays in the first one.
+        chip_poly, first = np.unique(chip_poly, return_index=True)
+        blocks[positions[chip_poly]] = polygon_ids[poly[first]]
+    return blocks
+
+
+def fold_files(out_path, filename, fold, num_folds):
+    """ Gets the TFRecord files of a cross validation round.
+
+    Args:
+        out_path (str): Directory of the folds, as given to CrossValidationBuilder.save_folds.
+        filename (str): Prefix of the folds files.
+        fold (int): Fold used as test set.
+        num_folds (int): Number of folds.
+
+    Returns:
+        The lists with the train and the test files.
+    """
+    files = [os.path.join(out_path, filename + '_fold' + str(k) + '.tfrecord') for k in range(num_folds)]
+    return files[:fold] + files[(fold + 1):], [files[fold]]
+
+
+class CrossValidationBuilder(object):
+    """ Builds a spatially blocked k-fold dataset from the chips of a DatasetGenerator.
+
+    The chips are grouped in spatial blocks, either square blocks of a grid (fold_by='grid') or the polygons of a
+    layer (fold_by='polygons'), and whole blocks are assigned to the folds. Only the chips entirely inside a block
+    are used (the chips crossing the borders of the blocks are discarded), so the chips of different folds never
+    share pixels. All folds are written in one pass over the chips, one TFRecord file per fold, and each
+    cross validation round takes one fold as test set and the others as train set (see fold_files).
+    """
+    default_params = {'num_folds': 5,
+                      'fold_by': 'grid',
+                      'block_size': 512,
+                      'polygons': None,
+                      'transforms': None,
+                      'field': None,
+                      'random_seed': None}
+
+    block_strategies = {'grid': grid_blocks,
+                        'polygons': polygon_blocks}
+
+    def __init__(self, dataset_generator, params=None):
+        if params is None:
+            params = {}
+        self.params = utils.check_dict_parameters(dict(params), default=self.default_params)
+        self.dataset_generator = dataset_generator
+        self.num_folds = self.params['num_folds']
+        self.folds = None
+
+    def assign_folds(self):
+        chips_struct = self.dataset_generator.chips_struct
+        blocks = self.block_strategies[self.params['fold_by']](chips_struct, self.params)
+        self.folds = np.full(len(blocks), -1, dtype=np.int64)
+        valid = blocks >= 0
+        self.folds[valid] = dsutils.block_split(blocks[valid], [1] * self.num_folds, self.params['random_seed'])
+        return self.folds
+
+    def save_folds(self, out_path, filename):
+        print('  -> Saving folds to disk...')
+        if self.folds is None:
+            self.assign_folds()
+        chips_struct = self.dataset_generator.chips_struct
+        fs.mkdir(out_path)
+
+        counts = np.bincount(self.folds[self.folds >= 0], minlength=self.num_folds)
+        writers = [tf.io.TFRecordWriter(os.path.join(out_path, filename + '_fold' + str(k) + '.tfrecord'))
+                   for k in range(self.num_folds)]
+        for pos in np.flatnonzero(self.folds >= 0):
+            writers[self.folds[pos]].write(dsgen.serialize_chip(chips_struct['chips'][pos],
+                                                                chips_struct['labels'][pos]))
+        for writer in writers:
+            writer.close()
+
+        description = self.dataset_generator.description
+        if description is None:
+            description = {}
+        description['num_folds'] = self.num_folds
+        description['fold_by'] = self.params['fold_by']
+        for k in range(self.num_folds):
+            description['fold' + str(k) + '_samples'] = int(counts[k])
+        utils.save_dict_2_csv(description, os.path.join(out_path, 'description.csv'))
+        print('  -> DONE!')
@@ -1,10 +1,11 @@
+import concurrent.futures
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 import os
 import sys
 import scipy.misc
 import pylab as pl
-import sklearn
 # from osgeo import gdal
 # from osgeo import ogr
 # from osgeo import osr  # TODO: Verify if it is really necessary? If I get the SRID from the Raster I still need this?
@@ -12,6 +13,7 @@ import sklearn
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../"))
 import common.utils as utils
 import common.filesystem as fs
+import common.geofunctions as gf
 import dataset.sequential_chips as seqchips
 import dataset.random_chips as rdmchips
 import dataset.centroids_chips as centchips
@@ -30,6 +32,60 @@ def wrap_int64(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
+def serialize_chip(img, lbl):
+    feature = {'image': wrap_bytes(img.tobytes()),
+               'label': wrap_bytes(lbl.tobytes()),
+               'channels': wrap_int64(img.shape[2]),
+               'height': wrap_int64(img.shape[0]),
+               'width': wrap_int64(img.shape[1])}
+
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example.SerializeToString()
+
+
+def read_chips(tfrecord_path, image_dtype=np.float32, label_dtype=np.int32):
+    """ Reads the chips of a TFRecord file written by serialize_chip (e.g. the valid split of save_to_disk or
+    generate_chips_parallel) to arrays, e.g. for ModelBuilder.validate.
+
+    Returns:
+        A dict with the chips and the labels arrays.
+    """
+    chips = []
+    labels = []
+    for record in tf.compat.v1.io.tf_record_iterator(tfrecord_path):
+        feature = tf.train.Example.FromString(record).features.feature
+        shape = [feature[key].int64_list.value[0] for key in ['height', 'width', 'channels']]
+        chips.append(np.frombuffer(feature['image'].bytes_list.value[0], dtype=image_dtype).reshape(shape))
+        labels.append(np.frombuffer(feature['label'].bytes_list.value[0], dtype=label_dtype).reshape(shape[:2] + [-1]))
+    return {'chips': np.array(chips), 'labels': np.array(labels)}
+
+
+def no_data_chips(labels, chip_size, tolerance=.99):
+    labels = np.asarray(labels).reshape(labels.shape[0], -1)
+    return np.count_nonzero(labels == 0, axis=1) > ((chip_size * chip_size) * tolerance)
+
+
+def _generate_scene_chips(strategy, raster_path, labels_path, params, no_data, tolerance, preprocess_func):
+    params = dict(params)
+    raster_array = gf.load_image(raster_path, no_data)
+    if preprocess_func is not None:
+        raster_array = preprocess_func(raster_array)
+    labels_array = gf.load_image(labels_path)
+    if len(labels_array.shape) < 3:
+        labels_array = np.expand_dims(labels_array.astype(np.int32), -1)
+
+    params['raster_array'] = raster_array
+    params['labels_array'] = labels_array
+    chips_struct = DatasetGenerator.strategies[strategy](params).generate_chips()
+
+    if tolerance is not None:
+        keep = ~no_data_chips(chips_struct['labels'], params['win_size'], tolerance)
+        chips_struct['chips'] = chips_struct['chips'][keep]
+        chips_struct['labels'] = chips_struct['labels'][keep]
+        chips_struct['coords'] = [x for i, x in enumerate(chips_struct['coords']) if keep[i]]
+    return raster_path, chips_struct
+
+
 class DatasetGenerator(object):
     strategies = {
         'sequential': seqchips.SequentialChipGenerator,
@@ -46,7 +102,7 @@ class DatasetGenerator(object):
             labels_arrays = [labels_arrays]
 
         for pos, lbl in enumerate(labels_arrays):
-            if len(lbl.shape) < 3:
+            if not isinstance(lbl, str) and len(lbl.shape) < 3:
                 labels_arrays[pos] = np.expand_dims(lbl.astype(np.int32), -1)
 
         self.raster_arrays = raster_arrays
@@ -61,6 +117,7 @@ class DatasetGenerator(object):
         self.chips_struct['chips'] = []
         self.chips_struct['labels'] = []
         self.chips_struct['coords'] = []
+        self.chips_struct['scene'] = []
         for i in range(0, len(self.raster_arrays)):
             params['raster_array'] = self.raster_arrays[i]
             params['labels_array'] = self.labels_arrays[i]
@@ -71,87 +128,199 @@ class DatasetGenerator(object):
             self.chips_struct['chips'].append(chips_struct['chips'])
             self.chips_struct['labels'].append(chips_struct['labels'])
             self.chips_struct['coords'] = self.chips_struct['coords'] + list(chips_struct['coords'])
+            self.chips_struct['scene'].append(np.full(len(chips_struct['chips']), i, dtype=np.int32))
 
         self.chips_struct['chips'] = np.concatenate(self.chips_struct['chips'], axis=0)
         self.chips_struct['labels'] = np.concatenate(self.chips_struct['labels'], axis=0)
+        self.chips_struct['scene'] = np.concatenate(self.chips_struct['scene'], axis=0)
         if 'overlap' in params:
             self.chips_struct['overlap'] = params['overlap']
 
+    def generate_chips_parallel(self, params, out_path, filename, num_workers=None, no_data=0, tolerance=.99,
+                                perc_test=20, perc_val=20, random_seed=None, preprocess_func=None):
+        """ Generates the chips of several scenes in parallel, streaming them to TFRecord files.
+
+        Each scene is loaded, chipped and filtered in a worker process. The generator must be created with the paths
+        of the rasters and labels instead of arrays. At most num_workers scenes are processed at the same time, and
+        the chips of each scene are written as soon as they are ready, so the scenes are never all in memory. Each
+        chip is assigned to the train, test or valid split at random, and the three splits are written as
+        filename_<split>.tfrecord, as in save_to_disk. The valid split is also written as filename_valid.npz.
+
+        Args:
+            params (dict): Parameters of the chips generation strategy, without raster_array and labels_array.
+            out_path (str): Directory of the output files.
+            filename (str): Prefix of the output files.
+            num_workers (int): Number of worker processes. Default: number of CPUs.
+            no_data (number): No data value of the rasters.
+            tolerance (float): Chips with more than this proportion of no data labels are discarded. If None, no
+                chip is discarded.
+            perc_test (number): Percentage of chips in the test split.
+            perc_val (number): Percentage of chips in the valid split.
+            random_seed (int): Seed of the splits assignment.
+            preprocess_func (function): Optional function applied to each raster array before chipping. It must be
+                defined at the top level of a module, to be sent to the workers.
+        """
+        print('  -> Generating chips in parallel...')
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.chip_size = params['win_size']
+
+        fs.mkdir(out_path)
+        splits = ['train', 'test', 'valid']
+        proportions = np.array([100 - perc_test - perc_val, perc_test, perc_val], dtype=np.float64) / 100
+        rng = np.random.default_rng(random_seed)
+        counts = dict.fromkeys(splits, 0)
+        dtypes = None
+        writers = {suf: tf.io.TFRecordWriter(os.path.join(out_path, filename + '_' + suf + '.tfrecord'))
+                   for suf in splits}
+
+        scenes = list(zip(self.raster_arrays, self.labels_arrays))
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+            running = set()
+            while len(scenes) > 0 or len(running) > 0:
+                while len(scenes) > 0 and len(running) < num_workers:
+                    raster_path, labels_path = scenes.pop(0)
+                    running.add(executor.submit(_generate_scene_chips, self.strategy, raster_path, labels_path,
+                                                params, no_data, tolerance, preprocess_func))
+
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    raster_path, chips_struct = future.result()
+                    if dtypes is None and len(chips_struct['chips']) > 0:
+                        dtypes = (chips_struct['chips'].dtype, chips_struct['labels'].dtype)
+                    assignment = rng.choice(len(splits), len(chips_struct['chips']), p=proportions)
+                    for pos in range(len(chips_struct['chips'])):
+                        suf = splits[assignment[pos]]
+                        writers[suf].write(serialize_chip(chips_struct['chips'][pos], chips_struct['labels'][pos]))
+                        counts[suf] += 1
+                    print('    -> ' + str(len(chips_struct['chips'])) + ' chips from ' + raster_path)
+
+        for writer in writers.values():
+            writer.close()
+
+        # The valid split is also written as filename_valid.npz, as in save_to_disk, for ModelBuilder.validate.
+        valid_path = os.path.join(out_path, filename + '_valid')
+        valid = {'chips': np.array([]), 'labels': np.array([])}
+        if dtypes is not None:
+            valid = read_chips(valid_path + '.tfrecord', *dtypes)
+        np.savez(valid_path + '.npz', chips=valid['chips'], labels=valid['labels'])
+
+        self.chips_struct = {suf: {'count': counts[suf]} for suf in splits}
+        if self.description is not None:
+            for suf in splits:
+                self.description[suf + '_samples'] = counts[suf]
+            utils.save_dict_2_csv(self.description, os.path.join(out_path, 'description.csv'))
+        print('  -> DONE!')
+
     def get_samples(self):
         return self.chips_struct
 
     def remove_no_data(self, tolerance=.99):
         print('  -> Removing no data chips...')
-        coords_remove = []
-        for i in range(0, len(self.chips_struct['chips'])):
-            if np.count_nonzero(self.chips_struct['labels'][i] == 0) > ((self.chip_size * self.chip_size) * tolerance):
-                coords_remove.append(i)
-        self.chips_struct['chips'] = np.delete(self.chips_struct['chips'], coords_remove, axis=0)
-        self.chips_struct['labels'] = np.delete(self.chips_struct['labels'], coords_remove, axis=0)
-        
-        self.chips_struct['coords'] = [x for i, x in enumerate(self.chips_struct['coords']) if i not in coords_remove]
-
-    def shuffle_ds(self):
+        keep = ~no_data_chips(self.chips_struct['labels'], self.chip_size, tolerance)
+        self.chips_struct['chips'] = self.chips_struct['chips'][keep]
+        self.chips_struct['labels'] = self.chips_struct['labels'][keep]
+
+        self.chips_struct['coords'] = [x for i, x in enumerate(self.chips_struct['coords']) if keep[i]]
+        if 'scene' in self.chips_struct:
+            self.chips_struct['scene'] = self.chips_struct['scene'][keep]
+
+    def get_index(self):
+        if 'index' not in self.chips_struct:
+            self.chips_struct['index'] = np.arange(len(self.chips_struct['chips']))
+        return self.chips_struct['index']
+
+    def shuffle_ds(self, random_seed=None):
         print('  -> Shuffling Dataset...')
-        chips, labels = sklearn.utils.shuffle(self.chips_struct['chips'],
-                                              self.chips_struct['labels'])
-        self.chips_struct['chips'] = chips
-        self.chips_struct['labels'] = labels
+        self.chips_struct['index'] = np.random.default_rng(random_seed).permutation(self.get_index())
 
-    def split_ds(self, perc_test=20, perc_val=20, random_seed=None):
+    def split_ds(self, perc_test=20, perc_val=20, random_seed=None, strategy='random', block_size=None):
+        """ Splits the dataset between train, test and valid, only through arrays of chip indexes.
+
+        The chips are not copied: each split keeps the indexes of its chips, which are gathered only when written
+        (save_to_disk) or requested (get_split).
+
+        Args:
+            perc_test (number): Percentage of chips in the test split.
+            perc_val (number): Percentage of chips in the valid split.
+            random_seed (int): Seed of the split.
+            strategy (str): 'random' splits the chips individually. 'block' keeps together the chips of each square
+                block of block_size pixels, and 'scene' the chips of each scene, avoiding spatial leakage between
+                the splits. With 'block', the chips which cross the borders of the blocks are discarded (see
+                dataset.utils.chip_block_ids).
+            block_size (int): Size of the blocks, in pixels, for the 'block' strategy.
+        """
         print('  -> Splitting Dataset...')
-        train_chips, test_chips, val_chips, train_labels, test_labels, val_labels =\
-            dsutils.split_dataset(self.chips_struct, perc_test, perc_val, random_seed)
-        self.chips_struct = {'train': {'chips': train_chips, 'labels': train_labels},
-                             'test': {'chips': test_chips, 'labels': test_labels},
-                             'valid': {'chips': val_chips, 'labels': val_labels}}
+        index = self.get_index()
+        if strategy == 'random':
+            train_idx, test_idx, val_idx = dsutils.split_indexes(index, perc_test, perc_val, random_seed)
+        else:
+            if strategy == 'block':
+                if block_size is None:
+                    raise AttributeError('Argument "block_size" is mandatory for the "block" strategy.')
+                block_ids = dsutils.chip_block_ids(self.chips_struct['coords'], block_size,
+                                                   self.chips_struct.get('scene'))
+            elif strategy == 'scene':
+                block_ids = self.chips_struct['scene']
+            else:
+                raise ValueError('Unknown split strategy: ' + str(strategy))
+            block_ids = block_ids[index]
+            if np.any(block_ids < 0):
+                print('  -> Discarding ', np.count_nonzero(block_ids < 0), ' chips which cross the blocks borders...')
+                index = index[block_ids >= 0]
+                block_ids = block_ids[block_ids >= 0]
+            groups = dsutils.block_split(block_ids, [100 - perc_test - perc_val, perc_test, perc_val], random_seed)
+            train_idx, test_idx, val_idx = index[groups == 0], index[groups == 1], index[groups == 2]
+
+        self.chips_struct['train'] = {'index': train_idx}
+        self.chips_struct['test'] = {'index': test_idx}
+        self.chips_struct['valid'] = {'index': val_idx}
+
+    def get_split(self, split):
+        index = self.chips_struct[split]['index']
+        return {'chips': self.chips_struct['chips'][index],
+                'labels': self.chips_struct['labels'][index],
+                'coords': [self.chips_struct['coords'][i] for i in index]}
 
     def save_to_disk(self, out_path, filename):
+        """ Writes the splits to filename_<split>.tfrecord, as generate_chips_parallel, or all the chips to
+        filename_.tfrecord if the dataset was not split. The valid split is also written as filename_valid.npz (chips
+        and labels arrays, e.g. for ModelBuilder.validate).
+        """
         print('  -> Saving Datasets to disk...')
 
         fs.mkdir(out_path)
         if self.description is not None:
             if 'train' in self.chips_struct:
-                self.description['train_samples'] = self.chips_struct['train']['chips'].shape[0]
+                self.description['train_samples'] = len(self.chips_struct['train']['index'])
             if 'test' in self.chips_struct:
-                self.description['test_samples'] = self.chips_struct['test']['chips'].shape[0]
+                self.description['test_samples'] = len(self.chips_struct['test']['index'])
             if 'valid' in self.chips_struct:
-                self.description['valid_samples'] = self.chips_struct['valid']['chips'].shape[0]
+                self.description['valid_samples'] = len(self.chips_struct['valid']['index'])
 
             utils.save_dict_2_csv(self.description, os.path.join(out_path, 'description.csv'))
 
         if 'train' in self.chips_struct:
             suffixes = ['train', 'test']
+            if 'valid' in self.chips_struct:
+                suffixes.append('valid')
         else:
             suffixes = ['']
         for suf in suffixes:
-            chips = self.chips_struct[suf]
+            index = self.chips_struct[suf]['index'] if suf != '' else self.get_index()
             out_file_path = os.path.join(out_path, filename + '_' + suf + '.tfrecord')
             with tf.io.TFRecordWriter(out_file_path) as writer:
-                for pos in range(chips['chips'].shape[0]):
-                    img = chips['chips'][pos, :, :, :]
-                    lbl = chips['labels'][pos, :, :, :]
-
-                    height = img.shape[0]
-                    width = img.shape[1]
-                    channels = img.shape[2]
-
-                    img_raw = img.tostring()
-                    lbl_raw = lbl.tostring()
-
-                    feature = {'image': wrap_bytes(img_raw),
-                               'label': wrap_bytes(lbl_raw),
-                               'channels': wrap_int64(channels),
-                               'height': wrap_int64(height),
-                               'width': wrap_int64(width)}
-
-                    example = tf.train.Example(features=tf.train.Features(feature=feature))
-                    writer.write(example.SerializeToString())
-
-        out_file_path = os.path.join(out_path, filename + '_valid.npz')
-        np.savez(out_file_path,
-                 chips=self.chips_struct['valid']['chips'],
-                 labels=self.chips_struct['valid']['labels'])
+                for pos in index:
+                    writer.write(serialize_chip(self.chips_struct['chips'][pos, :, :, :],
+                                                self.chips_struct['labels'][pos, :, :, :]))
+
+        if 'valid' in self.chips_struct:
+            valid_index = self.chips_struct['valid']['index']
+            np.savez(os.path.join(out_path, filename + '_valid.npz'),
+                     chips=self.chips_struct['chips'][valid_index],
+                     labels=self.chips_struct['labels'][valid_index])
+
         print('  -> DONE!')
 
     def save_samples_PNG(self, path, color_map=None, r_g_b=[1, 2, 3]):
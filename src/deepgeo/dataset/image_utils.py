@@ -1,50 +1,144 @@
 from osgeo import gdal
 from osgeo import ogr
 import numpy as np
-import fiona
 import os
-import rasterio
-import rasterio.mask
-import shapely
-import shutil
 import subprocess
-
-
-def stack_bands(files, output_img, band_names=None):#, no_data=-9999, format="GTiff", dtype=gdal.GDT_Int16):
+import tempfile
+import uuid
+from xml.sax.saxutils import escape
+
+
+def _simple_source_xml(file_path, band_number, band, x_size, y_size):
+    # The path is escaped, as it may have XML special characters (e.g. "&" or "<").
+    return ('<SimpleSource>'
+            '<SourceFilename relativeToVRT="0">{path}</SourceFilename>'
+            '<SourceBand>{band}</SourceBand>'
+            '<SourceProperties RasterXSize="{xs}" RasterYSize="{ys}" DataType="{dtype}" '
+            'BlockXSize="{bx}" BlockYSize="{by}"/>'
+            '<SrcRect xOff="0" yOff="0" xSize="{xs}" ySize="{ys}"/>'
+            '<DstRect xOff="0" yOff="0" xSize="{xs}" ySize="{ys}"/>'
+            '</SimpleSource>').format(path=escape(file_path), band=band_number, xs=x_size, ys=y_size,
+                                      dtype=gdal.GetDataTypeName(band.DataType),
+                                      bx=band.GetBlockSize()[0], by=band.GetBlockSize()[1])
+
+
+def build_stacked_vrt(files, output_vrt, band_names=None, all_bands=True):
+    """ Stacks the bands of several rasters in a persistent VRT, without copying pixels.
+
+    The VRT only references the input files, so downstream readers (e.g. gdal.Open, load_image) read the pixels
+    lazily from the original rasters. Band descriptions, no data values and band metadata are copied to the VRT.
+
+    Args:
+        files (list): Paths to the rasters to be stacked. All of them must have the same dimensions.
+        output_vrt (str): Path to the output VRT. It can be a /vsimem/ path.
+        band_names (list): Optional. Descriptions of the output bands. If None, the descriptions of the input bands
+            are used, or "band_<pos>" when they are empty.
+        all_bands (bool): If True, all the bands of each file are stacked. Otherwise, only the first one.
+
+    Returns:
+        The path to the created VRT.
+    """
     if not isinstance(files, list):
         raise TypeError("Argument \"files\" must be a list.")
-    
+
     if len(files) < 2:
         raise Exception("You must provide at least two .tiff files.")
 
+    base_ds = gdal.Open(files[0])
+    x_size = base_ds.RasterXSize
+    y_size = base_ds.RasterYSize
+
+    if not output_vrt.startswith('/vsimem/') and os.path.exists(output_vrt):
+        os.remove(output_vrt)
+
+    out_ds = gdal.GetDriverByName('VRT').Create(output_vrt, x_size, y_size, 0)
+    out_ds.SetGeoTransform(base_ds.GetGeoTransform())
+    out_ds.SetProjection(base_ds.GetProjection())
+
+    count = 0
+    for file_path in files:
+        in_ds = gdal.Open(file_path)
+        if in_ds.RasterXSize != x_size or in_ds.RasterYSize != y_size:
+            raise AttributeError('Raster "' + file_path + '" has different dimensions from "' + files[0] + '".')
+
+        num_bands = in_ds.RasterCount if all_bands else 1
+        source_path = file_path if file_path.startswith('/vsi') else os.path.abspath(file_path)
+        for j in range(1, num_bands + 1):
+            in_band = in_ds.GetRasterBand(j)
+            out_ds.AddBand(in_band.DataType)
+            out_band = out_ds.GetRasterBand(count + 1)
+            out_band.SetMetadataItem('source_0', _simple_source_xml(source_path, j, in_band, x_size, y_size),
+                                     'new_vrt_sources')
+
+            no_data = in_band.GetNoDataValue()
+            if no_data is not None:
+                out_band.SetNoDataValue(no_data)
+            out_band.SetMetadata(in_band.GetMetadata())
+
+            if band_names is not None:
+                name = band_names[count]
+            else:
+                name = in_band.GetDescription()
+                if name == '':
+                    name = "band_" + str(count)
+            out_band.SetDescription(name)
+            count = count + 1
+        in_ds = None
+
+    out_ds.FlushCache()
+    out_ds = None
+    base_ds = None
+    return output_vrt
+
+
+def materialize_raster(in_raster, output_img, compress='LZW', block_size=256, num_threads='ALL_CPUS',
+                       data_type=None):
+    """ Writes a (virtual) raster to a tiled and compressed GeoTIFF.
+
+    The compression runs in several threads (GDAL NUM_THREADS), and the pixels are read in blocks from the input, so
+    the whole raster is never loaded into memory.
+
+    Args:
+        in_raster (str): Path to the input raster, usually a VRT created by build_stacked_vrt.
+        output_img (str): Path to the output GeoTIFF.
+        compress (str): GeoTIFF compression method. If None, the output is not compressed.
+        block_size (int): Size of the square tiles of the output.
+        num_threads (int or str): Number of threads used to compress the output. Default: 'ALL_CPUS'.
+        data_type (int): Optional GDAL data type of the output. If None, the input data type is kept.
+    """
+    if os.path.exists(output_img):
+        os.remove(output_img)
+
+    creation_options = ['TILED=YES',
+                        'BLOCKXSIZE=' + str(block_size),
+                        'BLOCKYSIZE=' + str(block_size),
+                        'BIGTIFF=IF_SAFER',
+                        'NUM_THREADS=' + str(num_threads)]
+    if compress is not None:
+        creation_options.append('COMPRESS=' + compress)
+
+    gdal.Translate(output_img, in_raster, format='GTiff', outputType=data_type or gdal.GDT_Unknown,
+                   creationOptions=creation_options)
+
+
+def stack_bands(files, output_img, band_names=None, virtual=False, compress='LZW'):
     if band_names is None:
         band_names = []
-        for i in range(0, len(files )): #TODO: Verify this
+        for i in range(0, len(files)):
             ds = gdal.Open(files[i])
             name = ds.GetRasterBand(1).GetDescription()
             if name == '':
                 name = "band_" + str(i)
             band_names.append(name)
 
-    if os.path.exists(output_img):
-        os.remove(output_img)
-
-    outvrt = '/vsimem/stacked.vrt' #/vsimem is special in-memory virtual "directory"
-    outds = gdal.BuildVRT(outvrt, files, separate=True)
+    if virtual:
+        return build_stacked_vrt(files, output_img, band_names, all_bands=False)
 
-    count = 1
-    for i in range(0, len(files)):
-        ds = gdal.Open(files[i])
-        for j in range(1, ds.RasterCount + 1):
-            outds.GetRasterBand(count).SetNoDataValue(ds.GetRasterBand(j).GetNoDataValue())
-            outds.GetRasterBand(count).SetMetadata(ds.GetRasterBand(j).GetMetadata())
-            outds.GetRasterBand(count).SetDescription(band_names[count - 1])
-            count = count + 1
-
-    ds = gdal.Open(files[0])
-    outds.SetGeoTransform(ds.GetGeoTransform())
-    outds.SetProjection(ds.GetProjection())
-    gdal.Translate(output_img, outds, options=['COMPRESS=LZW'])
+    outvrt = '/vsimem/stacked_' + uuid.uuid4().hex + '.vrt' #/vsimem is special in-memory virtual "directory"
+    build_stacked_vrt(files, outvrt, band_names, all_bands=False)
+    materialize_raster(outvrt, output_img, compress=compress)
+    gdal.Unlink(outvrt)
+    return output_img
 
 
 def clip_img_by_extent_shp(img_file, reference_shp, output_img):
@@ -69,48 +163,15 @@ def clip_img_by_extent_shp(img_file, reference_shp, output_img):
     raster_to_clip = None
 
 
-def stack_temporal_images(files, output_img, band_names=None):
-    if not isinstance(files, list):
-        raise TypeError("Argument \"files\" must be a list.")
-
-    if len(files) < 2:
-        raise Exception("You must provide at least two .tiff files.")
-
-    if os.path.exists(output_img):
-        os.remove(output_img)
-
-    num_bands = 0
-    for file in files:
-        inputds = gdal.Open(file)
-        num_bands = num_bands + inputds.RasterCount
-        inputds = None
-
-    drv = gdal.GetDriverByName("GTiff")
-    inputds = gdal.Open(files[0])
-    out_xSize = inputds.RasterXSize
-    out_ySize = inputds.RasterYSize
-    datatype = inputds.GetRasterBand(1).DataType
-
-    outds = drv.Create(output_img, out_xSize, out_ySize, num_bands, datatype, options=['COMPRESS=LZW'])
-
-    count = 1
-    for i in range(0, len(files)):
-        inputds = gdal.Open(files[i])
-
-        for j in range(1, inputds.RasterCount + 1):
-            band = inputds.GetRasterBand(j)
-            band_arr = band.ReadAsArray()
-            outds.GetRasterBand(count).WriteArray(band_arr)
-            outds.GetRasterBand(count).SetNoDataValue(inputds.GetRasterBand(j).GetNoDataValue())
-            outds.GetRasterBand(count).SetMetadata(inputds.GetRasterBand(j).GetMetadata())
-            outds.GetRasterBand(count).SetDescription(band_names[count - 1])
-            count = count + 1
-        inputds = None
+def stack_temporal_images(files, output_img, band_names=None, virtual=False, compress='LZW'):
+    if virtual:
+        return build_stacked_vrt(files, output_img, band_names)
 
-    ds = gdal.Open(files[0])
-    outds.SetGeoTransform(ds.GetGeoTransform())
-    outds.SetProjection(ds.GetProjection())
-    outds = None
+    outvrt = '/vsimem/temporal_' + uuid.uuid4().hex + '.vrt'
+    build_stacked_vrt(files, outvrt, band_names)
+    materialize_raster(outvrt, output_img, compress=compress)
+    gdal.Unlink(outvrt)
+    return output_img
 
 
 def mosaic_images(files, output_file, band_names=None):
@@ -162,64 +223,101 @@ def mosaic_images(files, output_file, band_names=None):
     input_ds = None
 
 
-def clip_by_aggregated_polygons(in_raster_path, shape_file, output_path, band_names=None, no_data=None):
+def _unique_tmp_path(reference_path, suffix='.tif'):
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix, prefix='.tmp_',
+                                    dir=os.path.dirname(os.path.abspath(reference_path)))
+    os.close(fd)
+    return tmp_path
+
+
+def _window_from_bounds(raster_ds, bounds):
+    min_x, min_y, max_x, max_y = bounds
+    inv_transform = gdal.InvGeoTransform(raster_ds.GetGeoTransform())
+    cols = []
+    rows = []
+    for x, y in [(min_x, min_y), (min_x, max_y), (max_x, min_y), (max_x, max_y)]:
+        cols.append(inv_transform[0] + inv_transform[1] * x + inv_transform[2] * y)
+        rows.append(inv_transform[3] + inv_transform[4] * x + inv_transform[5] * y)
+
+    col_start = max(int(np.floor(min(cols))), 0)
+    row_start = max(int(np.floor(min(rows))), 0)
+    col_end = min(int(np.ceil(max(cols))), raster_ds.RasterXSize)
+    row_end = min(int(np.ceil(max(rows))), raster_ds.RasterYSize)
+
+    if col_end <= col_start or row_end <= row_start:
+        raise ValueError('The clipping geometries do not intersect the raster.')
+
+    return [col_start, row_start, col_end - col_start, row_end - row_start]
+
+
+def _clip_by_cutline(in_raster_path, cutline_path, bounds, output_path, band_names=None, no_data=None,
+                     cutline_srs=None):
+    src_ds = gdal.Open(in_raster_path)
     if band_names is None:
         band_names = []
-        ds = gdal.Open(in_raster_path)
-        for i in range(1, ds.RasterCount):
-            name = ds.GetRasterBand(i).GetDescription()
+        for i in range(1, src_ds.RasterCount + 1):
+            name = src_ds.GetRasterBand(i).GetDescription()
             if name == '':
                 name = "band_" + str(i - 1)
             band_names.append(name)
 
     if no_data is None:
-        ds = gdal.Open(in_raster_path)
-        no_data = ds.GetRasterBand(1).GetNoDataValue()
+        no_data = src_ds.GetRasterBand(1).GetNoDataValue()
+        if no_data is None:
+            no_data = 0
 
-    with fiona.open(shape_file, "r") as shapefile:
-        features = [feature["geometry"] for feature in shapefile]
+    window_vrt = '/vsimem/clip_window_' + uuid.uuid4().hex + '.vrt'
+    gdal.Translate(window_vrt, src_ds, format='VRT', srcWin=_window_from_bounds(src_ds, bounds))
+    src_ds = None
 
-    with rasterio.open(in_raster_path) as src:
-        out_image, out_transform = rasterio.mask.mask(src, features, crop=True, nodata=no_data)
-        out_meta = src.meta.copy()
+    same_file = os.path.abspath(output_path) == os.path.abspath(in_raster_path)
+    target_path = _unique_tmp_path(output_path) if same_file else output_path
+    if not same_file and os.path.exists(output_path):
+        os.remove(output_path)
 
-    out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
+    try:
+        out_ds = gdal.Warp(target_path, window_vrt, format='GTiff', cutlineDSName=cutline_path,
+                           cutlineSRS=cutline_srs, dstNodata=no_data, multithread=True,
+                           creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+        for i, name in enumerate(band_names):
+            out_ds.GetRasterBand(i + 1).SetDescription(name)
+        out_ds = None
+    finally:
+        gdal.Unlink(window_vrt)
 
-    if os.path.exists(output_path):
-        os.remove(output_path)
+    if same_file:
+        os.replace(target_path, output_path)
 
-    with rasterio.open(output_path, "w", **out_meta) as dest:
-        for id, name in enumerate(band_names):
-            dest.set_band_description(id + 1, name)
-        dest.write(out_image)
 
+def clip_by_aggregated_polygons(in_raster_path, shape_file, output_path, band_names=None, no_data=None):
+    vector_ds = ogr.Open(shape_file)
+    min_x, max_x, min_y, max_y = vector_ds.GetLayer().GetExtent()
+    vector_ds = None
+
+    _clip_by_cutline(in_raster_path, shape_file, [min_x, min_y, max_x, max_y], output_path, band_names, no_data)
 
-def clip_img_by_network_output(img_file, net_overlap):
-    raster_to_clip = gdal.Open(img_file)
-    projection = raster_to_clip.GetProjectionRef()
 
-    x_start, pixel_width, _, y_start, _, pixel_height = raster_to_clip.GetGeoTransform()
+def clip_img_by_network_output(img_file, net_overlap, output_img=None):
+    if output_img is None:
+        output_img = img_file
+
+    raster_to_clip = gdal.Open(img_file)
     x_size = raster_to_clip.RasterXSize
     y_size = raster_to_clip.RasterYSize
 
-    x_end = x_start + (x_size * pixel_width)
-    y_end = y_start + (y_size * pixel_height)
+    x_offset = int(round(net_overlap[0] / 2))
+    y_offset = int(round(net_overlap[1] / 2))
+    src_window = [x_offset, y_offset, x_size - (2 * x_offset), y_size - (2 * y_offset)]
 
-    min_x = x_start + (round(net_overlap[0] / 2) * pixel_width)
-    max_x = x_end - (round(net_overlap[0] / 2) * pixel_width)
-    min_y = y_start + (round(net_overlap[1] / 2) * pixel_height)
-    max_y = y_end - (round(net_overlap[1] / 2) * pixel_height)
-
-    gdal.Translate('tmp.tif', raster_to_clip, format="GTiff",
-                   projWin=[min_x, min_y, max_x, max_y],
-                   #dstSRS=projection, resampleAlg=gdal.GRA_NearestNeighbour,
-                   options=['COMPRESS=LZW'])
+    same_file = os.path.abspath(output_img) == os.path.abspath(img_file)
+    target_path = _unique_tmp_path(output_img) if same_file else output_img
 
+    gdal.Translate(target_path, raster_to_clip, format="GTiff", srcWin=src_window,
+                   creationOptions=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
     raster_to_clip = None
-    shutil.move('tmp.tif', img_file)
+
+    if same_file:
+        os.replace(target_path, output_img)
 
 
 def compute_cloud_mask(img_array, qa_pos=0):
@@ -236,34 +334,15 @@ def compute_cloud_mask(img_array, qa_pos=0):
     return cl_mask
 
 def clip_by_polygon(in_raster_path, geoms, output_path, band_names=None, no_data=None):
-    if band_names is None:
-        band_names = []
-        ds = gdal.Open(in_raster_path)
-        for i in range(1, ds.RasterCount):
-            name = ds.GetRasterBand(i).GetDescription()
-            if name == '':
-                name = "band_" + str(i - 1)
-            band_names.append(name)
-
-    if no_data is None:
-        ds = gdal.Open(in_raster_path)
-        no_data = ds.GetRasterBand(1).GetNoDataValue()
-
-    geoms = [shapely.geometry.mapping(x) for x in geoms.values.tolist()]
-
-    with rasterio.open(in_raster_path) as src:
-        out_image, out_transform = rasterio.mask.mask(src, geoms, crop=True, nodata=no_data)
-        out_meta = src.meta.copy()
-
-    out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
-
-    if os.path.exists(output_path):
-        os.remove(output_path)
-
-    with rasterio.open(output_path, "w", **out_meta) as dest:
-        for id, name in enumerate(band_names):
-            dest.set_band_description(id + 1, name)
-        dest.write(out_image)
+    raster_srs = gdal.Open(in_raster_path).GetProjection()
+    if geoms.crs is not None:
+        geoms = geoms.to_crs(raster_srs)
+
+    cutline_path = '/vsimem/cutline_' + uuid.uuid4().hex + '.geojson'
+    gdal.FileFromMemBuffer(cutline_path, geoms.to_json())
+
+    try:
+        _clip_by_cutline(in_raster_path, cutline_path, geoms.total_bounds, output_path, band_names, no_data,
+                         cutline_srs=raster_srs)
+    finally:
+        gdal.Unlink(cutline_path)
@@ -6,6 +6,7 @@ from os import path
 
 sys.path.insert(0, path.join(path.dirname(__file__), '..'))
 import common.geofunctions as gf
+import common.raster_writer as rw
 
 
 # ----------------------------------------------------------------- #
@@ -210,29 +211,16 @@ class Preprocessor(object):
         self.raster_array.set_fill_value(new_value)
         self.raster_dummy = new_value
 
-    def save_index_raster(self, index, out_path):
-        driver = gdal.GetDriverByName("GTiff")
-        ds_band = self.img_dataset.GetRasterBand(1)
-        out_xSize = ds_band.XSize
-        out_ySize = ds_band.YSize
-        output_ds = driver.Create(out_path,
-                                  out_xSize, out_ySize, 1)
-        output_ds.SetProjection(self.img_dataset.GetProjection())
-        output_ds.SetGeoTransform(self.img_dataset.GetGeoTransform())
-        outputBand = output_ds.GetRasterBand(1)
-        outputBand.WriteArray(self.get_index_band(index))
-
-    def save_stacked_raster(self, out_path):
-        driver = gdal.GetDriverByName("GTiff")
-        ds_band = self.img_dataset.GetRasterBand(1)
-        out_xSize = ds_band.XSize
-        out_ySize = ds_band.YSize
-        nbands = self.raster_array.shape[2]
-        output_ds = driver.Create(out_path,
-                                  out_xSize, out_ySize, nbands)
-
-        for band in range(nbands):
-            output_ds.SetProjection(self.img_dataset.GetProjection())
-            output_ds.SetGeoTransform(self.img_dataset.GetGeoTransform())
-            outputBand = output_ds.GetRasterBand(band + 1)
-            outputBand.WriteArray(self.raster_array[:,:,band])
+    def __writer_params(self, params):
+        writer_params = {'no_data': self.raster_dummy}
+        if params is not None:
+            writer_params.update(params)
+        return writer_params
+
+    def save_index_raster(self, index, out_path, params=None):
+        rw.write_raster(out_path, self.get_index_band(index), self.img_dataset.GetGeoTransform(),
+                        self.img_dataset.GetProjection(), self.__writer_params(params), band_names=[index])
+
+    def save_stacked_raster(self, out_path, params=None):
+        rw.write_raster(out_path, self.raster_array, self.img_dataset.GetGeoTransform(),
+                        self.img_dataset.GetProjection(), self.__writer_params(params))
@@ -7,10 +7,135 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import common.utils as utils
 
 
+def _label_block(labels_array, row_start, row_end):
+    block = labels_array[row_start:row_end]
+    if block.ndim > 2:
+        block = block[:, :, 0]
+    valid = ~np.ma.getmaskarray(block)
+    return np.ma.getdata(block), valid
+
+
+def _stratum_filter(block, valid, stratum):
+    if stratum is None:
+        return valid
+    return np.logical_and(valid, block == stratum)
+
+
+def count_strata(labels_array, strata, block_rows=512):
+    """ Counts the valid pixels of each stratum, block by block.
+
+    Args:
+        labels_array (numpy.ndarray): Labels (rows x cols [x 1]). Masked pixels are not counted.
+        strata (list): Label values of each stratum. A stratum None contains all the valid pixels.
+        block_rows (int): Number of rows processed at once.
+
+    Returns:
+        An array (number of blocks x number of strata) with the pixel counts.
+    """
+    num_rows = labels_array.shape[0]
+    counts = []
+    for row_start in range(0, num_rows, block_rows):
+        block, valid = _label_block(labels_array, row_start, row_start + block_rows)
+        counts.append([np.count_nonzero(_stratum_filter(block, valid, stratum)) for stratum in strata])
+    return np.array(counts, dtype=np.int64).reshape(-1, len(strata))
+
+
+def balanced_quotas(quantity, available):
+    """ Splits quantity samples evenly among the strata, moving the surplus of the small strata to the others.
+
+    Args:
+        quantity (int): Total number of samples.
+        available (list): Number of pixels available in each stratum.
+
+    Returns:
+        A list with the number of samples of each stratum.
+    """
+    available = np.asarray(available, dtype=np.int64)
+    quotas = np.zeros(len(available), dtype=np.int64)
+    remaining = min(int(quantity), int(available.sum()))
+    while remaining > 0:
+        open_strata = np.flatnonzero(quotas < available)
+        share = np.full(len(open_strata), remaining // len(open_strata), dtype=np.int64)
+        share[:remaining % len(open_strata)] += 1
+        share = np.minimum(share, available[open_strata] - quotas[open_strata])
+        quotas[open_strata] += share
+        remaining -= int(share.sum())
+    return quotas.tolist()
+
+
+def proportional_quotas(quantity, available):
+    available = np.asarray(available, dtype=np.int64)
+    quantity = min(int(quantity), int(available.sum()))
+    if quantity == 0:
+        return [0] * len(available)
+    quotas = np.floor(quantity * available / available.sum()).astype(np.int64)
+    remainder = quantity - int(quotas.sum())
+    quotas[np.argsort(quotas - (quantity * available / available.sum()))[:remainder]] += 1
+    return quotas.tolist()
+
+
+def stratified_sample(labels_array, strata, quotas, block_rows=512, seed=None, counts=None):
+    """ Samples pixel positions per stratum without materializing all the candidate pixels.
+
+    The valid pixels of each stratum are counted block by block, the ranks of the samples are drawn among these counts
+    and, in a second pass, only the selected ranks are converted into positions. The memory used is bounded by the
+    size of one block plus the number of samples.
+
+    Args:
+        labels_array (numpy.ndarray): Labels (rows x cols [x 1]). Masked pixels are never sampled.
+        strata (list): Label values of each stratum. A stratum None contains all the valid pixels.
+        quotas (list): Number of samples drawn from each stratum. It is limited to the number of pixels available.
+        block_rows (int): Number of rows processed at once.
+        seed (int): Seed of the random generator.
+        counts (numpy.ndarray): Optional result of count_strata, to avoid counting twice.
+
+    Returns:
+        An array (number of samples x 2) of int32 with the (row, col) positions, in random order.
+    """
+    rng = np.random.default_rng(seed)
+    if counts is None:
+        counts = count_strata(labels_array, strata, block_rows)
+
+    selected = [[] for _ in range(counts.shape[0])]
+    for pos, stratum in enumerate(strata):
+        cum_counts = np.cumsum(counts[:, pos])
+        total = int(cum_counts[-1]) if len(cum_counts) > 0 else 0
+        quota = min(int(quotas[pos]), total)
+        if quota == 0:
+            continue
+        ranks = np.sort(rng.choice(total, quota, replace=False))
+        blocks = np.searchsorted(cum_counts, ranks, side='right')
+        offsets = cum_counts - counts[:, pos]
+        for block_id in np.unique(blocks):
+            selected[block_id].append((stratum, ranks[blocks == block_id] - offsets[block_id]))
+
+    samples = []
+    for block_id, block_selection in enumerate(selected):
+        if len(block_selection) == 0:
+            continue
+        row_start = block_id * block_rows
+        block, valid = _label_block(labels_array, row_start, row_start + block_rows)
+        for stratum, local_ranks in block_selection:
+            flat_positions = np.flatnonzero(_stratum_filter(block, valid, stratum))[local_ranks]
+            rows, cols = np.divmod(flat_positions, block.shape[1])
+            samples.append(np.stack([rows + row_start, cols], axis=-1).astype(np.int32))
+
+    if len(samples) == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+    return rng.permutation(np.concatenate(samples, axis=0))
+
+
 class RandomChipGenerator(object):
     mandatory_params = ['raster_array', 'labels_array', 'win_size', 'quantity', 'class_names']
     default_params = {'class_of_interest': None,
-                      'remove_no_data': None}
+                      'remove_no_data': None,
+                      'sampling': 'balanced',
+                      'quotas': None,
+                      'block_rows': 512,
+                      'seed': None}
+
+    sampling_strategies = {'balanced': balanced_quotas,
+                           'proportional': proportional_quotas}
 
     def __init__(self, params):
         params = utils.check_dict_parameters(params, self.mandatory_params, self.default_params)
@@ -20,27 +145,29 @@ class RandomChipGenerator(object):
         self.class_of_interest = params['class_of_interest']
         self.quantity = params['quantity']
         self.class_names = params['class_names']
+        self.sampling = params['sampling']
+        self.quotas = params['quotas']
+        self.block_rows = params['block_rows']
+        self.seed = params['seed']
 
     def compute_indexes(self):
         """
-        Sample quantity indices in the labeled image
+        Sample quantity indices in the labeled image, stratified by the classes of interest
         """
         if self.class_of_interest is None:
-            self.sample_candidates = np.transpose(np.nonzero(~self.labeled_img.mask))
-        elif isinstance(self.class_of_interest, list):
-            self.sample_candidates = []
-            for clazz in self.class_of_interest:
-                label_interest = self.class_names.index(clazz)
-                self.sample_candidates.append(np.transpose(np.nonzero(np.logical_and(~self.labeled_img.mask,
-                                                                                self.labeled_img == label_interest))))
-            self.sample_candidates = np.concatenate(self.sample_candidates, axis=0)
+            classes = [None]
+            strata = [None]
         else:
-            label_interest = self.class_names.index(self.class_of_interest)
-            self.sample_candidates = np.transpose(np.nonzero(np.logical_and(~self.labeled_img.mask,
-                                                                            self.labeled_img == label_interest)))
-        indices = np.random.choice(np.arange(len(self.sample_candidates)), self.quantity, replace=False)
-        self.ij_samples = self.sample_candidates[indices]
-        print(self.ij_samples, type(self.ij_samples))
+            classes = self.class_of_interest if isinstance(self.class_of_interest, list) else [self.class_of_interest]
+            strata = [self.class_names.index(clazz) for clazz in classes]
+
+        counts = count_strata(self.labeled_img, strata, self.block_rows)
+        if self.quotas is not None:
+            quotas = [self.quotas[clazz] for clazz in classes]
+        else:
+            quotas = self.sampling_strategies[self.sampling](self.quantity, counts.sum(axis=0))
+
+        self.ij_samples = stratified_sample(self.labeled_img, strata, quotas, self.block_rows, self.seed, counts)
 
     def compute_window_coords(self, coord):
         window_coords = {}
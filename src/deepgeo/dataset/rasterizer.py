@@ -5,8 +5,8 @@ from osgeo import gdal
 from osgeo import ogr
 
 sys.path.insert(0, path.join(path.dirname(__file__),"../"))
-import common.utils as utilfuncs
 import dataset.image_utils as iutils
+import dataset.utils as dsutils
 
 
 class Rasterizer(object):
@@ -76,25 +76,33 @@ class Rasterizer(object):
         assert(err == gdal.CE_None)
         return mem_raster.ReadAsArray()
 
-    def rasterize_layer(self):
-        vector_ds = ogr.Open(self.vector_path)
-        vector_layer = vector_ds.GetLayer()
-        self.labeled_raster = np.ma.masked_all((self.base_raster.RasterYSize, 
-                                self.base_raster.RasterXSize, 1),
-                                dtype=np.int32)
+    def rasterize_classes(self, vector_layer):
+        """ Burns the polygons of each class, with its position in class_names + 1, in a single raster. """
+        mem_drv = gdal.GetDriverByName('MEM')
+        mem_raster = mem_drv.Create(
+            '',
+            self.base_raster.RasterXSize,
+            self.base_raster.RasterYSize,
+            1,
+            gdal.GDT_Int32
+        )
+        mem_raster.SetProjection(self.base_raster.GetProjection())
+        mem_raster.SetGeoTransform(self.base_raster.GetGeoTransform())
+        mem_raster.GetRasterBand(1).Fill(self.no_data)
 
         for lid, label in enumerate(self.class_names):
-            if self.classes_interest is None:
-                value = self.class_names.index(label) + 1
-            else:
-                if utilfuncs.nested_list_contains(self.classes_interest, label):
-                    value = self.__get_pixel_value(self.classes_interest, label)
-                else:
-                    value = self.__get_pixel_value(self.classes_interest, self.non_class)
-
             vector_layer.SetAttributeFilter("%s='%s'" % (str(self.class_column), str(label)))
-            limg = self.rasterize_label(vector_layer)
-            self.labeled_raster[limg == 1] = value
+            err = gdal.RasterizeLayer(mem_raster, [1], vector_layer, None, None, [lid + 1], options=['ALL_TOUCHED'])
+            assert(err == gdal.CE_None)
+        return mem_raster.ReadAsArray()
+
+    def rasterize_layer(self):
+        vector_ds = ogr.Open(self.vector_path)
+        vector_layer = vector_ds.GetLayer()
+        class_ids = self.rasterize_classes(vector_layer)
+        lut = dsutils.grouping_lut(self.class_names, self.classes_interest, self.non_class, self.no_data)
+        self.labeled_raster = np.ma.masked_array(dsutils.remap_values(class_ids, lut).astype(np.int32),
+                                                 mask=class_ids == self.no_data)[:, :, np.newaxis]
 
         # Close DataSource Connection
         vector_ds.Destroy()
@@ -126,14 +134,3 @@ class Rasterizer(object):
         output_band.WriteArray(np.ma.filled(self.labeled_raster[:, :, 0], self.no_data))
         output_band.FlushCache()
         output_ds = None
-
-    def __get_pixel_value(self, nl, target):
-        if target in nl:
-            return nl.index(target) + 1
-
-        for thing in nl:
-            if type(thing) is list:
-                if target in thing:
-                    return nl.index(thing) + 1
-
-        raise ValueError(target + ' is not in classes_of_interest')
@@ -8,12 +8,14 @@ import sys
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 import common.utils as utils
+import networks.shape_inference as shape_inference
 
 
 class SequentialChipGenerator(object):
     mandatory_params = ['raster_array', 'win_size']
     default_params = {'labels_array': None,
-                      'overlap': (0, 0),
+                      'overlap': None,
+                      'network': None,
                       'class_of_interest': None,
                       'perc_discard_nd': None,
                       'no_data': 0}
@@ -24,10 +26,26 @@ class SequentialChipGenerator(object):
         self.labeled_array = params['labels_array']
         self.win_size = params['win_size']
         self.overlap = params['overlap']
+        if self.overlap is None:
+            self.overlap = self.recommended_overlap(params['network'], self.win_size)
         self.class_of_interest = params['class_of_interest']
         self.perc_discard_nd = params['perc_discard_nd']
         self.no_data = params['no_data']
 
+    @staticmethod
+    def recommended_overlap(network, win_size):
+        """ Overlap of the windows for a predefined network (see networks.shape_inference): the border lost by the
+        network, so the outputs of the windows are adjacent. Without a network, the windows do not overlap.
+
+        Raises:
+            ValueError: If the output of the network is not centered in windows of win_size. The message suggests the
+                nearest valid size.
+        """
+        if network is None:
+            return (0, 0)
+        overlap = shape_inference.tiling(network, win_size)['overlap']
+        return (overlap, overlap)
+
     def compute_indexes(self):
         row_size, col_size, nbands = self.img_array.shape
         if self.labeled_array is not None:
@@ -20,6 +20,83 @@ def split_dataset(dataset, perc_test=30, perc_val=0, random_seed=None):
     return train_images, test_images, valid_images, train_labels, test_labels, valid_labels
 
 
+def split_indexes(indexes, perc_test=30, perc_val=0, random_seed=None):
+    """ Splits an array of chip indexes between train, test and validation, without touching the chips.
+
+    Args:
+        indexes (numpy.ndarray or int): Indexes of the chips, or the number of chips.
+        perc_test (number): Percentage of the chips in the test split.
+        perc_val (number): Percentage of the chips in the validation split.
+        random_seed (int): Seed of the permutation.
+
+    Returns:
+        The arrays of indexes of the train, test and validation splits.
+    """
+    if np.isscalar(indexes):
+        indexes = np.arange(indexes)
+    indexes = np.random.default_rng(random_seed).permutation(indexes)
+    num_test = int(round(len(indexes) * perc_test / 100))
+    num_val = int(round(len(indexes) * perc_val / 100))
+    num_train = len(indexes) - num_test - num_val
+    return indexes[:num_train], indexes[num_train:(num_train + num_test)], indexes[(num_train + num_test):]
+
+
+def chip_block_ids(coords, block_size, scenes=None):
+    """ Assigns each chip to a spatial block of a regular grid, according to its whole window.
+
+    A chip which crosses the border between blocks shares pixels with the chips of the blocks it touches, so it gets
+    the block -1, and is left out of the splits and folds. Thus chips of different blocks never share pixels.
+
+    Args:
+        coords (list): Windows of the chips, as returned by the chips generators.
+        block_size (int): Size of the blocks, in pixels.
+        scenes (numpy.ndarray): Optional scene of each chip. Chips of different scenes are never in the same block.
+
+    Returns:
+        An array with the block of each chip, numbered from 0, or -1 for the chips crossing blocks.
+    """
+    def window_edge(key):
+        return np.fromiter((coord[key] for coord in coords), dtype=np.int64, count=len(coords))
+
+    first_rows = window_edge('upper_row') // block_size
+    first_cols = window_edge('left_col') // block_size
+    # The lower row and the right column are exclusive.
+    last_rows = (window_edge('lower_row') - 1) // block_size
+    last_cols = (window_edge('right_col') - 1) // block_size
+    inside = (first_rows == last_rows) & (first_cols == last_cols)
+
+    if scenes is None:
+        scenes = np.zeros(len(coords), dtype=np.int64)
+    keys = np.stack([np.asarray(scenes, dtype=np.int64), first_rows, first_cols], axis=-1)
+    block_ids = np.full(len(coords), -1, dtype=np.int64)
+    if np.any(inside):
+        block_ids[inside] = np.unique(keys[inside], axis=0, return_inverse=True)[1].reshape(-1)
+    return block_ids
+
+
+def block_split(block_ids, proportions, random_seed=None):
+    """ Assigns whole blocks of chips to groups (splits or folds), so chips of the same block are never separated.
+
+    The blocks are shuffled and laid in sequence, and each block goes to the group whose share of the chips contains
+    the middle of the block, so each group gets approximately its proportion of the chips.
+
+    Args:
+        block_ids (numpy.ndarray): Block of each chip.
+        proportions (list): Proportion of the chips in each group.
+        random_seed (int): Seed of the blocks shuffling.
+
+    Returns:
+        An array with the group of each chip.
+    """
+    blocks, chip_blocks, block_sizes = np.unique(block_ids, return_inverse=True, return_counts=True)
+    order = np.random.default_rng(random_seed).permutation(len(blocks))
+    middle_fraction = (np.cumsum(block_sizes[order]) - block_sizes[order] / 2) / len(block_ids)
+    bounds = np.cumsum(proportions, dtype=np.float64)[:-1] / np.sum(proportions)
+    block_groups = np.empty(len(blocks), dtype=np.int64)
+    block_groups[order] = np.searchsorted(bounds, middle_fraction, side='right')
+    return block_groups[chip_blocks.reshape(-1)]
+
+
 def crop_np_chip(chip, out_size):
     feat_shape = chip.shape
     offsets = [int((int(feat_shape[0]) - int(out_size)) / 2),
@@ -36,3 +113,52 @@ def crop_np_batch(batch, out_size):
                int((int(feat_shape[2]) - int(out_size)) / 2)]
     batch = batch[:, offsets[0]:(offsets[0] + out_size), offsets[1]:(offsets[1] + out_size), :]
     return batch
+
+
+def class_values(class_names, classes_interest=None, non_class_name='non_class'):
+    """ Gets the value of each class in the labeled raster. Without classes_interest, the value of a class is its
+    position in class_names + 1. Otherwise, it is the position + 1 of the class (or of the list grouping it) in
+    classes_interest, and the classes out of classes_interest get the value of non_class_name.
+
+    Returns:
+        A dict with the value of each class name.
+    """
+    if classes_interest is None:
+        return {name: pos + 1 for pos, name in enumerate(class_names)}
+    group_values = {name: pos + 1 for pos, name in reversed(list(enumerate(classes_interest)))
+                    if not isinstance(name, list)}
+    for pos, group in enumerate(classes_interest):
+        if isinstance(group, list):
+            for name in group:
+                group_values.setdefault(name, pos + 1)
+    if non_class_name not in group_values:
+        raise ValueError(non_class_name + ' is not in classes_of_interest')
+    return {name: group_values.get(name, group_values[non_class_name]) for name in class_names}
+
+
+def grouping_lut(class_names, classes_interest=None, non_class_name='non_class', no_data=0):
+    """ Builds the lookup table from the class ids (position in class_names + 1, no_data at 0) to the values of
+    class_values, for remap_values.
+    """
+    values = class_values(class_names, classes_interest, non_class_name)
+    return np.array([no_data] + [values[name] for name in class_names])
+
+
+def remap_values(data, lut):
+    """ Rounds the values of data to the nearest integer (x.5 goes down), clips them to the range of the lookup table
+    and remaps them, in one vectorized pass.
+
+    Args:
+        data (array): Class ids, or continuous values (e.g. the output of a regression).
+        lut (array): New value of each class id.
+    """
+    data = np.asarray(data)
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.ceil(data - 0.5)
+    lut = np.asarray(lut)
+    return lut[np.clip(data, 0, len(lut) - 1).astype(np.int64)]
+
+
+def discretize_values(data, number_class, start_value=0):
+    """ Rounds the values of data to the classes start_value, ..., number_class. """
+    return remap_values(data, np.maximum(np.arange(number_class + 1), start_value)).astype(np.uint8)
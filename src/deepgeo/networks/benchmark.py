@@ -0,0 +1,107 @@
+import csv
+import sys
+import time
+from os import path
+import tensorflow as tf
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+import networks.keras_models as keras_models
+import networks.precision as prec
+
+
+def benchmark_network(network, params, precision='float32', xla=False, batch_size=8, steps=20, warmup=3):
+    """ Measures the training throughput of the Keras version of a network, on synthetic data.
+
+    Args:
+        network (str): Name of the network (see keras_models.predefModels).
+        params (dict): Parameters of the model. They must define the input shape (shape, or chip_size and bands) and
+            num_classes.
+        precision (str): float32, mixed_float16 or mixed_bfloat16.
+        xla (bool): If the training step is compiled with XLA.
+        batch_size (int): Number of chips per step.
+        steps (int): Number of measured steps.
+        warmup (int): Number of steps run before the measure, including the tracing and the compilation.
+
+    Returns:
+        A dict with the network, the options, the warmup time, the mean step time and the examples per second.
+    """
+    prec.set_policy(precision)
+    try:
+        model = keras_models.build_model(network, dict(params))
+        input_shape = [batch_size] + list(model.input_shape[1:])
+        output_shape = [batch_size] + list(model.output_shape[1:3])
+        images = tf.random.uniform(input_shape, dtype=tf.float32)
+        labels = tf.random.uniform(output_shape, maxval=params['num_classes'], dtype=tf.int32)
+        optimizer = prec.loss_scale_optimizer(tf.keras.optimizers.Adam(), precision)
+
+        @tf.function(jit_compile=xla)
+        def train_step(images, labels):
+            with tf.GradientTape() as tape:
+                logits = tf.cast(model(images, training=True), tf.float32)
+                loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits))
+                scaled_loss = prec.scaled_loss(optimizer, loss)
+            gradients = prec.unscaled_gradients(optimizer, tape.gradient(scaled_loss, model.trainable_variables))
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+
+        start = time.perf_counter()
+        for _ in range(warmup):
+            train_step(images, labels).numpy()
+        warmup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            loss = train_step(images, labels)
+        loss.numpy()
+        step_time = (time.perf_counter() - start) / steps
+    finally:
+        prec.set_policy('float32')
+
+    return {'network': network,
+            'precision': precision,
+            'xla': xla,
+            'batch_size': batch_size,
+            'warmup_time': warmup_time,
+            'step_time': step_time,
+            'examples_per_sec': batch_size / step_time}
+
+
+def benchmark_networks(networks, params, precisions=None, xla_options=(False, True), out_path=None, **kwargs):
+    """ Benchmarks the networks with every combination of precision and XLA.
+
+    The speedup of each run is relative to the float32 run without XLA of the same network.
+
+    Args:
+        networks (list): Names of the networks.
+        params (dict): Parameters of the models.
+        precisions (list): Precisions to test. Default: all the policies in networks.precision.
+        xla_options (list): XLA options to test.
+        out_path (str): Optional CSV file for the results.
+        **kwargs: Other arguments of benchmark_network (batch_size, steps, warmup).
+
+    Returns:
+        The list of results of benchmark_network, with the speedup.
+    """
+    if precisions is None:
+        precisions = prec.policies
+    results = []
+    for network in networks:
+        network_results = []
+        for precision in precisions:
+            for xla in xla_options:
+                result = benchmark_network(network, params, precision=precision, xla=xla, **kwargs)
+                print(network, '- precision:', precision, '- xla:', xla, '-',
+                      round(result['examples_per_sec'], 2), 'examples/s')
+                network_results.append(result)
+
+        baseline = [res for res in network_results if res['precision'] == 'float32' and not res['xla']]
+        for result in network_results:
+            result['speedup'] = result['examples_per_sec'] / baseline[0]['examples_per_sec'] if baseline else None
+        results += network_results
+
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()), delimiter=';')
+            writer.writeheader()
+            writer.writerows(results)
+    return results
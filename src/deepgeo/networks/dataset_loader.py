@@ -1,3 +1,4 @@
+import math
 import tensorflow as tf
 import numpy as np
 
@@ -38,6 +39,39 @@ def _flip_transpose(image, label):
     return image, label
 
 
+# Test-time augmentation operations: the transformation of a batch of images (NHWC), and its inverse, applied to the
+# predictions. The rotations need square chips, and the inverses need outputs centered in the chips (see
+# networks.shape_inference.valid_chip_sizes), otherwise the variants are shifted from each other.
+tta_operations = {'rot90': (lambda batch: tf.image.rot90(batch, 1), lambda batch: tf.image.rot90(batch, 3)),
+                  'rot180': (lambda batch: tf.image.rot90(batch, 2), lambda batch: tf.image.rot90(batch, 2)),
+                  'rot270': (lambda batch: tf.image.rot90(batch, 3), lambda batch: tf.image.rot90(batch, 1)),
+                  'flip_left_right': (tf.image.flip_left_right, tf.image.flip_left_right),
+                  'flip_up_down': (tf.image.flip_up_down, tf.image.flip_up_down),
+                  'flip_transpose': (tf.image.transpose, tf.image.transpose)}
+
+
+def tta_batch(images, tta_ops):
+    """ Stacks the images and their transformations by each operation in tta_ops along the batch dimension, so all
+    the variants are predicted in a single forward pass.
+    """
+    return tf.concat([images] + [tta_operations[op][0](images) for op in tta_ops], axis=0)
+
+
+def tta_merge(predictions, tta_ops):
+    """ Inverts the transformations of the predictions of a batch built by tta_batch, and averages the variants. """
+    variants = tf.split(predictions, len(tta_ops) + 1, axis=0)
+    inverted = [variants[0]] + [tta_operations[op][1](variant) for op, variant in zip(tta_ops, variants[1:])]
+    return tf.add_n(inverted) / float(len(inverted))
+
+
+def remap_labels(label, lut):
+    """ Remaps the class ids of a label tensor with a lookup table (see dataset.utils.remap_values), clipping the ids
+    to the range of the table.
+    """
+    lut = tf.constant(lut, dtype=label.dtype)
+    return tf.gather(lut, tf.clip_by_value(label, 0, tf.shape(lut, out_type=label.dtype)[0] - 1))
+
+
 class DatasetLoader(object):
     data_aug_operations = {'rot90': _rot90,
                            'rot180': _rot180,
@@ -100,19 +134,28 @@ class DatasetLoader(object):
 
         label = tf.io.decode_raw(parsed_features['label'], tf.int32)
         label = tf.reshape(label, shape_lbl)
+        if self.params.get('labels_lut') is not None:
+            label = remap_labels(label, self.params['labels_lut'])
         return image, label
 
-    def tfrecord_input_fn(self, train=True):
-        if isinstance(self.dataset, list):
-            dataset = tf.data.Dataset.from_tensor_slices(self.dataset)
-            dataset = dataset.interleave(lambda x : tf.data.TFRecordDataset(self.dataset),
-                                             cycle_length=1,
-                                             # block_length=16,
-                                             num_parallel_calls=tf.data.experimental.AUTOTUNE)
-            train_input = dataset.map(self._parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        else:
-            dataset = tf.data.TFRecordDataset(self.dataset)
-            train_input = dataset.map(self._parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    def tfrecord_input_fn(self, train=True, input_context=None):
+        """ Builds the input pipeline of the TFRecord dataset.
+
+        When training with several workers, the estimator gives an input_context, and each worker reads only its shard
+        of the dataset: whole files if there are enough files for all workers, or every n-th record otherwise.
+        """
+        files = self.dataset if isinstance(self.dataset, list) else [self.dataset]
+        num_shards = 1 if input_context is None else input_context.num_input_pipelines
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+        if num_shards > 1 and len(files) >= num_shards:
+            dataset = dataset.shard(num_shards, input_context.input_pipeline_id)
+        dataset = dataset.interleave(lambda x: tf.data.TFRecordDataset(x),
+                                     cycle_length=1,
+                                     # block_length=16,
+                                     num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if num_shards > 1 and len(files) < num_shards:
+            dataset = dataset.shard(num_shards, input_context.input_pipeline_id)
+        train_input = dataset.map(self._parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
         if train:
             aug_datasets = []
             if 'data_aug_per_chip' in self.params:
@@ -129,10 +172,11 @@ class DatasetLoader(object):
             for ds in aug_datasets:
                 train_input = train_input.concatenate(ds)
 
+            shuffle_size = math.ceil(self.params['number_of_chips'] / num_shards)
             if len(data_aug_ops) > 0:
-                train_input = train_input.shuffle(self.params['number_of_chips'] * len(data_aug_ops))
+                train_input = train_input.shuffle(shuffle_size * len(data_aug_ops))
             else:
-                train_input = train_input.shuffle(self.params['number_of_chips'])
+                train_input = train_input.shuffle(shuffle_size)
             train_input = train_input.repeat(self.params['epochs'])
         else:
             train_input.repeat(1)  # TODO: Try to do without this. Check if the batch size is the reason for going only to 40
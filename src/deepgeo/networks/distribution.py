@@ -0,0 +1,107 @@
+import json
+import math
+import os
+import tensorflow as tf
+
+
+def _mirrored_strategy(params):
+    return tf.distribute.MirroredStrategy(devices=params['devices'])
+
+
+def _multi_worker_mirrored_strategy(params):
+    return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+
+def _parameter_server_strategy(params):
+    return tf.compat.v1.distribute.experimental.ParameterServerStrategy()
+
+
+def _one_device_strategy(params):
+    device = params['devices'][0] if params['devices'] else '/cpu:0'
+    return tf.distribute.OneDeviceStrategy(device=device)
+
+
+strategies = {'mirrored': _mirrored_strategy,
+              'multi_worker_mirrored': _multi_worker_mirrored_strategy,
+              'parameter_server': _parameter_server_strategy,
+              'one_device': _one_device_strategy}
+
+learning_rate_scalings = {'linear': lambda num_replicas: num_replicas,
+                          'sqrt': lambda num_replicas: math.sqrt(num_replicas)}
+
+
+def local_cluster_config(num_workers, task_index, task_type='worker', num_ps=0, base_port=12345):
+    """ Builds a TF_CONFIG for a cluster of processes on the local host, e.g. to test multi-worker training.
+
+    Args:
+        num_workers (int): Number of workers. With parameter servers, the first worker is the chief.
+        task_index (int): Index of the task of this process.
+        task_type (str): Type of the task of this process: 'worker', 'chief' or 'ps'.
+        num_ps (int): Number of parameter servers.
+        base_port (int): First port of the cluster. Each task uses the next one.
+
+    Returns:
+        The TF_CONFIG, as a dict.
+    """
+    ports = iter(range(base_port, base_port + num_workers + num_ps))
+    cluster = {}
+    if num_ps > 0:
+        cluster['chief'] = ['localhost:' + str(next(ports))]
+        num_workers -= 1
+    if num_workers > 0:
+        cluster['worker'] = ['localhost:' + str(next(ports)) for _ in range(num_workers)]
+    if num_ps > 0:
+        cluster['ps'] = ['localhost:' + str(next(ports)) for _ in range(num_ps)]
+    return {'cluster': cluster, 'task': {'type': task_type, 'index': task_index}}
+
+
+def get_tf_config():
+    return json.loads(os.environ.get('TF_CONFIG', '{}'))
+
+
+def set_tf_config(tf_config):
+    if isinstance(tf_config, dict):
+        tf_config = json.dumps(tf_config)
+    os.environ['TF_CONFIG'] = tf_config
+
+
+def num_workers(tf_config=None):
+    """ Gets the number of workers (chief included) of the cluster in TF_CONFIG, or 1 without a cluster. """
+    if tf_config is None:
+        tf_config = get_tf_config()
+    cluster = tf_config.get('cluster', {})
+    return max(1, len(cluster.get('worker', [])) + len(cluster.get('chief', [])))
+
+
+def make_strategy(params):
+    """ Creates the distribution strategy selected in params['distribution'].
+
+    If params['tf_config'] is given, it is exported as TF_CONFIG before the strategy is created, so the cluster
+    specification can also come from the parameters.
+    """
+    if params['tf_config'] is not None:
+        set_tf_config(params['tf_config'])
+    return strategies[params['distribution']](params)
+
+
+def global_replicas(strategy, params):
+    """ Gets the number of batches processed per training step across the cluster.
+
+    With parameter servers, each worker runs its own steps, so the replicas of all workers are counted.
+    """
+    if params['distribution'] == 'parameter_server':
+        return strategy.num_replicas_in_sync * num_workers()
+    return strategy.num_replicas_in_sync
+
+
+def scale_learning_rate(learning_rate, num_replicas, scaling=None):
+    """ Scales the learning rate to the global batch size (batch_size * num_replicas).
+
+    Args:
+        learning_rate (float): Learning rate for one replica.
+        num_replicas (int): Number of replicas training in sync.
+        scaling (str): None (no scaling), 'linear' or 'sqrt'.
+    """
+    if scaling is None:
+        return learning_rate
+    return learning_rate * learning_rate_scalings[scaling](num_replicas)
@@ -0,0 +1,145 @@
+import glob
+import os
+import shutil
+import sys
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+import common.filesystem as fs
+import common.utils as utils
+
+# Direction of improvement of the evaluation metrics.
+metric_modes = {'loss': 'min',
+                'eval_metrics/cross_entropy': 'min',
+                'eval_metrics/accuracy': 'max',
+                'eval_metrics/auc_roc': 'max'}
+
+
+def _is_improvement(value, best, mode, min_delta):
+    if best is None:
+        return True
+    if mode == 'min':
+        return value < best - min_delta
+    return value > best + min_delta
+
+
+class EarlyStopping(object):
+    """ Tracks an evaluation metric, and tells when it stopped improving.
+
+    Args:
+        metric (str): Name of the metric, as in the evaluation results (e.g. loss, eval_metrics/accuracy).
+        patience (int): Number of evaluations without improvement before stopping.
+        min_delta (float): Minimum change of the metric to be considered an improvement.
+        mode (str): 'min' or 'max'. Default: the mode in metric_modes.
+    """
+    def __init__(self, metric='loss', patience=5, min_delta=0., mode=None):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.mode = mode if mode is not None else metric_modes[metric]
+        self.best = None
+        self.best_step = None
+        self.evaluations_without_improvement = 0
+
+    def update(self, value, step=None):
+        """ Adds the result of an evaluation. Returns True if it improved the best value. """
+        if _is_improvement(value, self.best, self.mode, self.min_delta):
+            self.best = value
+            self.best_step = step
+            self.evaluations_without_improvement = 0
+            return True
+        self.evaluations_without_improvement += 1
+        return False
+
+    def should_stop(self):
+        return self.evaluations_without_improvement >= self.patience
+
+
+def make_early_stopping_hook(estimator, tracker, run_every_secs=60):
+    """ Creates a training hook which stops the estimator when the tracked metric stops improving.
+
+    The hook reads the results of the evaluations already run by train_and_evaluate (the event files in the eval
+    directory), so no extra evaluation is run.
+    """
+    eval_dir = estimator.eval_dir()
+    seen_steps = set()
+
+    def should_stop_fn():
+        for step, metrics in tf.estimator.experimental.read_eval_metrics(eval_dir).items():
+            if step not in seen_steps and tracker.metric in metrics:
+                seen_steps.add(step)
+                tracker.update(metrics[tracker.metric], step)
+        if tracker.should_stop():
+            print('Early stopping: ', tracker.metric, ' did not improve for ', tracker.patience,
+                  ' evaluations. Best: ', tracker.best, ' at step ', tracker.best_step)
+            return True
+        return False
+
+    return tf.estimator.experimental.make_early_stopping_hook(estimator, should_stop_fn,
+                                                              run_every_secs=run_every_secs)
+
+
+class BestCheckpoints(object):
+    """ Keeps on disk only the top-k checkpoints according to an evaluation metric.
+
+    The selected checkpoints are copied to out_dir, and best_checkpoints.csv lists them with their metric values.
+    With it, the training keeps only the two latest checkpoints in the model directory, so the disk is bounded.
+
+    Args:
+        out_dir (str): Directory of the best checkpoints (e.g. <model_dir>/best).
+        metric (str): Name of the metric.
+        keep (int): Number of checkpoints kept.
+        mode (str): 'min' or 'max'. Default: the mode in metric_modes.
+    """
+    def __init__(self, out_dir, metric='loss', keep=3, mode=None):
+        self.out_dir = out_dir
+        self.metric = metric
+        self.keep = keep
+        self.mode = mode if mode is not None else metric_modes[metric]
+        self.checkpoints = []
+
+    def add(self, checkpoint_path, value, step):
+        """ Offers a checkpoint. It is copied only if it is among the best ones, and the worst one is removed.
+
+        Returns:
+            True if the checkpoint was kept.
+        """
+        candidates = sorted(self.checkpoints + [(value, step, checkpoint_path)], key=lambda ckpt: ckpt[0],
+                            reverse=self.mode == 'max')
+        if (value, step, checkpoint_path) not in candidates[:self.keep]:
+            return False
+
+        fs.mkdir(self.out_dir)
+        for file_path in glob.glob(checkpoint_path + '.*'):
+            shutil.copy(file_path, self.out_dir)
+        for _, _, removed_path in candidates[self.keep:]:
+            for file_path in glob.glob(os.path.join(self.out_dir, os.path.basename(removed_path) + '.*')):
+                os.remove(file_path)
+        self.checkpoints = candidates[:self.keep]
+
+        best_path = os.path.join(self.out_dir, os.path.basename(self.checkpoints[0][2]))
+        with open(os.path.join(self.out_dir, 'checkpoint'), 'w') as f:
+            f.write('model_checkpoint_path: "' + best_path + '"\n')
+        utils.save_dict_2_csv({os.path.basename(ckpt[2]): ckpt[0] for ckpt in self.checkpoints},
+                              os.path.join(self.out_dir, 'best_checkpoints.csv'))
+        return True
+
+
+class BestCheckpointExporter(tf.estimator.Exporter):
+    """ Estimator exporter which keeps the top-k checkpoints, using the results of the evaluations it receives from
+    train_and_evaluate.
+    """
+    def __init__(self, best_checkpoints, name='best_checkpoints'):
+        self.best_checkpoints = best_checkpoints
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+    def export(self, estimator, export_path, checkpoint_path, eval_result, is_the_final_export):
+        if self.best_checkpoints.metric not in eval_result:
+            return None
+        self.best_checkpoints.add(checkpoint_path, eval_result[self.best_checkpoints.metric],
+                                  eval_result['global_step'])
+        return self.best_checkpoints.out_dir
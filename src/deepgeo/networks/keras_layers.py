@@ -0,0 +1,85 @@
+import tensorflow as tf
+
+# Keras versions of the layers in networks.layers. Each Keras layer is named after the variable scope of its
+# tf.compat.v1.layers counterpart, with '/' replaced by '.', so checkpoints of the estimator models can be loaded by
+# the Keras models (see keras_models.load_estimator_checkpoint).
+
+
+def scoped_name(scope, name):
+    return scope + '.' + name
+
+
+def conv_pool_layer(bottom, filters, params, kernel_size=3, name='', pool=True, pad='same'):
+    scope = 'Conv_layer_{}'.format(name)
+    conv = tf.keras.layers.Conv2D(filters=filters,
+                                  kernel_size=kernel_size,
+                                  padding=pad,
+                                  data_format='channels_last',
+                                  activation=None,
+                                  kernel_regularizer=tf.keras.regularizers.L2(params['l2_reg_rate']),
+                                  kernel_initializer=tf.keras.initializers.GlorotUniform(),
+                                  name=scoped_name(scope, 'convolution_{}'.format(name)))(bottom)
+    norm = tf.keras.layers.BatchNormalization(name=scoped_name(scope, 'batch_norm_{}'.format(name)))(conv)
+    relu = tf.keras.layers.ReLU(name=scoped_name(scope, 'relu_{}'.format(name)))(norm)
+
+    if pool:
+        pooling = tf.keras.layers.MaxPooling2D(2, strides=2, padding=pad,
+                                               name=scoped_name(scope, 'pool_{}'.format(name)))(relu)
+        return relu, pooling
+    else:
+        return relu
+
+
+def crop_features(features, out_size, name=''):
+    height, width = int(features.shape[1]), int(features.shape[2])
+    top = int((height - int(out_size)) / 2)
+    left = int((width - int(out_size)) / 2)
+    cropping = ((top, height - int(out_size) - top), (left, width - int(out_size) - left))
+    return tf.keras.layers.Cropping2D(cropping, name='crop_{}'.format(name))(features)
+
+
+def up_conv_layer(bottom, num_filters, kernel_size, strides, params, batch_norm=False, out_size=None, name='',
+                  pad='valid'):
+    scope = 'UP_Conv_Layer_{}'.format(name)
+    up_conv = tf.keras.layers.Conv2DTranspose(filters=num_filters,
+                                              kernel_size=kernel_size,
+                                              strides=strides,
+                                              activation=None,
+                                              padding=pad,
+                                              kernel_regularizer=tf.keras.regularizers.L2(params['l2_reg_rate']),
+                                              kernel_initializer=tf.keras.initializers.GlorotUniform(),
+                                              name=scoped_name(scope, 'upconv{}'.format(name)))(bottom)
+
+    if batch_norm:
+        up_conv = tf.keras.layers.BatchNormalization(name=scoped_name(scope, 'batch_norm_{}'.format(name)))(up_conv)
+        up_conv = tf.keras.layers.ReLU(name=scoped_name(scope, 'relu_{}'.format(name)))(up_conv)
+
+    if out_size is not None and up_conv.shape[1] != out_size:
+        up_conv = crop_features(up_conv, out_size, name=name)
+
+    return up_conv
+
+
+def up_conv_add_layer(bottom, concat, params, kernel_size=4, num_filters=2, strides=2, pad='valid', name=''):
+    upconv = up_conv_layer(bottom, num_filters, kernel_size, strides, params, name=name, pad=pad)
+
+    scope = 'Score_concat{}'.format(name)
+    out_size = concat.shape[1]
+    if upconv.shape[1] != out_size:
+        upconv = crop_features(upconv, out_size, name=name)
+
+    score_pool = tf.keras.layers.Conv2D(filters=num_filters,
+                                        kernel_size=1,
+                                        padding=pad,
+                                        data_format='channels_last',
+                                        activation=None,
+                                        kernel_initializer=tf.keras.initializers.GlorotUniform(),
+                                        name=scoped_name(scope, 'score_layer'))(concat)
+
+    return tf.keras.layers.Add(name='add_{}'.format(name))([upconv, score_pool])
+
+
+def upconv_concat_layer(bottom, concat, params, kernel_size=4, num_filters=2, strides=2, pad='valid', name=''):
+    upconv = up_conv_layer(bottom, num_filters, kernel_size, strides, params, batch_norm=True, name=name, pad=pad)
+    cropped = crop_features(concat, upconv.shape[1], name=name)
+    return tf.keras.layers.Concatenate(axis=-1, name='concat_{}'.format(name))([upconv, cropped])
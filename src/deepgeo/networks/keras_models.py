@@ -0,0 +1,271 @@
+import sys
+from os import path
+import tensorflow as tf
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..'))
+import networks.keras_layers as klayers
+
+
+def _input_shape(params):
+    if 'shape' in params:
+        return params['shape']
+    return [params['chip_size'], params['chip_size'], params['bands']]
+
+
+def vgg16_encoder(samples, params):
+    features = {}
+    conv1_1 = klayers.conv_pool_layer(bottom=samples, filters=64, params=params, name='1_1', pool=False)
+    features['conv1_2'], features['pool1'] = klayers.conv_pool_layer(bottom=conv1_1, filters=64, params=params,
+                                                                     name='1_2')
+
+    conv2_1 = klayers.conv_pool_layer(bottom=features['pool1'], filters=128, params=params, name='2_1', pool=False)
+    features['conv2_2'], features['pool2'] = klayers.conv_pool_layer(bottom=conv2_1, filters=128, params=params,
+                                                                     name='2_2')
+
+    conv3_1 = klayers.conv_pool_layer(bottom=features['pool2'], filters=256, params=params, name='3_1', pool=False)
+    conv3_2 = klayers.conv_pool_layer(bottom=conv3_1, filters=256, params=params, name='3_2', pool=False)
+    features['conv3_3'], features['pool3'] = klayers.conv_pool_layer(bottom=conv3_2, filters=256, params=params,
+                                                                     name='3_3')
+
+    conv4_1 = klayers.conv_pool_layer(bottom=features['pool3'], filters=512, params=params, name='4_1', pool=False)
+    conv4_2 = klayers.conv_pool_layer(bottom=conv4_1, filters=512, params=params, name='4_2', pool=False)
+    features['conv4_3'], features['pool4'] = klayers.conv_pool_layer(bottom=conv4_2, filters=512, params=params,
+                                                                     name='4_3')
+
+    conv5_1 = klayers.conv_pool_layer(bottom=features['pool4'], filters=512, params=params, name='5_1', pool=False)
+    conv5_2 = klayers.conv_pool_layer(bottom=conv5_1, filters=512, params=params, name='5_2', pool=False)
+    features['conv5_3'], features['pool5'] = klayers.conv_pool_layer(bottom=conv5_2, filters=512, params=params,
+                                                                     name='5_3')
+    return features
+
+
+def fcn_model(params, skips, final_kernel, final_strides, name, score_name='Score_Layer_FC_2', score_pad='valid',
+              final_name='final', final_skip=None):
+    """ Builds a FCN network (VGG16 base), as in networks.fcn8s and the other FCN descriptions.
+
+    Args:
+        params (dict): Parameters of the model.
+        skips (list): Features of the encoder added to the scores, from the deepest one, e.g. ['pool4', 'pool3'].
+        final_kernel (int): Kernel size of the last up-convolution.
+        final_strides (int): Strides of the last up-convolution.
+        name (str): Name of the model.
+        score_name (str): Name of the score layer.
+        score_pad (str): Padding of the score layer.
+        final_name (str): Name of the last up-convolution.
+        final_skip (str): If given, the last up-convolution also adds this feature of the encoder (FCN1s).
+    """
+    num_classes = params['num_classes']
+    shape = _input_shape(params)
+    samples = tf.keras.Input(shape=shape, name='samples')
+    features = vgg16_encoder(samples, params)
+
+    fconv6 = klayers.conv_pool_layer(bottom=features['pool5'], filters=4096, kernel_size=7, params=params,
+                                     name='fc6', pool=False)
+    fconv6 = tf.keras.layers.Dropout(params['dropout_rate'], name='drop_6')(fconv6)
+    fconv7 = klayers.conv_pool_layer(bottom=fconv6, filters=4096, kernel_size=1, params=params, name='fc7',
+                                     pool=False)
+    fconv7 = tf.keras.layers.Dropout(params['dropout_rate'], name='drop_7')(fconv7)
+
+    score = tf.keras.layers.Conv2D(filters=num_classes, kernel_size=1, padding=score_pad, data_format='channels_last',
+                                   activation=None, name=score_name)(fconv7)
+    if len(skips) > 0:
+        score = tf.keras.layers.Dropout(params['dropout_rate'], name='drop_8')(score)
+
+    for pos, skip in enumerate(skips):
+        score = klayers.up_conv_add_layer(score, features[skip], params=params, kernel_size=4,
+                                          num_filters=num_classes, strides=2, pad='same', name=str(pos + 1))
+
+    if final_skip is None:
+        logits = klayers.up_conv_layer(score, num_filters=num_classes, kernel_size=final_kernel, strides=final_strides,
+                                       params=params, out_size=shape[0], pad='same', name=final_name)
+    else:
+        logits = klayers.up_conv_add_layer(score, features[final_skip], params=params, kernel_size=final_kernel,
+                                           num_filters=num_classes, strides=final_strides, pad='same',
+                                           name=final_name)
+    return tf.keras.Model(inputs=samples, outputs=logits, name=name)
+
+
+def fcn1s_model(params):
+    return fcn_model(params, ['conv5_3', 'conv4_3', 'conv3_3', 'conv2_2'], 4, 2, 'fcn1s', final_skip='conv1_2')
+
+
+def fcn2s_model(params):
+    return fcn_model(params, ['pool4', 'pool3', 'pool2', 'pool1'], 8, 2, 'fcn2s')
+
+
+def fcn4s_model(params):
+    return fcn_model(params, ['pool4', 'pool3', 'pool2'], 8, 4, 'fcn4s')
+
+
+def fcn8s_model(params):
+    return fcn_model(params, ['pool4', 'pool3'], 8, 8, 'fcn8s')
+
+
+def fcn32s_model(params):
+    return fcn_model(params, [], 64, 32, 'fcn32s', score_name='score_layer', score_pad='same', final_name='uc')
+
+
+def unet_encoder(samples, params, name_sufix=''):
+    if params.get('fusion') == 'early':
+        num_channels = round(samples.shape[3] / 2)
+        samples = tf.keras.layers.Conv2D(filters=num_channels, kernel_size=(1, 1), strides=1, padding='valid',
+                                         activation='relu', kernel_initializer=tf.keras.initializers.GlorotUniform(),
+                                         name='time_fusion' + name_sufix)(samples)
+
+    conv_1 = klayers.conv_pool_layer(bottom=samples, filters=64, params=params, name='1_1' + name_sufix, pool=False,
+                                     pad='valid')
+    conv_1_2, pool1 = klayers.conv_pool_layer(bottom=conv_1, filters=64, params=params, name='1_2' + name_sufix,
+                                              pad='valid')
+    conv_2 = klayers.conv_pool_layer(bottom=pool1, filters=128, params=params, name='2_1' + name_sufix, pool=False,
+                                     pad='valid')
+    conv_2_1, pool2 = klayers.conv_pool_layer(bottom=conv_2, filters=128, params=params, name='2_2' + name_sufix,
+                                              pad='valid')
+    conv_3 = klayers.conv_pool_layer(bottom=pool2, filters=256, params=params, name='3_1' + name_sufix, pool=False,
+                                     pad='valid')
+    conv_3_1, pool3 = klayers.conv_pool_layer(bottom=conv_3, filters=256, params=params, name='3_2' + name_sufix,
+                                              pad='valid')
+    conv_4 = klayers.conv_pool_layer(bottom=pool3, filters=512, params=params, name='4_1' + name_sufix, pool=False,
+                                     pad='valid')
+    conv_4_1, pool4 = klayers.conv_pool_layer(bottom=conv_4, filters=512, params=params, name='4_2' + name_sufix,
+                                              pad='valid')
+    conv_5_1 = klayers.conv_pool_layer(bottom=pool4, filters=1024, params=params, name='5_1' + name_sufix,
+                                       pool=False, pad='valid')
+    conv_5_2 = klayers.conv_pool_layer(bottom=conv_5_1, filters=1024, params=params, name='5_2' + name_sufix,
+                                       pool=False, pad='valid')
+
+    return {'conv_1': conv_1_2,
+            'conv_2': conv_2_1,
+            'conv_3': conv_3_1,
+            'conv_4': conv_4_1,
+            'conv_5': conv_5_2}
+
+
+def unet_decoder(features, params):
+    up6 = klayers.upconv_concat_layer(features['conv_5'], features['conv_4'], params, num_filters=512,
+                                      kernel_size=2, strides=2, pad='valid', name='6')
+    conv_6 = klayers.conv_pool_layer(up6, filters=512, params=params, kernel_size=3, pool=False, pad='valid',
+                                     name='6')
+    conv_6_1 = klayers.conv_pool_layer(conv_6, filters=512, params=params, kernel_size=3, pool=False, pad='valid',
+                                       name='6_1')
+
+    up7 = klayers.upconv_concat_layer(conv_6_1, features['conv_3'], params, num_filters=256,
+                                      kernel_size=2, strides=2, pad='valid', name='7')
+    conv_7 = klayers.conv_pool_layer(up7, filters=256, params=params, kernel_size=3, pool=False, pad='valid',
+                                     name='7')
+    conv_7_1 = klayers.conv_pool_layer(conv_7, filters=256, params=params, kernel_size=3, pool=False, pad='valid',
+                                       name='7_1')
+
+    up8 = klayers.upconv_concat_layer(conv_7_1, features['conv_2'], params, num_filters=128,
+                                      kernel_size=2, strides=2, pad='valid', name='8')
+    conv_8 = klayers.conv_pool_layer(up8, filters=128, params=params, kernel_size=3, pool=False, pad='valid',
+                                     name='8')
+    conv_8_1 = klayers.conv_pool_layer(conv_8, filters=128, params=params, kernel_size=3, pool=False, pad='valid',
+                                       name='8_1')
+
+    up9 = klayers.upconv_concat_layer(conv_8_1, features['conv_1'], params, num_filters=64,
+                                      kernel_size=2, strides=2, pad='valid', name='9')
+    conv_9 = klayers.conv_pool_layer(up9, filters=64, params=params, kernel_size=3, pool=False, pad='valid',
+                                     name='9')
+    conv_9_1 = klayers.conv_pool_layer(conv_9, filters=64, params=params, kernel_size=3, pool=False, pad='valid',
+                                       name='9_1')
+    return conv_9_1
+
+
+def _logits_layer(last_conv, params):
+    return tf.keras.layers.Conv2D(params['num_classes'], (1, 1), activation='relu', padding='valid',
+                                  kernel_initializer=tf.keras.initializers.GlorotUniform(), name='logits')(last_conv)
+
+
+def unet_model(params):
+    samples = tf.keras.Input(shape=_input_shape(params), name='samples')
+    encoded_feat = unet_encoder(samples, params)
+    last_conv = unet_decoder(encoded_feat, params)
+    return tf.keras.Model(inputs=samples, outputs=_logits_layer(last_conv, params), name='unet')
+
+
+def _fuse_encoders(convs_t1, convs_t2):
+    encoded_feat = {}
+    for pos, filters in enumerate([64, 128, 256, 512, 1024]):
+        key = 'conv_' + str(pos + 1)
+        concat = tf.keras.layers.Concatenate(axis=-1, name='concat_t' + str(pos + 1))([convs_t1[key], convs_t2[key]])
+        encoded_feat[key] = tf.keras.layers.Conv2D(filters=filters, kernel_size=(1, 1), strides=1, padding='valid',
+                                                   activation='relu',
+                                                   kernel_initializer=tf.keras.initializers.GlorotUniform(),
+                                                   name='conv_fusion_' + str(pos + 1))(concat)
+    return encoded_feat
+
+
+def unet_lf_model(params):
+    samples = tf.keras.Input(shape=_input_shape(params), name='samples')
+    samples_t1 = tf.keras.layers.Lambda(lambda x: x[:, :, :, 0:5], name='samples_t1')(samples)
+    samples_t2 = tf.keras.layers.Lambda(lambda x: x[:, :, :, 5:10], name='samples_t2')(samples)
+    encoded_feat = _fuse_encoders(unet_encoder(samples_t1, params, 't_1'), unet_encoder(samples_t2, params, 't_2'))
+    last_conv = unet_decoder(encoded_feat, params)
+    return tf.keras.Model(inputs=samples, outputs=_logits_layer(last_conv, params), name='unet_lf')
+
+
+def mask_unet_model(params):
+    num_masks = params['num_masks']
+    num_bands = params['bands']
+    samples = tf.keras.Input(shape=_input_shape(params), name='samples')
+    masks = tf.keras.layers.Lambda(lambda x: x[:, :, :, -num_masks:], name='masks')(samples)
+    samples_t1 = tf.keras.layers.Lambda(lambda x: x[:, :, :, 0:int(num_bands / 2)], name='samples_t1')(samples)
+    samples_t2 = tf.keras.layers.Lambda(lambda x: x[:, :, :, int(num_bands / 2):-num_masks],
+                                        name='samples_t2')(samples)
+    encoded_feat = _fuse_encoders(unet_encoder(samples_t1, params, 't_1'), unet_encoder(samples_t2, params, 't_2'))
+    last_conv = unet_decoder(encoded_feat, params)
+
+    cropped_mask = klayers.crop_features(masks, last_conv.shape[1], name='crop_mask')
+    last_conv = tf.keras.layers.Concatenate(axis=-1, name='concat_mask')([last_conv, cropped_mask])
+    return tf.keras.Model(inputs=samples, outputs=_logits_layer(last_conv, params), name='mask_unet')
+
+
+predefModels = {'fcn1s': fcn1s_model,
+                'fcn2s': fcn2s_model,
+                'fcn4s': fcn4s_model,
+                'fcn8s': fcn8s_model,
+                'fcn32s': fcn32s_model,
+                'unet': unet_model,
+                'unet_lf': unet_lf_model,
+                'mask_unet': mask_unet_model}
+
+
+def build_model(network, params):
+    return predefModels[network](params)
+
+
+def is_estimator_checkpoint(checkpoint_path):
+    """ Checks if a checkpoint was written by the estimator (name based) instead of tf.train.Checkpoint. """
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    return '_CHECKPOINTABLE_OBJECT_GRAPH' not in reader.get_variable_to_shape_map()
+
+
+def load_estimator_checkpoint(model, checkpoint_path):
+    """ Loads the weights of an estimator checkpoint into the Keras version of its network.
+
+    The variables of the estimator models are named scope/layer/weight, and the Keras layers are named scope.layer,
+    so each weight is matched by name. The optimizer slots and the global step are ignored.
+
+    Args:
+        model (tf.keras.Model): The Keras model, e.g. from build_model.
+        checkpoint_path (str): A checkpoint file or a model directory (its latest checkpoint is loaded).
+
+    Raises:
+        ValueError: If some weight of the model is not in the checkpoint.
+    """
+    if tf.io.gfile.isdir(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    variables = reader.get_variable_to_shape_map()
+
+    missing = []
+    for layer in model.layers:
+        for weight in layer.weights:
+            weight_name = weight.name.split('/')[-1].split(':')[0]
+            var_name = layer.name.replace('.', '/') + '/' + weight_name
+            if var_name in variables:
+                weight.assign(reader.get_tensor(var_name))
+            else:
+                missing.append(var_name)
+    if len(missing) > 0:
+        raise ValueError('Variables not found in the checkpoint ' + checkpoint_path + ': ' + ', '.join(missing))
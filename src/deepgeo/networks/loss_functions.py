@@ -18,10 +18,13 @@ def twoclass_cost(params):  # TODO: Try to set here the positive class and compu
 # def avg_soft_dice(logits, labels):
 def avg_soft_dice(params):
     with tf.compat.v1.name_scope('cost'):
+        # The dice is computed in float32, even if the network computes in float16.
+        predictions = tf.cast(params['predictions'], tf.float32)
+        labels_1hot = tf.cast(params['labels_1hot'], tf.float32)
         epsilon = tf.constant(1e-6, dtype=tf.float32)
-        intersection = tf.reduce_sum(input_tensor=tf.multiply(params['predictions'], params['labels_1hot']), axis=[1, 2])
+        intersection = tf.reduce_sum(input_tensor=tf.multiply(predictions, labels_1hot), axis=[1, 2])
         numerator = tf.multiply(tf.constant(2., dtype=tf.float32), intersection)
-        denominator = tf.reduce_sum(input_tensor=tf.add(tf.square(params['predictions']), tf.square(params['labels_1hot'])), axis=[1, 2])
+        denominator = tf.reduce_sum(input_tensor=tf.add(tf.square(predictions), tf.square(labels_1hot)), axis=[1, 2])
         dice_mean = tf.reduce_mean(input_tensor=tf.divide(numerator, tf.add(denominator, epsilon)))
         loss = tf.subtract(tf.constant(1., dtype=tf.float32), dice_mean, name='loss')
         return loss
@@ -34,11 +37,14 @@ def avg_generalized_dice(params):
         else:
             class_weights = tf.reshape(params['class_weights']['eval'], (1, params['num_classes']))
 
+        # The dice is computed in float32, even if the network computes in float16.
+        predictions = tf.cast(params['predictions'], tf.float32)
+        labels_1hot = tf.cast(params['labels_1hot'], tf.float32)
         epsilon = tf.constant(1e-6, dtype=tf.float32)
-        intersection = tf.reduce_sum(input_tensor=tf.multiply(params['predictions'], params['labels_1hot']), axis=[1, 2])
+        intersection = tf.reduce_sum(input_tensor=tf.multiply(predictions, labels_1hot), axis=[1, 2])
         weighted_intersection = tf.multiply(intersection, class_weights)
         numerator = tf.multiply(tf.constant(2., dtype=tf.float32), weighted_intersection)
-        denominator = tf.reduce_sum(input_tensor=tf.add(params['predictions'], params['labels_1hot']), axis=[1, 2])
+        denominator = tf.reduce_sum(input_tensor=tf.add(predictions, labels_1hot), axis=[1, 2])
         denominator = tf.multiply(denominator, class_weights)
         dice_mean = tf.reduce_mean(input_tensor=tf.divide(numerator, tf.add(denominator, epsilon)))
         loss = tf.subtract(tf.constant(1., dtype=tf.float32), dice_mean, name='loss')
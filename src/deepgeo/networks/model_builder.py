@@ -4,12 +4,17 @@ import numpy as np
 import tensorflow as tf
 import sys
 import os
+import time
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 import common.filesystem as fs
 import common.quality_metrics as qm
+import common.quantization as quant
+import common.raster_writer as rw
 import common.utils as utils
 import common.visualization as vis
+import dataset.image_utils as iutils
+import dataset.sequential_chips as seqchips
 import dataset.utils as dsutils
 import networks.fcn1s as fcn1s
 import networks.fcn2s as fcn2s
@@ -22,24 +27,16 @@ import networks.loss_functions as lossf
 import networks.tb_metrics as tbm
 import networks.layers as layers
 import networks.dataset_loader as dsloader
+import networks.distribution as distribution
+import networks.early_stopping as early_stopping
+import networks.keras_models as keras_models
+import networks.precision as prec
+import networks.profiling as profiling
 import networks.mask_unet as mask_unet
+import networks.optimizers as optim
+import networks.shape_inference as shape_inference
 
 
-# TODO: Remove this
-def discretize_values(data, number_class, start_value=0):
-    for clazz in range(start_value, (number_class + 1)):
-        if clazz == start_value:
-            class_filter = (data <= clazz + 0.5)
-        elif clazz == number_class:
-            class_filter = (data > clazz - 0.5)
-        else:
-            class_filter = np.logical_and(data > clazz - 0.5, data <= clazz + 0.5)
-        data[class_filter] = clazz
-
-    return data.astype(np.uint8)
-
-
-# TODO: Implement in the ModelBuilder a function that computes the output size.
 class ModelBuilder(object):
     default_params = {
         'epochs': None,
@@ -54,7 +51,34 @@ class ModelBuilder(object):
         'chips_tensorboard': 2,
         'fusion': 'none',
         'loss_func': 'crossentropy',
-        'bands_plot': [0, 1, 2]
+        'bands_plot': [0, 1, 2],
+        'distribution': 'mirrored',
+        'devices': None,
+        'tf_config': None,
+        'lr_scaling': None,
+        'backend': 'estimator',
+        'xla': False,
+        'precision': 'float32',
+        'profiling': False,
+        'profile_steps': None,
+        'summaries': 'scalars',
+        'summary_steps': 100,
+        'early_stopping': False,
+        'es_metric': 'loss',
+        'es_patience': 5,
+        'es_min_delta': 0.,
+        'keep_best': None,
+        'optimizer': 'adam',
+        'lr_schedule': None,
+        'warmup_steps': 0,
+        'min_learning_rate': 0.,
+        'base_batch_size': None,
+        'weight_decay': 1e-4,
+        'momentum': 0.9,
+        'tta': None,
+        'prob_format': 'float32',
+        'prob_top_k': 3,
+        'prob_extra_band': None
     }
 
     predefModels = {
@@ -76,6 +100,21 @@ class ModelBuilder(object):
         'weighted_bin_cross_entropy': lossf.weighted_binary_cross_entropy
     }
 
+    optimizers = {
+        'adam': optim.adam,
+        'adamw': optim.adamw,
+        'sgd_momentum': optim.sgd_momentum,
+        'lamb': optim.lamb
+    }
+
+    lr_schedules = {
+        'constant': optim.constant,
+        'exponential': optim.exponential,
+        'cosine': optim.cosine,
+        'one_cycle': optim.one_cycle,
+        'warmup_linear': optim.warmup_linear
+    }
+
     predefClassif = {
         'sigmoid': tf.nn.sigmoid,
         'softmax': tf.nn.softmax
@@ -83,9 +122,11 @@ class ModelBuilder(object):
 
     def __init__(self, params):
         if isinstance(params, dict):
-            self.params = params
+            # A copy, so the defaults (and the parameters set by train) do not leak into the caller's dict.
+            self.params = dict(params)
         elif isinstance(params, str):
             self.params = utils.read_csv_2_dict(os.path.join(params, 'parameters.csv'), keys_exclude=['dataset', 'Notes'])
+        self.params = utils.check_dict_parameters(self.params, default=self.default_params)
         self.network = self.params['network']
         self.model_description = self.predefModels[self.params['network']]
 
@@ -96,21 +137,54 @@ class ModelBuilder(object):
     def register_loss(self, name, loss_func):
         self.loss_functions[name] = loss_func
 
-    #TODO: raise errors if the parameters params, mode and config are None
-    def __build_model(self, features, labels, params, mode, config):
-        tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
-        training = mode == tf.estimator.ModeKeys.TRAIN
-        samples = features
+    def register_optimizer(self, name, optimizer_func):
+        self.optimizers[name] = optimizer_func
 
-        logits = self.model_description(samples, labels, params, mode, config)
-
-        predictions = tf.nn.softmax(logits, name='Softmax')
-        output = tf.expand_dims(tf.argmax(input=predictions, axis=-1, name='Argmax_Prediction'), -1)
-
-        if mode == tf.estimator.ModeKeys.PREDICT:
-            return tf.estimator.EstimatorSpec(mode=mode, predictions={'classes': output,
-                                                                      'probabilities': predictions})
+    def register_lr_schedule(self, name, schedule_func):
+        self.lr_schedules[name] = schedule_func
 
+    def input_shape(self, chip_size):
+        if not 'num_masks' in self.params:
+            return [chip_size, chip_size, self.params['bands']]
+        return [chip_size, chip_size, int(self.params['bands'] + self.params['num_masks'])]
+
+    def output_size(self, chip_size):
+        """ Computes the size of the output of the network for square chips of chip_size (see
+        networks.shape_inference).
+
+        Raises:
+            ValueError: If the network does not accept chips of this size (e.g. the chip is smaller than the
+                receptive field).
+        """
+        try:
+            return shape_inference.output_size(self.network, chip_size)
+        except ValueError as error:
+            raise ValueError('The network ' + self.network + ' does not accept chips of size ' + str(chip_size) +
+                             ': ' + str(error))
+
+    def valid_window_size(self, max_size):
+        """ Finds the largest window, up to max_size, whose output is centered in the window, with the same border
+        loss at both sides (see shape_inference.valid_chip_sizes).
+
+        Returns:
+            The window size and its output size.
+        """
+        return shape_inference.largest_chip_size(self.network, max_size)
+
+    def __learning_rate(self, params, step=None):
+        """ Builds the learning rate of the schedule params['lr_schedule']. With the step (the global step of the
+        estimator), it returns the tensor of the current learning rate. Otherwise, it returns a Keras schedule (or a
+        float, for a constant learning rate).
+        """
+        schedule = self.lr_schedules[optim.schedule_name(params)]
+        if step is not None:
+            with tf.compat.v1.name_scope('learning_rate'):
+                return schedule(params['learning_rate'], tf.cast(step, tf.float32), params)
+        if schedule is optim.constant:
+            return params['learning_rate']
+        return optim.StepSchedule(schedule, params['learning_rate'], params)
+
+    def __compute_loss(self, logits, labels, predictions, output, params, training):
         if labels.shape[1] != logits.shape[1]:
             labels = tf.cast(layers.crop_features(labels, logits.shape[1], name="labels"), tf.float32)
 
@@ -133,6 +207,33 @@ class ModelBuilder(object):
             loss_params['num_classes'] = params['num_classes']
 
         loss = self.loss_functions[params['loss_func']](loss_params)  # TODO: Review this solution
+        return loss, labels, labels_1hot
+
+    #TODO: raise errors if the parameters params, mode and config are None
+    def __build_model(self, features, labels, params, mode, config):
+        tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+        training = mode == tf.estimator.ModeKeys.TRAIN
+        samples = features
+
+        # With test-time augmentation, the augmented variants are predicted in the same batch, and their probabilities
+        # are averaged in the graph.
+        tta_ops = params['tta'] if mode == tf.estimator.ModeKeys.PREDICT else None
+        if tta_ops:
+            samples = dsloader.tta_batch(samples, tta_ops)
+
+        # The softmax and the losses are computed in float32, even when the network computes in float16.
+        logits = tf.cast(self.model_description(samples, labels, params, mode, config), tf.float32)
+
+        predictions = tf.nn.softmax(logits, name='Softmax')
+        if tta_ops:
+            predictions = dsloader.tta_merge(predictions, tta_ops)
+        output = tf.expand_dims(tf.argmax(input=predictions, axis=-1, name='Argmax_Prediction'), -1)
+
+        if mode == tf.estimator.ModeKeys.PREDICT:
+            return tf.estimator.EstimatorSpec(mode=mode, predictions={'classes': output,
+                                                                      'probabilities': predictions})
+
+        loss, labels, labels_1hot = self.__compute_loss(logits, labels, predictions, output, params, training)
 
         # loss = tf.losses.sigmoid_cross_entropy(labels_1hot, output)
         # loss = lossf.weighted_binary_cross_entropy(logits, labels, params['class_weights'])
@@ -145,59 +246,64 @@ class ModelBuilder(object):
         # loss_func = self.losses_switcher.get(params['loss_func'], lossf.unknown_loss_error)
         # loss = loss_func(loss_params)
 
-        tbm.plot_chips_tensorboard(samples, labels, output, params)
-        metrics, summaries = tbm.define_quality_metrics(labels_1hot, predictions, logits, labels, output, loss, params)
+        # The summaries policy (off, scalars or full) defines which diagnostics are added to the graph. The streaming
+        # metrics are always needed by the evaluation, but in training they are only added if they will be written,
+        # and the AUC (200 thresholds) and the chips images only with full summaries.
+        evaluating = mode == tf.estimator.ModeKeys.EVAL
+        full_summaries = params['summaries'] == 'full'
+        write_summaries = params['summaries'] != 'off'
+        if full_summaries:
+            tbm.plot_chips_tensorboard(samples, labels, output, params)
+        metrics = {}
+        if evaluating or write_summaries:
+            metrics, summaries = tbm.define_quality_metrics(labels_1hot, predictions, logits, labels, output, loss,
+                                                            params, auc=evaluating or full_summaries,
+                                                            summaries=write_summaries)
 
         update_ops = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.UPDATE_OPS)
 
-        if params['learning_rate_decay']:
-            params['learning_rate'] = tf.compat.v1.train.exponential_decay(learning_rate=params['learning_rate'],
-                                                                 global_step=tf.compat.v1.train.get_global_step(),
-                                                                 decay_rate=params['decay_rate'],
-                                                                 decay_steps=params['decay_steps'],
-                                                                 name='decrease_lr')
+        params['learning_rate'] = self.__learning_rate(params, tf.compat.v1.train.get_global_step())
 
-        tf.compat.v1.summary.scalar('learning_rate', params['learning_rate'])
+        if write_summaries:
+            tf.compat.v1.summary.scalar('learning_rate', params['learning_rate'])
 
-        optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=params['learning_rate'], name='Optimizer')
-        # optimizer = tf.contrib.opt.NadamOptimizer(params['learning_rate'], name='Optimizer')
+        optimizer = self.optimizers[params['optimizer']](params['learning_rate'], params, 'estimator')
 
         if training:
+            optimizer = prec.graph_rewrite_optimizer(optimizer, params['precision'])
             with tf.control_dependencies(update_ops):
                 train_op = optimizer.minimize(loss=loss, global_step=tf.compat.v1.train.get_global_step())
         else:
             train_op = None
 
-        train_summary_hook = tf.estimator.SummarySaverHook(save_steps=100,
-                                                       output_dir=config.model_dir,
-                                                       summary_op=tf.compat.v1.summary.merge_all())
-
-        eval_metric_ops = {'eval_metrics/accuracy': metrics['accuracy'],
-                           # 'eval_metrics/f1-score': metrics['f1_score'],
-                           'eval_metrics/cross_entropy': metrics['cross_entropy'],
-                           'eval_metrics/auc_roc': metrics['auc-roc']}  # ,
-                           # 'eval_metrics/mean_iou': metrics['mean_iou']}
-
-        logging_hook = tf.estimator.LoggingTensorHook({'loss': loss,
-                                                   'accuracy': metrics['accuracy'][1],
-                                                   # 'f1_score': metrics['f1_score'][1],
-                                                   'cross_entropy': metrics['cross_entropy'][1],
-                                                   # 'mean_iou': metrics['mean_iou'][0],
-                                                   'learning_rate': params['learning_rate'],
-                                                   'auc_roc': metrics['auc-roc'][1]},
-                                                  every_n_iter=100)
-
-        eval_summary_hook = tf.estimator.SummarySaverHook(save_steps=100,
-                                                      output_dir=config.model_dir + "/eval",
-                                                      summary_op=tf.compat.v1.summary.merge_all())
+        eval_metric_ops = None
+        if evaluating:
+            eval_metric_ops = {'eval_metrics/accuracy': metrics['accuracy'],
+                               # 'eval_metrics/f1-score': metrics['f1_score'],
+                               'eval_metrics/cross_entropy': metrics['cross_entropy'],
+                               'eval_metrics/auc_roc': metrics['auc-roc']}  # ,
+                               # 'eval_metrics/mean_iou': metrics['mean_iou']}
+
+        logged_tensors = {'loss': loss, 'learning_rate': params['learning_rate']}
+        for name, key in [('accuracy', 'accuracy'), ('cross_entropy', 'cross_entropy'), ('auc_roc', 'auc-roc')]:
+            if key in metrics:
+                logged_tensors[name] = metrics[key][1]
+        logging_hook = tf.estimator.LoggingTensorHook(logged_tensors, every_n_iter=params['summary_steps'])
+
+        # The training summaries are written by the estimator itself (RunConfig.save_summary_steps).
+        evaluation_hooks = [logging_hook]
+        if full_summaries:
+            evaluation_hooks.append(tf.estimator.SummarySaverHook(save_steps=params['summary_steps'],
+                                                                  output_dir=config.model_dir + "/eval",
+                                                                  summary_op=tf.compat.v1.summary.merge_all()))
 
         return tf.estimator.EstimatorSpec(mode=mode,
                                           predictions=output,
                                           loss=loss,
                                           train_op=train_op,
                                           eval_metric_ops=eval_metric_ops,
-                                          evaluation_hooks=[eval_summary_hook, logging_hook],
-                                          training_hooks=[train_summary_hook, logging_hook])
+                                          evaluation_hooks=evaluation_hooks,
+                                          training_hooks=[logging_hook])
 
     def train(self, train_dataset, test_dataset, output_dir):
         # tf.set_random_seed(1987)
@@ -214,11 +320,7 @@ class ModelBuilder(object):
             for key in sorted(self.params):
                 w.writerow([key, self.params[key]])
 
-        if not 'num_masks' in self.params:
-            self.params['shape'] = [self.params['chip_size'], self.params['chip_size'], self.params['bands']]
-        else:
-            self.params['shape'] = [self.params['chip_size'], self.params['chip_size'],
-                                    int(self.params['bands'] + self.params['num_masks'])]
+        self.params['shape'] = self.input_shape(self.params['chip_size'])
 
         train_loader = dsloader.DatasetLoader(train_dataset, self.params)
         test_loader = dsloader.DatasetLoader(test_dataset, self.params)
@@ -235,27 +337,252 @@ class ModelBuilder(object):
             multpl_data_aug = len(self.params['data_aug_ops']) + 1
             
         # https://www.tensorflow.org/guide/distribute_strategy
-        strategy = tf.distribute.MirroredStrategy()  # TODO: Allow to select the devices here
-        self.params['decay_steps'] = math.ceil((number_of_chips * multpl_data_aug) / (self.params['batch_size'] * strategy.num_replicas_in_sync))
-        config = tf.estimator.RunConfig(train_distribute=strategy)  # , eval_distribute=strategy)
+        strategy = distribution.make_strategy(self.params)
+        num_replicas = distribution.global_replicas(strategy, self.params)
+        self.params['decay_steps'] = math.ceil((number_of_chips * multpl_data_aug) / (self.params['batch_size'] * num_replicas))
+
+        model_params = dict(self.params)
+        model_params['global_batch_size'] = self.params['batch_size'] * num_replicas
+        model_params['learning_rate'] = distribution.scale_learning_rate(self.params['learning_rate'], num_replicas,
+                                                                         self.params['lr_scaling'])
+
+        if self.params['backend'] == 'keras':
+            self.__train_keras(train_loader, test_loader, output_dir, strategy, model_params)
+            return
+
+        save_summary_steps = self.params['summary_steps'] if self.params['summaries'] != 'off' else None
+        config = tf.estimator.RunConfig(train_distribute=strategy,  # , eval_distribute=strategy)
+                                        session_config=prec.session_config(self.params['xla']),
+                                        save_summary_steps=save_summary_steps,
+                                        keep_checkpoint_max=self.__checkpoints_to_keep())
 
         estimator = tf.estimator.Estimator(model_fn=self.__build_model,
                                            model_dir=output_dir,
-                                           params=self.params,
+                                           params=model_params,
                                            config=config)
 
-        trainer = tf.estimator.TrainSpec(lambda: train_loader.tfrecord_input_fn())
-        evaluator = tf.estimator.EvalSpec(lambda: test_loader.tfrecord_input_fn(train=False))
+        train_hooks = []
+        if self.params['profiling']:
+            profiler = profiling.StepProfiler(output_dir, self.params['batch_size'] * strategy.num_replicas_in_sync,
+                                              self.params['profile_steps'])
+            train_hooks.append(profiling.ProfilingHook(profiler))
+        tracker, best_checkpoints = self.__early_stopping_trackers(output_dir)
+        if tracker is not None:
+            train_hooks.append(early_stopping.make_early_stopping_hook(estimator, tracker))
+        exporters = []
+        if best_checkpoints is not None:
+            exporters.append(early_stopping.BestCheckpointExporter(best_checkpoints))
+
+        trainer = tf.estimator.TrainSpec(
+            lambda input_context=None: train_loader.tfrecord_input_fn(input_context=input_context), hooks=train_hooks)
+        evaluator = tf.estimator.EvalSpec(lambda: test_loader.tfrecord_input_fn(train=False), exporters=exporters)
         tf.estimator.train_and_evaluate(estimator, train_spec=trainer, eval_spec=evaluator)
 
-        # profiling_hook = tf.train.ProfilerHook(save_steps=10, output_dir=path.join(output_dir))
-
-        # early_stopping = tf.contrib.estimator.stop_if_no_decrease_hook(
-        #     estimator,
-        #     metric_name='cost/loss',
-        #     max_steps_without_decrease=1000,
-        #     eval_dir=path.join(output_dir, "eval"),
-        #     min_steps=100)
+    def __early_stopping_trackers(self, output_dir):
+        """ Creates the early stopping tracker (params['early_stopping']) and the top-k checkpoints keeper
+        (params['keep_best']), both driven by the evaluation metric params['es_metric'].
+        """
+        tracker = None
+        if self.params['early_stopping']:
+            tracker = early_stopping.EarlyStopping(self.params['es_metric'], self.params['es_patience'],
+                                                   self.params['es_min_delta'])
+        best_checkpoints = None
+        if self.params['keep_best'] is not None:
+            best_checkpoints = early_stopping.BestCheckpoints(os.path.join(output_dir, 'best'),
+                                                              self.params['es_metric'], self.params['keep_best'])
+        return tracker, best_checkpoints
+
+    def __checkpoints_to_keep(self):
+        """ Number of latest checkpoints kept in the model directory. With params['keep_best'], the best checkpoints
+        are copied to <model_dir>/best, so only the last two (the one being evaluated and the one of the resume) are
+        kept, and the disk holds at most keep_best + 2 checkpoints.
+        """
+        return 5 if self.params['keep_best'] is None else 2
+
+    def __train_keras(self, train_loader, test_loader, output_dir, strategy, params):
+        """ Trains the Keras version of the network (see keras_models) with a compiled training loop.
+
+        The model, the optimizer and the step are saved with tf.train.Checkpoint in output_dir, and the training
+        resumes from the latest checkpoint. At every epoch (decay_steps steps), the model is evaluated on the test
+        dataset and saved. The parameter server strategy is not supported by this backend.
+
+        With params['xla'], each training step is compiled with XLA. With params['precision'] = mixed_float16 or
+        mixed_bfloat16, the layers compute in half precision and, for float16, the loss is scaled dynamically.
+        """
+        prec.set_policy(params['precision'])
+        with strategy.scope():
+            model = keras_models.build_model(self.network, params)
+            learning_rate = self.__learning_rate(params)
+            optimizer = self.optimizers[params['optimizer']](learning_rate, params, 'keras')
+            optimizer = prec.loss_scale_optimizer(optimizer, params['precision'])
+            step = tf.Variable(0, dtype=tf.int64, trainable=False, name='global_step')
+            checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, step=step)
+        manager = tf.train.CheckpointManager(checkpoint, output_dir, max_to_keep=self.__checkpoints_to_keep())
+        checkpoint.restore(manager.latest_checkpoint)
+        compute_loss = self.__compute_loss
+
+        def replica_loss(images, labels, training):
+            logits = tf.cast(model(images, training=training), tf.float32)
+            predictions = tf.nn.softmax(logits, name='Softmax')
+            output = tf.expand_dims(tf.argmax(input=predictions, axis=-1, name='Argmax_Prediction'), -1)
+            loss, labels, _ = compute_loss(logits, labels, predictions, output, params, training)
+            if training and len(model.losses) > 0:
+                loss += tf.add_n(model.losses)
+            accuracy = tf.reduce_mean(tf.cast(tf.equal(tf.cast(labels, tf.int64), output), tf.float32))
+            return loss, accuracy
+
+        @tf.function(jit_compile=params['xla'])
+        def replica_train_step(images, labels):
+            with tf.GradientTape() as tape:
+                loss, accuracy = replica_loss(images, labels, True)
+                scaled_loss = prec.scaled_loss(optimizer, loss / strategy.num_replicas_in_sync)
+            gradients = prec.unscaled_gradients(optimizer, tape.gradient(scaled_loss, model.trainable_variables))
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss, accuracy
+
+        def reduce_mean(values):
+            return [strategy.reduce(tf.distribute.ReduceOp.MEAN, value, axis=None) for value in values]
+
+        @tf.function
+        def train_step(images, labels):
+            return reduce_mean(strategy.run(replica_train_step, args=(images, labels)))
+
+        @tf.function
+        def eval_step(images, labels):
+            return reduce_mean(strategy.run(replica_loss, args=(images, labels, False)))
+
+        def evaluate():
+            eval_loss = tf.keras.metrics.Mean()
+            eval_accuracy = tf.keras.metrics.Mean()
+            eval_input = strategy.distribute_datasets_from_function(
+                lambda input_context: test_loader.tfrecord_input_fn(train=False, input_context=input_context))
+            for images, labels in eval_input:
+                loss, accuracy = eval_step(images, labels)
+                eval_loss.update_state(loss)
+                eval_accuracy.update_state(accuracy)
+            with eval_writer.as_default():
+                tf.summary.scalar('cost/loss', eval_loss.result(), step=step)
+                tf.summary.scalar('eval_metrics/accuracy', eval_accuracy.result(), step=step)
+            print('Evaluation (step ', int(step), '): loss = ', float(eval_loss.result()), ', accuracy = ',
+                  float(eval_accuracy.result()))
+            return {'loss': float(eval_loss.result()), 'eval_metrics/accuracy': float(eval_accuracy.result())}
+
+        tracker, best_checkpoints = self.__early_stopping_trackers(output_dir)
+
+        def end_epoch(current_step):
+            """ Evaluates and saves the model. Returns True if the training must stop early. """
+            eval_result = evaluate()
+            checkpoint_path = manager.save(checkpoint_number=current_step)
+            if best_checkpoints is not None and best_checkpoints.metric in eval_result:
+                best_checkpoints.add(checkpoint_path, eval_result[best_checkpoints.metric], current_step)
+            if tracker is not None and tracker.metric in eval_result:
+                tracker.update(eval_result[tracker.metric], current_step)
+                if tracker.should_stop():
+                    print('Early stopping: ', tracker.metric, ' did not improve for ', tracker.patience,
+                          ' evaluations. Best: ', tracker.best, ' at step ', tracker.best_step)
+                    return True
+            return False
+
+        train_writer = tf.summary.create_file_writer(output_dir)
+        eval_writer = tf.summary.create_file_writer(os.path.join(output_dir, 'eval'))
+        train_input = strategy.distribute_datasets_from_function(
+            lambda input_context: train_loader.tfrecord_input_fn(input_context=input_context))
+
+        profiler = None
+        if params['profiling']:
+            profiler = profiling.StepProfiler(output_dir, params['batch_size'] * strategy.num_replicas_in_sync,
+                                              params['profile_steps'])
+
+        iterator = iter(train_input)
+        stopped_early = False
+        while not stopped_early:
+            if profiler is not None:
+                profiler.update_trace(int(step) + 1)
+            step_start = time.perf_counter()
+            try:
+                images, labels = next(iterator)
+            except StopIteration:
+                break
+            input_end = time.perf_counter()
+            loss, accuracy = train_step(images, labels)
+            if profiler is not None:
+                loss.numpy()  # Waits for the step to finish, so the compute time is exact.
+            compute_end = time.perf_counter()
+
+            step.assign_add(1)
+            current_step = int(step)
+            if current_step % params['summary_steps'] == 0:
+                if params['summaries'] != 'off':
+                    current_lr = learning_rate(step) if callable(learning_rate) else learning_rate
+                    with train_writer.as_default():
+                        tf.summary.scalar('cost/loss', loss, step=step)
+                        tf.summary.scalar('quality_metrics/accuracy', accuracy, step=step)
+                        tf.summary.scalar('learning_rate', current_lr, step=step)
+                print('Step ', current_step, ': loss = ', float(loss), ', accuracy = ', float(accuracy))
+            if profiler is not None:
+                profiler.record(current_step, input_wait=input_end - step_start, compute=compute_end - input_end,
+                                summary=time.perf_counter() - compute_end)
+            if current_step % params['decay_steps'] == 0:
+                stopped_early = end_epoch(current_step)
+
+        if not stopped_early and int(step) % params['decay_steps'] != 0:
+            end_epoch(int(step))
+        if profiler is not None:
+            profiler.write_report()
+
+    def __load_keras_model(self, model_dir, shape):
+        """ Builds the Keras version of the network and loads its latest checkpoint in model_dir.
+
+        Checkpoints of the estimator backend are also loaded, matching the variables by name.
+        """
+        params = dict(self.params)
+        params['shape'] = list(shape)
+        prec.set_policy(params['precision'])
+        model = keras_models.build_model(self.network, params)
+        checkpoint_path = tf.train.latest_checkpoint(model_dir)
+        if keras_models.is_estimator_checkpoint(checkpoint_path):
+            keras_models.load_estimator_checkpoint(model, checkpoint_path)
+        else:
+            tf.train.Checkpoint(model=model).restore(checkpoint_path).expect_partial()
+        return model
+
+    def __predictions(self, images, model_dir, tta_ops=None, batch_size=None):
+        """ Yields the classes and the probabilities of each image, using the estimator or the Keras backend.
+
+        With tta_ops (names of dataset_loader.tta_operations), the probabilities are averaged over the augmented
+        variants of each image, predicted in one forward pass. Default batch_size: params['batch_size'].
+        """
+        if batch_size is None:
+            batch_size = self.params['batch_size']
+        if self.params['backend'] == 'keras':
+            model = self.__load_keras_model(model_dir, images.shape[1:])
+
+            def predict_batch(batch):
+                if tta_ops:
+                    batch = dsloader.tta_batch(batch, tta_ops)
+                probabilities = tf.nn.softmax(tf.cast(model(batch, training=False), tf.float32), name='Softmax')
+                if tta_ops:
+                    probabilities = dsloader.tta_merge(probabilities, tta_ops)
+                return probabilities
+
+            predict_fn = tf.function(predict_batch, jit_compile=self.params['xla'])
+            for start in range(0, len(images), batch_size):
+                probabilities = predict_fn(images[start:(start + batch_size)]).numpy()
+                classes = np.expand_dims(np.argmax(probabilities, axis=-1), -1)
+                for pos in range(len(probabilities)):
+                    yield {'classes': classes[pos], 'probabilities': probabilities[pos]}
+        else:
+            params = dict(self.params)
+            params['tta'] = tta_ops
+            estimator = tf.estimator.Estimator(model_fn=self.__build_model,
+                                               model_dir=model_dir,
+                                               params=params)
+
+            input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(x=images,
+                                                                    batch_size=batch_size,
+                                                                    shuffle=False)
+            for predict in estimator.predict(input_fn):
+                yield predict
 
     def validate(self, images, expect_labels, model_dir, save_results=True, show_plots=True,
                  exclude_classes=[]):
@@ -263,19 +590,11 @@ class ModelBuilder(object):
 
         out_dir = os.path.join(model_dir, 'validation')
 
-        estimator = tf.estimator.Estimator(model_fn=self.__build_model,
-                                           model_dir=model_dir,
-                                           params=self.params)
-
-        input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(x=images,
-                                                      batch_size=self.params['batch_size'],
-                                                      shuffle=False)
-
         predictions_lst = []
         probabilities_lst = []
         crop_labels = []
 
-        zip_func = zip(estimator.predict(input_fn), expect_labels)
+        zip_func = zip(self.__predictions(images, model_dir), expect_labels)
 
         for predict, label in zip_func:
             predictions_lst.append(predict['classes'])
@@ -319,30 +638,167 @@ class ModelBuilder(object):
         vis.plot_roc_curve(metrics['roc_curve'], auc_roc_path, show_plot=show_plots)
         vis.plot_precision_recall_curve(metrics['prec_rec_curve'], fig_path=prec_rec_path, show_plot=show_plots)
 
-    def predict(self, chip_struct, model_dir, return_prob=True):
+    def __check_overlap(self, chip_size, overlap):
+        # The outputs are written at the window coords shifted by overlap / 2, so the overlap must match the border
+        # lost by the network, and the output must be centered in the chip.
+        if overlap is None:
+            return
+        try:
+            recommended = shape_inference.tiling(self.network, chip_size)['overlap']
+        except ValueError as error:
+            print('WARNING: ', error)
+            return
+        if tuple(overlap) != (recommended, recommended):
+            print('WARNING: the overlap of the chips ', tuple(overlap), ' does not match the border loss of the ',
+                  'network ', self.network, ' for chips of ', chip_size, ' pixels. Recommended overlap: ', recommended)
+
+    def __check_tta(self, chip_size):
+        # The inverse transformations of the test-time augmentation assume that the output is centered in the chip.
+        try:
+            shape_inference.output_size(self.network, chip_size, strict=True)
+        except ValueError as error:
+            raise ValueError('Test-time augmentation needs chips whose output is centered: ' + str(error) +
+                             ' Nearest valid chip size: ' +
+                             str(shape_inference.nearest_chip_size(self.network, chip_size)))
+
+    def __predicted_batches(self, images, model_dir, return_prob=True, tta=None, batch_size=None):
+        """ Yields the predictions of the images in batches of batch_size chips: dicts with the classes ('predict')
+        and, with return_prob, the encoded probabilities and their metadata (see predict).
+        """
+        if batch_size is None:
+            batch_size = self.params['batch_size']
+        if tta is None:
+            tta = self.params['tta']
+        if tta == 'all':
+            tta = list(dsloader.tta_operations.keys())
+        if tta:
+            self.__check_tta(images.shape[1])
+
+        def batch_struct(predictions, probabilities, metadata):
+            batch = {'predict': np.array(predictions, dtype=np.int32)}
+            if return_prob:
+                batch['probabilities'] = np.array(probabilities)
+                batch['probabilities_metadata'] = metadata
+            return batch
+
+        predictions = []
+        probabilities = []
+        metadata = None
+        for predict in self.__predictions(images, model_dir, tta, batch_size):
+            predictions.append(predict['classes'])
+            if return_prob:
+                encoded, metadata = quant.encode_probabilities(predict['probabilities'], self.params['prob_format'],
+                                                               self.params['prob_top_k'],
+                                                               self.params['prob_extra_band'])
+                probabilities.append(encoded)
+            if len(predictions) == batch_size:
+                yield batch_struct(predictions, probabilities, metadata)
+                predictions = []
+                probabilities = []
+        if len(predictions) > 0:
+            yield batch_struct(predictions, probabilities, metadata)
+
+    def predict(self, chip_struct, model_dir, return_prob=True, tta=None, batch_size=None):
+        """ Classifies the chips of chip_struct, adding the classes ('predict') and the probabilities to it.
+
+        Args:
+            tta (list): Optional test-time augmentation: names of dataset_loader.tta_operations, or 'all'. Default:
+                params['tta'].
+            batch_size (int): Number of chips per forward pass. Default: params['batch_size'].
+
+        The probabilities are encoded as params['prob_format'] (float32, uint8 or top_k, with params['prob_top_k']
+        classes), optionally with a confidence or entropy band (params['prob_extra_band']). Their metadata, needed to
+        decode them (see common.quantization), is stored in chip_struct['probabilities_metadata'].
+        """
         tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.WARN)
         images = chip_struct['chips']
 
-        estimator = tf.estimator.Estimator(model_fn=self.__build_model,
-                                           model_dir=model_dir,
-                                           params=self.params)
-
-        input_fn = tf.compat.v1.estimator.inputs.numpy_input_fn(x=images,
-                                                      batch_size=self.params['batch_size'],
-                                                      shuffle=False)
-
         print('Classifying image with structure ', str(images.shape), '...')
+        self.__check_overlap(images.shape[1], chip_struct.get('overlap'))
 
-        predictions = []
-        if return_prob:
-            probabilities = []
-
-        for predict in estimator.predict(input_fn):
-            predictions.append(predict['classes'])
+        batches = list(self.__predicted_batches(images, model_dir, return_prob, tta, batch_size))
+        if len(batches) == 0:
+            # No chips: empty arrays, as the chips.
+            chip_struct['predict'] = np.array([], dtype=np.int32)
             if return_prob:
-                probabilities.append(predict['probabilities'])
-        chip_struct['predict'] = np.array(predictions, dtype=np.int32)
+                chip_struct['probabilities'] = np.array([])
+                chip_struct['probabilities_metadata'] = None
+            return chip_struct
+
+        chip_struct['predict'] = np.concatenate([batch['predict'] for batch in batches])
         if return_prob:
-            chip_struct['probabilities'] = np.array(probabilities, dtype=np.float32)
+            chip_struct['probabilities'] = np.concatenate([batch['probabilities'] for batch in batches])
+            chip_struct['probabilities_metadata'] = batches[-1]['probabilities_metadata']
 
         return chip_struct
+
+    def predict_to_raster(self, chip_struct, model_dir, base_raster, output_path, prob_path=None, ref_shp=None,
+                          tta=None, batch_size=None, max_queue=4, writer_params=None):
+        """ Classifies the chips of chip_struct, writing the classes (and, with prob_path, the probabilities) to
+        rasters as the batches are predicted, instead of keeping them in memory as predict.
+
+        The batches are written by a raster_writer.AsyncPredictionWriter in a background thread, so the prediction of
+        the next batches runs while the previous ones are compressed and written. The outputs are created already
+        cropped to the network output, so only the optional clip by ref_shp runs after the prediction.
+
+        Args:
+            base_raster (str): Path to the classified raster, which gives the size and the georeference.
+            output_path (str): Path to the classes raster.
+            prob_path (str): Optional path to the probabilities raster (encoded as in predict).
+            ref_shp (str): Optional shapefile to clip the outputs.
+            max_queue (int): Maximum number of batches waiting to be written.
+            writer_params (dict): Parameters of the outputs. See raster_writer.default_params.
+
+        Returns:
+            The paths to the outputs, by key ('predict' and 'probabilities').
+        """
+        tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.WARN)
+        images = chip_struct['chips']
+        output_paths = {'predict': output_path}
+        if prob_path is not None:
+            output_paths['probabilities'] = prob_path
+
+        print('Classifying image with structure ', str(images.shape), '...')
+        self.__check_overlap(images.shape[1], chip_struct.get('overlap'))
+
+        with rw.AsyncPredictionWriter(base_raster, output_paths, chip_struct['overlap'], max_queue,
+                                      writer_params) as writer:
+            start = 0
+            for batch in self.__predicted_batches(images, model_dir, prob_path is not None, tta, batch_size):
+                end = start + len(batch['predict'])
+                batch['coords'] = chip_struct['coords'][start:end]
+                writer.put(batch)
+                start = end
+
+        if ref_shp is not None:
+            for path in output_paths.values():
+                iutils.clip_by_aggregated_polygons(path, ref_shp, path, no_data=0)
+        return output_paths
+
+    def predict_large_windows(self, raster_array, model_dir, window_size=2048, return_prob=True, tta=None,
+                              batch_size=1):
+        """ Classifies a raster with windows much larger than the training chips.
+
+        The networks use 'valid' padding, so each window loses a border, and small chips waste much of the computation
+        in the overlap. Here the window is the largest one accepted by the network up to window_size (and the raster
+        size), and the windows overlap by exactly the border loss, so their outputs are adjacent.
+
+        Args:
+            raster_array (array): Raster to classify (rows x cols x bands).
+            window_size (int): Maximum size of the windows (limited by the memory of the device).
+            batch_size (int): Number of windows per forward pass.
+
+        Returns:
+            The chip struct of the windows, with their predictions, as ModelBuilder.predict. It can be written with
+            geofunctions.write_pred_chips.
+        """
+        max_size = min(window_size, raster_array.shape[0], raster_array.shape[1])
+        window_size, output_size = self.valid_window_size(max_size)
+        overlap = window_size - output_size
+        print('Classifying with windows of ', window_size, ' pixels (output: ', output_size, ' pixels)...')
+
+        generator = seqchips.SequentialChipGenerator({'raster_array': raster_array,
+                                                      'win_size': window_size,
+                                                      'overlap': (overlap, overlap)})
+        chip_struct = generator.generate_chips()
+        return self.predict(chip_struct, model_dir, return_prob=return_prob, tta=tta, batch_size=batch_size)
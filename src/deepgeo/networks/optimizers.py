@@ -0,0 +1,175 @@
+import math
+import tensorflow as tf
+
+backends = ['estimator', 'keras']
+
+
+def schedule_name(params):
+    """ Gets the name of the learning rate schedule. Without lr_schedule, the old learning_rate_decay parameter
+    chooses between the exponential decay and a constant learning rate.
+    """
+    if params.get('lr_schedule') is not None:
+        return params['lr_schedule']
+    return 'exponential' if params.get('learning_rate_decay', False) else 'constant'
+
+
+def _total_steps(params):
+    if params.get('epochs') is None:
+        raise ValueError('The learning rate schedule ' + schedule_name(params) + ' needs the number of epochs.')
+    return float(params['epochs'] * params['decay_steps'])
+
+
+def _warmup_steps(params):
+    # Default: one epoch.
+    warmup_steps = params.get('warmup_steps')
+    return float(warmup_steps if warmup_steps else params['decay_steps'])
+
+
+def constant(learning_rate, step, params):
+    return tf.constant(learning_rate, dtype=tf.float32)
+
+
+def exponential(learning_rate, step, params):
+    """ Decays the learning rate by decay_rate at each decay_steps (one epoch). """
+    return learning_rate * tf.pow(float(params['decay_rate']), step / float(params['decay_steps']))
+
+
+def cosine(learning_rate, step, params):
+    """ Cosine decay from learning_rate to min_learning_rate along the whole training, after an optional linear
+    warmup of warmup_steps.
+    """
+    total_steps = _total_steps(params)
+    warmup_steps = float(params.get('warmup_steps') or 0)
+    min_lr = params.get('min_learning_rate', 0.)
+    progress = tf.clip_by_value((step - warmup_steps) / max(total_steps - warmup_steps, 1.), 0., 1.)
+    decayed = min_lr + 0.5 * (learning_rate - min_lr) * (1. + tf.cos(math.pi * progress))
+    if warmup_steps > 0:
+        decayed = tf.where(step < warmup_steps, learning_rate * (step + 1.) / warmup_steps, decayed)
+    return decayed
+
+
+def one_cycle(learning_rate, step, params):
+    """ One-cycle policy: the learning rate rises linearly from learning_rate / 25 to learning_rate along the first
+    one_cycle_pct of the training, and then anneals with a cosine to learning_rate / 1e4.
+    """
+    total_steps = _total_steps(params)
+    peak_step = max(total_steps * params.get('one_cycle_pct', 0.3), 1.)
+    initial_lr = learning_rate / 25.
+    final_lr = learning_rate / 1e4
+    rising = initial_lr + (learning_rate - initial_lr) * tf.minimum(step / peak_step, 1.)
+    progress = tf.clip_by_value((step - peak_step) / max(total_steps - peak_step, 1.), 0., 1.)
+    annealing = final_lr + 0.5 * (learning_rate - final_lr) * (1. + tf.cos(math.pi * progress))
+    return tf.where(step < peak_step, rising, annealing)
+
+
+def warmup_linear(learning_rate, step, params):
+    """ Linear scaling rule for large batches: the learning rate is scaled by global_batch_size / base_batch_size,
+    reached with a linear warmup from learning_rate along warmup_steps (default: one epoch). Then, it decays linearly
+    to min_learning_rate at the end of the training (if the number of epochs is defined).
+
+    This schedule already scales the learning rate with the batch size, so lr_scaling should not be used with it.
+    """
+    global_batch_size = params.get('global_batch_size', params['batch_size'])
+    base_batch_size = params.get('base_batch_size') or params['batch_size']
+    peak_lr = learning_rate * global_batch_size / float(base_batch_size)
+    warmup_steps = _warmup_steps(params)
+    rate = learning_rate + (peak_lr - learning_rate) * tf.minimum(step / warmup_steps, 1.)
+    if params.get('epochs') is not None:
+        total_steps = _total_steps(params)
+        min_lr = params.get('min_learning_rate', 0.)
+        progress = tf.clip_by_value((step - warmup_steps) / max(total_steps - warmup_steps, 1.), 0., 1.)
+        rate = tf.where(step < warmup_steps, rate, peak_lr - (peak_lr - min_lr) * progress)
+    return rate
+
+
+class StepSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """ Keras version of the schedules above, which are functions of the learning rate, the step and the params. """
+    def __init__(self, schedule, learning_rate, params):
+        super().__init__()
+        self.schedule = schedule
+        self.learning_rate = learning_rate
+        self.params = params
+
+    def __call__(self, step):
+        return self.schedule(self.learning_rate, tf.cast(step, tf.float32), self.params)
+
+    def get_config(self):
+        return {'schedule': self.schedule.__name__, 'learning_rate': self.learning_rate}
+
+
+class AdamWOptimizer(tf.compat.v1.train.AdamOptimizer):
+    """ Adam with decoupled weight decay (AdamW) for the estimator backend. Before each update, the variables are
+    decayed by learning_rate * weight_decay, as in tf.keras.optimizers.AdamW.
+
+    The decay runs in the update of each variable (the _apply methods), which the distribution strategies call once
+    per variable in cross-replica context, so it also works with mirrored variables.
+    """
+    def __init__(self, weight_decay, learning_rate=0.001, **kwargs):
+        super().__init__(learning_rate=learning_rate, **kwargs)
+        self.weight_decay = weight_decay
+
+    def _decay(self, var):
+        learning_rate = tf.cast(self._lr_t, var.dtype.base_dtype)
+        return tf.compat.v1.assign_sub(var, learning_rate * self.weight_decay * var, use_locking=self._use_locking)
+
+    def _apply_dense(self, grad, var):
+        with tf.control_dependencies([self._decay(var)]):
+            return super()._apply_dense(grad, var)
+
+    def _resource_apply_dense(self, grad, var):
+        with tf.control_dependencies([self._decay(var)]):
+            return super()._resource_apply_dense(grad, var)
+
+    def _apply_sparse(self, grad, var):
+        with tf.control_dependencies([self._decay(var)]):
+            return super()._apply_sparse(grad, var)
+
+    def _resource_apply_sparse(self, grad, var, indices):
+        with tf.control_dependencies([self._decay(var)]):
+            return super()._resource_apply_sparse(grad, var, indices)
+
+
+def _check_backend(backend):
+    if backend not in backends:
+        raise ValueError('Unknown backend: ' + str(backend) + '. Options: ' + ', '.join(backends))
+
+
+def adam(learning_rate, params, backend='estimator'):
+    _check_backend(backend)
+    if backend == 'keras':
+        return tf.keras.optimizers.Adam(learning_rate=learning_rate, name='Optimizer')
+    return tf.compat.v1.train.AdamOptimizer(learning_rate=learning_rate, name='Optimizer')
+
+
+def adamw(learning_rate, params, backend='estimator'):
+    _check_backend(backend)
+    weight_decay = params.get('weight_decay', 1e-4)
+    if backend == 'keras':
+        if hasattr(tf.keras.optimizers, 'AdamW'):
+            return tf.keras.optimizers.AdamW(learning_rate=learning_rate, weight_decay=weight_decay, name='Optimizer')
+        import tensorflow_addons as tfa
+        return tfa.optimizers.AdamW(weight_decay=weight_decay, learning_rate=learning_rate, name='Optimizer')
+    return AdamWOptimizer(weight_decay, learning_rate=learning_rate, name='Optimizer')
+
+
+def sgd_momentum(learning_rate, params, backend='estimator'):
+    _check_backend(backend)
+    momentum = params.get('momentum', 0.9)
+    nesterov = params.get('nesterov', False)
+    if backend == 'keras':
+        return tf.keras.optimizers.SGD(learning_rate=learning_rate, momentum=momentum, nesterov=nesterov,
+                                       name='Optimizer')
+    return tf.compat.v1.train.MomentumOptimizer(learning_rate=learning_rate, momentum=momentum,
+                                                use_nesterov=nesterov, name='Optimizer')
+
+
+def lamb(learning_rate, params, backend='estimator'):
+    """ LAMB (layer-wise adaptive moments), for training with large batches. """
+    _check_backend(backend)
+    if backend != 'keras':
+        raise ValueError('The optimizer lamb is supported only by the keras backend.')
+    weight_decay = params.get('weight_decay', 1e-4)
+    if hasattr(tf.keras.optimizers, 'Lamb'):
+        return tf.keras.optimizers.Lamb(learning_rate=learning_rate, weight_decay=weight_decay, name='Optimizer')
+    import tensorflow_addons as tfa
+    return tfa.optimizers.LAMB(learning_rate=learning_rate, weight_decay=weight_decay, name='Optimizer')
@@ -0,0 +1,63 @@
+import tensorflow as tf
+
+policies = ['float32', 'mixed_float16', 'mixed_bfloat16']
+
+
+def check_precision(precision):
+    if precision not in policies:
+        raise ValueError('Unknown precision: ' + str(precision) + '. Options: ' + ', '.join(policies))
+
+
+def set_policy(precision):
+    """ Sets the Keras global dtype policy. The layers built afterwards compute in float16/bfloat16 with float32
+    variables, when precision is mixed_float16/mixed_bfloat16.
+    """
+    check_precision(precision)
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
+def needs_loss_scaling(precision):
+    return precision == 'mixed_float16'
+
+
+def loss_scale_optimizer(optimizer, precision):
+    """ Wraps the optimizer with dynamic loss scaling when training in float16, to avoid gradient underflow. """
+    if needs_loss_scaling(precision):
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def scaled_loss(optimizer, loss):
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        if hasattr(optimizer, 'get_scaled_loss'):
+            return optimizer.get_scaled_loss(loss)
+        return optimizer.scale_loss(loss)
+    return loss
+
+
+def unscaled_gradients(optimizer, gradients):
+    # Keras 3 unscales the gradients in apply_gradients, older versions need it explicitly.
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer) and \
+            hasattr(optimizer, 'get_unscaled_gradients'):
+        return optimizer.get_unscaled_gradients(gradients)
+    return gradients
+
+
+def graph_rewrite_optimizer(optimizer, precision):
+    """ Enables the automatic mixed precision graph rewrite (with loss scaling) of a tf.compat.v1 optimizer, for the
+    estimator backend. Only float16 is supported by the rewrite.
+    """
+    check_precision(precision)
+    if precision == 'float32':
+        return optimizer
+    if precision != 'mixed_float16':
+        raise ValueError('Precision ' + precision + ' is supported only by the keras backend.')
+    return tf.compat.v1.mixed_precision.enable_mixed_precision_graph_rewrite(optimizer)
+
+
+def session_config(xla=False):
+    """ Builds the session config of the estimator, turning on the XLA JIT compilation of the graph if xla is True. """
+    config = tf.compat.v1.ConfigProto()
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.compat.v1.OptimizerOptions.ON_1
+    return config
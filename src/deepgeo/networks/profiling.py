@@ -0,0 +1,188 @@
+import csv
+import os
+import resource
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+import common.utils as utils
+
+phases = ['input_wait', 'compute', 'summary']
+
+
+def host_memory_mb():
+    """ Gets the resident memory of the process in MB (the peak resident memory where /proc is not available). """
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 ** 2)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StepProfiler(object):
+    """ Records the time of each training step, split in input wait, compute and summary writing.
+
+    Optionally, captures a TF profiler trace (viewed in the TensorBoard profile tab) from the step trace_steps[0] to
+    the step trace_steps[1].
+
+    Args:
+        output_dir (str): Directory of the reports and the traces (the model directory).
+        batch_size (int): Number of examples per step, to compute the throughput.
+        trace_steps (list): Optional first and last step of the trace.
+    """
+    def __init__(self, output_dir, batch_size, trace_steps=None):
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.trace_steps = trace_steps
+        self.tracing = False
+        self.steps = []
+
+    def record(self, step, input_wait=0., compute=0., summary=0.):
+        self.steps.append({'step': int(step),
+                           'input_wait': input_wait,
+                           'compute': compute,
+                           'summary': summary,
+                           'host_memory_mb': host_memory_mb()})
+
+    def in_trace(self, step):
+        """ Checks if the step is between the first and the last step of the trace (trace_steps). """
+        return self.trace_steps is not None and self.trace_steps[0] <= step <= self.trace_steps[1]
+
+    def update_trace(self, step):
+        """ Starts or stops the profiler trace, according to the step which is about to run. """
+        if self.trace_steps is None:
+            return
+        if not self.tracing and self.in_trace(step):
+            tf.profiler.experimental.start(os.path.join(self.output_dir, 'profile'))
+            self.tracing = True
+        elif self.tracing and step > self.trace_steps[1]:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+    def summary(self):
+        """ Summarizes the recorded steps. The first step is excluded from the times, as it includes the tracing
+        and the graph optimizations.
+
+        The input wait may be measured only in some steps (None in the others, where it is included in the compute
+        time). Its statistics and the input bound ratio are computed on the measured steps, and input_wait_note tells
+        how many they are. If it was not measured in any step, they are None.
+        """
+        steps = self.steps[1:] if len(self.steps) > 1 else self.steps
+        report = {'steps': len(self.steps)}
+        step_times = np.array([sum(step[phase] or 0. for phase in phases) for step in steps])
+        for phase in phases:
+            times = np.array([step[phase] for step in steps if step[phase] is not None])
+            report[phase + '_mean'] = float(np.mean(times)) if len(times) > 0 else 0.
+            report[phase + '_p95'] = float(np.percentile(times, 95)) if len(times) > 0 else 0.
+        report['step_time_mean'] = float(np.mean(step_times)) if len(step_times) > 0 else 0.
+        report['examples_per_sec'] = self.batch_size / report['step_time_mean'] if report['step_time_mean'] > 0 else 0.
+
+        measured = [step['input_wait'] is not None for step in steps]
+        if len(steps) > 0 and not any(measured):
+            report['input_wait_mean'] = None
+            report['input_wait_p95'] = None
+            report['input_bound_ratio'] = None
+            report['input_wait_note'] = 'The input wait was not measured (no traced run with an iterator op in its ' \
+                                        'step stats), so it is included in the compute time.'
+        else:
+            measured_time = float(np.mean(step_times[measured])) if any(measured) else 0.
+            report['input_bound_ratio'] = report['input_wait_mean'] / measured_time if measured_time > 0 else 0.
+            if not all(measured):
+                report['input_wait_note'] = 'The input wait was measured in ' + str(sum(measured)) + ' of ' + \
+                                            str(len(steps)) + ' steps (traced runs). In the others, it is included ' \
+                                            'in the compute time.'
+        report['host_memory_peak_mb'] = max([step['host_memory_mb'] for step in self.steps], default=0.)
+        return report
+
+    def write_report(self):
+        """ Writes profiling_report.csv (summary) and profiling_steps.csv (each step) to the output directory. """
+        self.stop_trace()
+        utils.save_dict_2_csv(self.summary(), os.path.join(self.output_dir, 'profiling_report.csv'))
+        with open(os.path.join(self.output_dir, 'profiling_steps.csv'), 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['step'] + phases + ['host_memory_mb'], delimiter=';')
+            writer.writeheader()
+            writer.writerows(self.steps)
+
+
+def input_wait_time(run_metadata):
+    """ Gets the time a session run waited for the input pipeline: the duration of its iterator get next ops (the
+    longest one, as the replicas get their batches in parallel), from the step stats of a traced run.
+
+    Returns:
+        The input wait in seconds, or None if the step stats have no get next op.
+    """
+    if run_metadata is None:
+        return None
+    durations = [node.all_end_rel_micros for device in run_metadata.step_stats.dev_stats
+                 for node in device.node_stats if 'GetNext' in node.node_name.split(':')[0]]
+    if len(durations) == 0:
+        return None
+    return max(durations) / 1e6
+
+
+class ProfilingHook(tf.compat.v1.train.SessionRunHook):
+    """ Records the step times of an estimator with a StepProfiler.
+
+    In the estimator, the input pipeline runs inside the session, so the input wait is the duration of the iterator
+    get next op in the step stats of a traced run (software trace only). As the tracing slows down the runs, only the
+    steps of the profiler trace (trace_steps) are traced or, without it, one step in trace_every. The other steps are
+    timed by the wall clock only, and their input wait (None, not measured) is included in the compute time, as in
+    the traced runs whose get next op is not found. The summary time is the time spent between the session runs,
+    mostly by the hooks that write the summaries.
+
+    Args:
+        profiler (StepProfiler): Profiler of the steps.
+        trace_every (int): Interval between the traced steps, if the profiler has no trace_steps.
+    """
+    def __init__(self, profiler, trace_every=100):
+        self.profiler = profiler
+        self.trace_every = trace_every
+        self.global_step = None
+        self.next_step = None
+        self.run_start = None
+        self.last_run_end = None
+
+    def begin(self):
+        self.global_step = tf.compat.v1.train.get_global_step()
+
+    def after_create_session(self, session, coord):
+        # The steps are numbered from 1, as in the Keras backend: the step which is about to run is global_step + 1.
+        self.next_step = int(session.run(self.global_step)) + 1
+
+    def traced(self, step):
+        if self.profiler.trace_steps is not None:
+            return self.profiler.in_trace(step)
+        return step % self.trace_every == 0
+
+    def before_run(self, run_context):
+        now = time.perf_counter()
+        if self.last_run_end is not None and len(self.profiler.steps) > 0:
+            self.profiler.steps[-1]['summary'] = now - self.last_run_end
+        self.profiler.update_trace(self.next_step)
+        options = None
+        if self.traced(self.next_step):
+            options = tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.SOFTWARE_TRACE)
+        self.run_start = time.perf_counter()
+        return tf.compat.v1.train.SessionRunArgs(self.global_step, options=options)
+
+    def after_run(self, run_context, run_values):
+        self.last_run_end = time.perf_counter()
+        run_time = self.last_run_end - self.run_start
+        input_wait = input_wait_time(run_values.run_metadata)
+        if input_wait is None:
+            compute = run_time
+        else:
+            input_wait = min(input_wait, run_time)
+            compute = run_time - input_wait
+        self.profiler.record(self.next_step, input_wait=input_wait, compute=compute)
+        self.next_step += 1
+
+    def end(self, session):
+        self.profiler.write_report()
@@ -0,0 +1,194 @@
+# Static shape inference of the predefined networks. The sizes are computed layer by layer in pure Python, following
+# the descriptions of the networks (see networks.keras_models), so no graph is built.
+import collections
+
+# Size of the features, and position (in input pixels) of their first pixel and the distance between their pixels.
+Features = collections.namedtuple('Features', ['size', 'offset', 'scale'])
+
+
+def conv(features, kernel_size=3, pad='same'):
+    if pad == 'same':
+        return features
+    return Features(_check_size(features.size - kernel_size + 1),
+                    features.offset + (kernel_size - 1) / 2 * features.scale,
+                    features.scale)
+
+
+def pool(features, pad='same', strict=False):
+    """ Features after a 2x2 max pooling with strides 2. With strict, pooling of an odd size is an error, as the
+    last row/column is dropped ('valid') or padded ('same'), and the features are no longer aligned with the input.
+    """
+    if strict and features.size % 2 != 0:
+        raise ValueError('Pooling of an odd size (' + str(features.size) + ') is not aligned with the input.')
+    size = (features.size + 1) // 2 if pad == 'same' else _check_size(features.size // 2)
+    return Features(size, features.offset + features.scale / 2, features.scale * 2)
+
+
+def up_conv(features, kernel_size, strides, pad='valid'):
+    if pad == 'same':
+        size = features.size * strides
+    else:
+        size = (features.size - 1) * strides + kernel_size
+    scale = features.scale / strides
+    return Features(size, features.offset - (strides - 1) / 2 * scale, scale)
+
+
+def crop(features, out_size):
+    """ Centered crop of the features (see keras_layers.crop_features). """
+    if out_size > features.size:
+        raise ValueError('Cannot crop features of size ' + str(features.size) + ' to ' + str(out_size) + '.')
+    top = (features.size - out_size) // 2
+    return Features(out_size, features.offset + top * features.scale, features.scale)
+
+
+def _check_size(size):
+    if size <= 0:
+        raise ValueError('The chip is smaller than the receptive field of the network.')
+    return size
+
+
+def _check_aligned(skip, features):
+    if skip.offset != features.offset:
+        raise ValueError('The skip connection is shifted by ' + str(features.offset - skip.offset) +
+                         ' pixels from the up-convolution.')
+
+
+def vgg16_encoder(features, strict=False):
+    """ Features of the VGG16 encoder of the FCNs ('same' padding). """
+    layers = {}
+    for block, num_convs in enumerate([2, 2, 3, 3, 3]):
+        for _ in range(num_convs):
+            features = conv(features, 3, 'same')
+        layers['conv' + str(block + 1) + '_' + str(num_convs)] = features
+        features = pool(features, 'same', strict)
+        layers['pool' + str(block + 1)] = features
+    return layers
+
+
+def fcn(features, skips, final_kernel, final_strides, final_skip=None, strict=False):
+    """ Output of a FCN (see keras_models.fcn_model). The last up-convolution is cropped to the chip size. With
+    strict, the chip size must be a multiple of 32, so no pooling layer pads the features.
+    """
+    layers = vgg16_encoder(features, strict)
+    score = conv(conv(layers['pool5'], 7, 'same'), 1, 'same')
+    for skip in skips:
+        score = crop(up_conv(score, 4, 2, 'same'), layers[skip].size)
+    out_size = features.size if final_skip is None else layers[final_skip].size
+    out = crop(up_conv(score, final_kernel, final_strides, 'same'), out_size)
+    # The outputs of 'same' padding are aligned with the input.
+    return Features(out.size, 0., 1.)
+
+
+def unet(features, strict=False):
+    """ Output of the U-Net (and its late fusion and mask versions), with 'valid' padding: two 3x3 convolutions per
+    level, and the skip connections cropped to the up-convolutions. With strict, the skip connections must be
+    aligned with the up-convolutions.
+    """
+    skips = []
+    for _ in range(4):
+        features = conv(conv(features, 3, 'valid'), 3, 'valid')
+        skips.append(features)
+        features = pool(features, 'valid', strict)
+    features = conv(conv(features, 3, 'valid'), 3, 'valid')
+    for skip in reversed(skips):
+        features = up_conv(features, 2, 2, 'valid')
+        skip = crop(skip, features.size)
+        if strict:
+            _check_aligned(skip, features)
+        features = conv(conv(features, 3, 'valid'), 3, 'valid')
+    return features
+
+
+networks = {'fcn1s': lambda features, strict=False: fcn(features, ['conv5_3', 'conv4_3', 'conv3_3', 'conv2_2'], 4, 2,
+                                                        final_skip='conv1_2', strict=strict),
+            'fcn2s': lambda features, strict=False: fcn(features, ['pool4', 'pool3', 'pool2', 'pool1'], 8, 2,
+                                                        strict=strict),
+            'fcn4s': lambda features, strict=False: fcn(features, ['pool4', 'pool3', 'pool2'], 8, 4, strict=strict),
+            'fcn8s': lambda features, strict=False: fcn(features, ['pool4', 'pool3'], 8, 8, strict=strict),
+            'fcn32s': lambda features, strict=False: fcn(features, [], 64, 32, strict=strict),
+            'unet': unet,
+            'unet_lf': unet,
+            'mask_unet': unet}
+
+
+def output_features(network, chip_size, strict=False):
+    """ Computes the output features of a network for square chips of chip_size.
+
+    With strict, the chip size must give an output centered in the chip, with the same border loss at both sides,
+    and features aligned with the input in all layers.
+
+    Raises:
+        ValueError: If the network does not accept chips of this size (or, with strict, the output is not aligned).
+    """
+    if network not in networks:
+        raise ValueError('Unknown network: ' + str(network) + '. Options: ' + ', '.join(sorted(networks)))
+    out = networks[network](Features(chip_size, 0., 1.), strict=strict)
+    if strict and out.offset * 2 != chip_size - out.size:
+        raise ValueError('The output of ' + str(out.size) + ' pixels is not centered in the chip (offset: ' +
+                         str(out.offset) + ').')
+    return out
+
+
+def output_size(network, chip_size, strict=False):
+    """ Computes the size of the output of a network for square chips of chip_size (see output_features). """
+    return output_features(network, chip_size, strict).size
+
+
+def valid_chip_sizes(network, min_size, max_size):
+    """ Lists the chip sizes between min_size and max_size whose output is aligned and centered in the chip (see
+    output_features with strict).
+    """
+    sizes = []
+    for chip_size in range(min_size, max_size + 1):
+        try:
+            output_features(network, chip_size, strict=True)
+        except ValueError:
+            continue
+        sizes.append(chip_size)
+    return sizes
+
+
+def nearest_chip_size(network, chip_size):
+    """ Finds the valid chip size (see valid_chip_sizes) nearest to chip_size, preferring the smaller one. """
+    for distance in range(0, chip_size):
+        for candidate in [chip_size - distance, chip_size + distance]:
+            if len(valid_chip_sizes(network, candidate, candidate)) > 0:
+                return candidate
+    raise ValueError('The network ' + str(network) + ' does not accept chips near ' + str(chip_size))
+
+
+def largest_chip_size(network, max_size):
+    """ Finds the largest valid chip size up to max_size (see valid_chip_sizes).
+
+    Returns:
+        The chip size and its output size.
+    """
+    for chip_size in range(max_size, 0, -1):
+        if len(valid_chip_sizes(network, chip_size, chip_size)) > 0:
+            return chip_size, output_size(network, chip_size)
+    raise ValueError('The network ' + str(network) + ' does not accept chips up to ' + str(max_size))
+
+
+def tiling(network, chip_size):
+    """ Computes how to tile a raster in chips of chip_size for a network.
+
+    Returns:
+        A dict with the output_size, the border_loss (pixels lost at each side), and the recommended overlap and
+        stride, with which the outputs of the chips are adjacent.
+
+    Raises:
+        ValueError: If the output is not centered in chips of this size (see valid_chip_sizes), so the outputs of
+            the chips cannot be placed by the overlap. The message suggests the nearest valid size.
+    """
+    try:
+        out_size = output_size(network, chip_size, strict=True)
+    except ValueError as error:
+        raise ValueError('Chips of ' + str(chip_size) + ' pixels cannot be tiled with the network ' + str(network) +
+                         ': ' + str(error) + ' Nearest valid chip size: ' +
+                         str(nearest_chip_size(network, chip_size)))
+    overlap = chip_size - out_size
+    return {'chip_size': chip_size,
+            'output_size': out_size,
+            'border_loss': overlap // 2,
+            'overlap': overlap,
+            'stride': chip_size - overlap}
@@ -12,30 +12,33 @@ def f1_score(labels, predictions):
            (tf.compat.v1.metrics.recall(labels, predictions) + tf.compat.v1.metrics.precision(labels, predictions))
 
 
-def define_quality_metrics(labels_1hot, predictions, logits, labels, output, loss, params):
+def define_quality_metrics(labels_1hot, predictions, logits, labels, output, loss, params, auc=True, summaries=True):
     metrics = {}
-    summaries = {}
+    summaries_ops = {}
     with tf.compat.v1.name_scope('quality_metrics'):
         # metrics['f1_score'] = f1_score(labels=labels_1hot, predictions=predictions)
-        # summaries['f1_score'] = tf.compat.v1.summary.scalar('f1-score', metrics['f1_score'][1])
+        # summaries_ops['f1_score'] = tf.compat.v1.summary.scalar('f1-score', metrics['f1_score'][1])
 
         metrics['accuracy'] = tf.compat.v1.metrics.accuracy(labels=labels, predictions=output)
-        summaries['accuracy'] = tf.compat.v1.summary.scalar('accuracy', metrics['accuracy'][1])
 
         cross_entropy = tf.compat.v1.losses.softmax_cross_entropy(onehot_labels=labels_1hot, logits=predictions)
         metrics['cross_entropy'] = tf.compat.v1.metrics.mean(cross_entropy)
-        summaries['cross_entropy'] = tf.compat.v1.summary.scalar('cross_entropy', metrics['cross_entropy'][1])
 
-        metrics['auc-roc'] = tf.compat.v1.metrics.auc(labels=labels_1hot, predictions=predictions)
-        summaries['auc-roc'] = tf.compat.v1.summary.scalar('auc_roc', metrics['auc-roc'][1])
+        if auc:
+            metrics['auc-roc'] = tf.compat.v1.metrics.auc(labels=labels_1hot, predictions=predictions)
 
         # metrics['mean_iou'] = tf.metrics.mean_iou(labels=labels, predictions=predictions,
         #                                                      num_classes=params['num_classes'])
-        # summaries['mean_iou'] = tf.summary.scalar('mean_iou', metrics['mean_iou'][0])
+        # summaries_ops['mean_iou'] = tf.summary.scalar('mean_iou', metrics['mean_iou'][0])
 
-        summaries['loss'] = tf.compat.v1.summary.scalar('loss', loss)
+        if summaries:
+            summaries_ops['accuracy'] = tf.compat.v1.summary.scalar('accuracy', metrics['accuracy'][1])
+            summaries_ops['cross_entropy'] = tf.compat.v1.summary.scalar('cross_entropy', metrics['cross_entropy'][1])
+            if auc:
+                summaries_ops['auc-roc'] = tf.compat.v1.summary.scalar('auc_roc', metrics['auc-roc'][1])
+            summaries_ops['loss'] = tf.compat.v1.summary.scalar('loss', loss)
 
-    return metrics, summaries
+    return metrics, summaries_ops
 
 
 def plot_chips_tensorboard(samples, labels, output, params):
@@ -47,8 +50,7 @@ def plot_chips_tensorboard(samples, labels, output, params):
         if not isinstance(params['bands_plot'][0], list):
             params['bands_plot'] = [params['bands_plot']]
         for i in range(0, params['num_compositions']):
-            bands = tf.constant(params['bands_plot'][i])
-            input_data_vis = tf.transpose(a=tf.nn.embedding_lookup(params=tf.transpose(a=input_data), ids=bands))
+            input_data_vis = tf.gather(input_data, params['bands_plot'][i], axis=-1)
             input_data_vis = tf.image.convert_image_dtype(input_data_vis, tf.uint8, saturate=True)
             tf.compat.v1.summary.image("input_image_c{}".format(i), input_data_vis, max_outputs=params['chips_tensorboard'])
 
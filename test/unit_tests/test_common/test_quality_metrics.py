@@ -0,0 +1,101 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.common.quality_metrics as qm
+
+labels = np.array([[1, 1, 2, 2], [3, 3, 0, 1]])
+predictions = np.array([[1, 2, 2, 2], [3, 1, 2, 0]])
+
+
+def test_confusion_matrix():
+    confusion_matrix = qm.ConfusionMatrix(4, classes_ignore=[0]).update(labels, predictions)
+    expected = [[0, 0, 0, 0],
+                [0, 2, 1, 0],
+                [0, 0, 2, 0],
+                [0, 1, 0, 1]]
+    assert_true(np.array_equal(expected, confusion_matrix.matrix))
+    assert_equal(7, confusion_matrix.total())
+
+
+def test_confusion_matrix_blockwise():
+    full = qm.ConfusionMatrix(4).update(labels, predictions)
+    blocks = qm.ConfusionMatrix(4).update(labels[0], predictions[0])
+    blocks.merge(qm.ConfusionMatrix(4).update(labels[1], predictions[1]))
+    assert_true(np.array_equal(full.matrix, blocks.matrix))
+
+
+def test_metrics():
+    metrics_dict = qm.ConfusionMatrix(4).update(labels, predictions).metrics()
+    assert_almost_equal(5. / 7., metrics_dict['accuracy'])
+    assert_true(np.allclose([2. / 3., 2. / 3., 1.], metrics_dict['precision']))
+    assert_true(np.allclose([2. / 3., 1., .5], metrics_dict['recall']))
+    assert_true(np.allclose([2. / 3., .8, 2. / 3.], metrics_dict['f1_score']))
+    assert_true(np.allclose([.5, 2. / 3., .5], metrics_dict['iou']))
+    expected_agreement = (3 * 3 + 2 * 3 + 2 * 1) / 49.
+    assert_almost_equal((5. / 7. - expected_agreement) / (1 - expected_agreement), metrics_dict['kappa'])
+    assert_true(np.allclose(1., metrics_dict['confusion_matrix'].sum(axis=1)))
+
+
+def test_binned_curves():
+    curve_labels = np.array([1, 1, 2, 2])
+    probabilities = np.array([[0., .9, .1], [0., .6, .4], [0., .3, .7], [0., .55, .45]])
+    curves = qm.BinnedCurves(3, classes_ignore=[0], num_bins=10).update(curve_labels, probabilities)
+    assert_equal(4, curves.histograms[1].sum())
+    fpr, tpr, thresholds = curves.roc_curve(1)
+    assert_equal(0., fpr[0])
+    assert_equal(1., tpr[-1])
+    metrics_dict = curves.metrics(['none', 'a', 'b'])
+    assert_almost_equal(1., metrics_dict['auc_roc']['a'])
+    assert_almost_equal(1., metrics_dict['auc_pr']['a'])
+    assert_false(0 in metrics_dict['auc_roc'])
+
+
+def test_binned_curves_blockwise():
+    curve_labels = np.array([1, 2, 1, 2])
+    probabilities = np.array([[0., .2, .8], [0., .6, .4], [0., .3, .7], [0., .9, .1]])
+    full = qm.BinnedCurves(3).update(curve_labels, probabilities)
+    blocks = qm.BinnedCurves(3).update(curve_labels[:2], probabilities[:2])
+    blocks.merge(qm.BinnedCurves(3).update(curve_labels[2:], probabilities[2:]))
+    assert_true(np.array_equal(full.histograms, blocks.histograms))
+    assert_almost_equal(0., full.metrics(['none', 'a', 'b'])['auc_roc']['a'])
+
+
+class FakeDataset(object):
+    def __init__(self, geo_transform, x_size, y_size):
+        self.geo_transform = geo_transform
+        self.RasterXSize = x_size
+        self.RasterYSize = y_size
+
+    def GetGeoTransform(self):
+        return self.geo_transform
+
+
+def test_aligned_windows():
+    truth_ds = FakeDataset((100., 10., 0., 500., 0., -10.), 10, 8)
+    pred_ds = FakeDataset((120., 10., 0., 480., 0., -10.), 6, 4)
+    windows = list(qm.aligned_windows(pred_ds, truth_ds, block_size=4))
+    assert_equal([((0, 0, 4, 4), (2, 2, 4, 4)), ((4, 0, 2, 4), (6, 2, 2, 4))], windows)
+
+
+def test_aligned_windows_partial_overlap():
+    truth_ds = FakeDataset((100., 10., 0., 500., 0., -10.), 4, 4)
+    pred_ds = FakeDataset((80., 10., 0., 500., 0., -10.), 4, 4)
+    windows = list(qm.aligned_windows(pred_ds, truth_ds, block_size=8))
+    assert_equal([((2, 0, 2, 4), (0, 0, 2, 4))], windows)
+
+
+def test_zonal_confusion_matrix():
+    zones = np.array([[0, 0, 1, 1], [0, 0, 1, -1]])
+    zonal_matrix = qm.ZonalConfusionMatrix(4).update(zones, labels, predictions)
+    assert_equal([0, 1], sorted(zonal_matrix.matrices))
+    assert_true(np.array_equal(qm.ConfusionMatrix(4).update(labels[:, :2], predictions[:, :2]).matrix,
+                               zonal_matrix.matrices[0].matrix))
+    assert_equal(2, zonal_matrix.matrices[1].total())
+
+    rows = zonal_matrix.table(['none', 'a', 'b', 'c'], zone_names=['north', 'south'])
+    assert_equal(['north', 'south'], [row['zone'] for row in rows])
+    assert_almost_equal(.5, rows[0]['accuracy'])
+    assert_almost_equal(1., rows[1]['f1_score_b'])
@@ -0,0 +1,40 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.common.quantization as quant
+
+probabilities = np.array([[[.7, .2, .1, 0.], [.25, .25, .25, .25]]], dtype=np.float32)
+
+
+def test_uint8_round_trip():
+    encoded, metadata = quant.encode_probabilities(probabilities, 'uint8')
+    assert_equal(np.uint8, encoded.dtype)
+    assert_equal((1, 2, 4), encoded.shape)
+    np.testing.assert_allclose(probabilities, quant.decode_probabilities(encoded, metadata), atol=1. / 255)
+
+
+def test_top_k_round_trip():
+    encoded, metadata = quant.encode_probabilities(probabilities, 'top_k', top_k=2, extra_band='confidence')
+    assert_equal((1, 2, 5), encoded.shape)
+    np.testing.assert_array_equal([0, 1], encoded[0, 0, :2])
+    decoded = quant.decode_probabilities(encoded, metadata)
+    np.testing.assert_allclose([.7, .2, .05, .05], decoded[0, 0], atol=1. / 255)
+    np.testing.assert_allclose([.7, .25], quant.decode_extra_band(encoded, metadata)[0], atol=1. / 255)
+
+
+def test_entropy_band():
+    encoded, metadata = quant.encode_probabilities(probabilities, 'float32', extra_band='entropy')
+    np.testing.assert_allclose(probabilities, quant.decode_probabilities(encoded, metadata))
+    assert_almost_equal(1., quant.decode_extra_band(encoded, metadata)[0, 1], places=5)
+
+
+def test_decode_without_metadata():
+    np.testing.assert_array_equal(probabilities, quant.decode_probabilities(probabilities, {}))
+
+
+@raises(ValueError)
+def test_unknown_format():
+    quant.encode_probabilities(probabilities, 'float16')
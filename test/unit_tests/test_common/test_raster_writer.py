@@ -0,0 +1,48 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+import tempfile
+from osgeo import gdal
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.common.raster_writer as rw
+
+
+def _base_raster(out_dir, x_size=10, y_size=8):
+    base_path = path.join(out_dir, 'base.tif')
+    rw.write_raster(base_path, np.zeros((y_size, x_size), dtype=np.uint8), (100., 1., 0., 200., 0., -1.), '')
+    return base_path
+
+
+def _batches(chips, coords, batch_size=2):
+    for start in range(0, len(chips), batch_size):
+        yield {'predict': chips[start:(start + batch_size)], 'coords': coords[start:(start + batch_size)]}
+
+
+def test_async_prediction_writer():
+    out_dir = tempfile.mkdtemp()
+    out_path = path.join(out_dir, 'predict.tif')
+    # Windows of 6x6 with an overlap of 2 (output of 4x4) over a raster of 10x8: the output is 8x6.
+    coords = [{'upper_row': row, 'left_col': col} for col in [0, 4] for row in [0, 2]]
+    chips = np.stack([np.full((4, 4, 1), pos + 1, dtype=np.int32) for pos in range(len(coords))])
+
+    with rw.AsyncPredictionWriter(_base_raster(out_dir), {'predict': out_path}, (2, 2), max_queue=1) as writer:
+        for batch in _batches(chips, coords):
+            writer.put(batch)
+
+    out_ds = gdal.Open(out_path)
+    assert_equal((8, 6), (out_ds.RasterXSize, out_ds.RasterYSize))
+    assert_equal((101., 1., 0., 199., 0., -1.), out_ds.GetGeoTransform())
+    result = out_ds.ReadAsArray()
+    assert_equal(1, result[0, 0])
+    assert_equal(2, result[5, 0])
+    assert_equal(3, result[0, 7])
+    assert_equal(4, result[5, 7])
+
+
+def test_async_prediction_writer_error():
+    out_dir = tempfile.mkdtemp()
+    writer = rw.AsyncPredictionWriter(_base_raster(out_dir), {'predict': path.join(out_dir, 'predict.tif')})
+    writer.put({'coords': [{'upper_row': 0, 'left_col': 0}]})
+    assert_raises(KeyError, writer.close)
@@ -0,0 +1,78 @@
+from nose.tools import *
+from os import path
+import math
+import sys
+import tempfile
+import affine
+import geopandas
+import numpy as np
+import rasterio
+import shapely.geometry
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.dataset.centroids_chips as cchips
+
+# Pixels of 10 x 10 map units, from (1000, 2000) at the upper left corner of a raster of 20 rows x 30 columns.
+transform = affine.Affine(10., 0., 1000., 0., -10., 2000.)
+height, width = 20, 30
+
+
+def _write_labels(labels_path, labels):
+    with rasterio.open(labels_path, 'w', driver='GTiff', height=height, width=width, count=1,
+                       dtype=labels.dtype.name, crs='EPSG:31982', transform=transform) as dst:
+        dst.write(labels, 1)
+
+
+def _write_points(points_path, coords):
+    points = geopandas.GeoDataFrame({'id': list(range(len(coords)))},
+                                    geometry=[shapely.geometry.Point(x, y) for x, y in coords], crs='EPSG:31982')
+    points.to_file(points_path, driver='GPKG')
+
+
+def test_points_to_pixels():
+    x = np.array([1005., 1015., 1299.9, 995.])
+    y = np.array([1995., 1980., 1800.1, 1995.])
+    pixels = cchips.points_to_pixels(x, y, transform)
+    assert_equal([[0, 0], [2, 1], [19, 29], [0, -1]], pixels.tolist())
+    assert_equal(np.int64, pixels.dtype)
+
+
+def test_read_centroids_bbox():
+    points_path = path.join(tempfile.mkdtemp(), 'centroids.gpkg')
+    _write_points(points_path, [(1005., 1995.), (1150., 1900.), (1400., 1900.), (1150., 1500.)])
+    points = cchips.read_centroids(points_path, bbox=(1000., 1800., 1300., 2000.))
+    assert_equal([0, 1], points['id'].tolist())
+    assert_equal(4, len(cchips.read_centroids(points_path)))
+
+
+def test_generate_chips():
+    out_dir = tempfile.mkdtemp()
+    labels = np.arange(height * width, dtype=np.int32).reshape(height, width)
+    raster = np.dstack([labels * 2., labels * 3.]).astype(np.float32)
+    labels_path = path.join(out_dir, 'labels.tif')
+    points_path = path.join(out_dir, 'centroids.gpkg')
+    _write_labels(labels_path, labels)
+    # Within the raster: (10, 15), (3, 4), (16, 27) and (2, 2), whose window crosses the upper left corner. On the
+    # right edge of the raster (column 30), and outside of it.
+    _write_points(points_path, [(1155., 1895.), (1045., 1965.), (1275., 1835.), (1025., 1975.), (1300., 1900.),
+                                (1500., 1900.)])
+
+    win_size = 5
+    generator = cchips.CentroidsChipGenerator({'raster_array': raster, 'labels_array': labels, 'win_size': win_size,
+                                               'shp_path': points_path, 'labels_tif': labels_path})
+    chips = generator.generate_chips()
+    assert_equal([[10, 15], [3, 4], [16, 27]], generator.ij_samples.tolist())
+    assert_equal((3, win_size, win_size, 2), chips['chips'].shape)
+    assert_equal((3, win_size, win_size), chips['labels'].shape)
+
+    # The same windows as the slicing of each window (the former extract_windows).
+    for pos, (row, col) in enumerate(generator.ij_samples):
+        upper_row = row - math.floor(win_size / 2)
+        left_col = col - math.ceil(win_size / 2)
+        coords = {'upper_row': upper_row, 'lower_row': upper_row + win_size,
+                  'left_col': left_col, 'right_col': left_col + win_size}
+        assert_equal(coords, chips['coords'][pos])
+        np.testing.assert_array_equal(raster[upper_row:upper_row + win_size, left_col:left_col + win_size],
+                                      chips['chips'][pos])
+        np.testing.assert_array_equal(labels[upper_row:upper_row + win_size, left_col:left_col + win_size],
+                                      chips['labels'][pos])
@@ -0,0 +1,31 @@
+from nose.tools import *
+from os import path
+import sys
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.dataset.cross_validation as cv
+
+
+class FakeDatasetGenerator(object):
+    def __init__(self, coords):
+        self.chips_struct = {'coords': coords}
+        self.description = None
+
+
+def test_folds_do_not_share_pixels():
+    # Overlapping sequential chips (64 pixels, step 40) over a raster of 600 x 600, many crossing the block borders.
+    coords = [{'upper_row': row, 'lower_row': row + 64, 'left_col': col, 'right_col': col + 64}
+              for row in range(0, 537, 40) for col in range(0, 537, 40)]
+    builder = cv.CrossValidationBuilder(FakeDatasetGenerator(coords), {'num_folds': 3, 'block_size': 200,
+                                                                       'random_seed': 0})
+    folds = builder.assign_folds()
+
+    coverage = np.zeros((3, 600, 600), dtype=bool)
+    for coord, fold in zip(coords, folds):
+        if fold >= 0:
+            coverage[fold, coord['upper_row']:coord['lower_row'], coord['left_col']:coord['right_col']] = True
+    assert_equal(set([0, 1, 2]), set(folds[folds >= 0]))
+    for fold_a in range(3):
+        for fold_b in range(fold_a + 1, 3):
+            assert_false(np.any(coverage[fold_a] & coverage[fold_b]))
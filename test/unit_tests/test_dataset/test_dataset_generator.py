@@ -0,0 +1,64 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+import tempfile
+import tensorflow as tf
+from osgeo import gdal
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.dataset.dataset_generator as dsgen
+
+
+def test_read_chips():
+    chips = np.random.rand(3, 8, 8, 4).astype(np.float32)
+    labels = np.random.randint(0, 5, (3, 8, 8, 1)).astype(np.int32)
+    tfrecord_path = path.join(tempfile.mkdtemp(), 'chips_valid.tfrecord')
+    with tf.io.TFRecordWriter(tfrecord_path) as writer:
+        for pos in range(len(chips)):
+            writer.write(dsgen.serialize_chip(chips[pos], labels[pos]))
+
+    split = dsgen.read_chips(tfrecord_path)
+    np.testing.assert_array_equal(chips, split['chips'])
+    np.testing.assert_array_equal(labels, split['labels'])
+
+
+def _write_raster(out_path, array, data_type):
+    out_ds = gdal.GetDriverByName('GTiff').Create(out_path, array.shape[1], array.shape[0], array.shape[2], data_type)
+    for band in range(array.shape[2]):
+        out_ds.GetRasterBand(band + 1).WriteArray(array[:, :, band])
+    out_ds.FlushCache()
+    out_ds = None
+
+
+def test_generate_chips_parallel():
+    out_dir = tempfile.mkdtemp()
+    rasters = []
+    labels = []
+    windows = set()
+    for scene in range(2):
+        rows, cols = np.meshgrid(np.arange(40), np.arange(40), indexing='ij')
+        # The pixel values identify the scene, the pixel and the band.
+        image = np.stack([scene * 10000 + rows * 100 + cols + band * 0.25 for band in range(3)],
+                         axis=-1).astype(np.float32)
+        rasters.append(path.join(out_dir, 'raster' + str(scene) + '.tif'))
+        labels.append(path.join(out_dir, 'labels' + str(scene) + '.tif'))
+        _write_raster(rasters[-1], image, gdal.GDT_Float32)
+        _write_raster(labels[-1], np.ones((40, 40, 1), dtype=np.int32), gdal.GDT_Int32)
+        windows.update(float(image[row, col, 0]) for row in range(0, 40, 10) for col in range(0, 40, 10))
+
+    generator = dsgen.DatasetGenerator(rasters, labels)
+    generator.generate_chips_parallel({'win_size': 10}, out_dir, 'dataset', num_workers=2, tolerance=None,
+                                      random_seed=0)
+
+    splits = {suf: dsgen.read_chips(path.join(out_dir, 'dataset_' + suf + '.tfrecord'))
+              for suf in ['train', 'test', 'valid']}
+    chips = np.concatenate([split['chips'] for split in splits.values()])
+    assert_equal((32, 10, 10, 3), chips.shape)
+    assert_equal(windows, set(chips[:, 0, 0, 0].tolist()))
+    for suf, split in splits.items():
+        assert_equal(len(split['chips']), generator.get_samples()[suf]['count'])
+
+    valid = np.load(path.join(out_dir, 'dataset_valid.npz'))
+    np.testing.assert_array_equal(splits['valid']['chips'], valid['chips'])
+    np.testing.assert_array_equal(splits['valid']['labels'], valid['labels'])
@@ -0,0 +1,142 @@
+from nose.tools import *
+from os import path
+import os
+import numpy as np
+import sys
+import tempfile
+import geopandas
+import shapely.geometry
+from osgeo import gdal
+from osgeo import osr
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.dataset.image_utils as iutils
+
+geo_transform = (1000., 10., 0., 2000., 0., -10.)
+epsg = 32722
+
+
+def _write_raster(out_path, array, geo_transform=geo_transform):
+    out_ds = gdal.GetDriverByName('GTiff').Create(out_path, array.shape[2], array.shape[1], array.shape[0],
+                                                  gdal.GDT_Float32)
+    out_ds.SetGeoTransform(geo_transform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    out_ds.SetProjection(srs.ExportToWkt())
+    for band in range(array.shape[0]):
+        out_ds.GetRasterBand(band + 1).WriteArray(array[band])
+    out_ds.FlushCache()
+    out_ds = None
+
+
+def _read_raster(raster_path):
+    raster_ds = gdal.Open(raster_path)
+    array = raster_ds.ReadAsArray()
+    geo = raster_ds.GetGeoTransform()
+    raster_ds = None
+    return array.reshape((-1,) + array.shape[-2:]), geo
+
+
+def _stack_inputs():
+    # The directory has XML special characters, which must be escaped in the VRT sources.
+    out_dir = path.join(tempfile.mkdtemp(), 'a&b<c')
+    os.makedirs(out_dir)
+    first = np.arange(2 * 5 * 6, dtype=np.float32).reshape(2, 5, 6)
+    second = -np.arange(5 * 6, dtype=np.float32).reshape(1, 5, 6)
+    files = [path.join(out_dir, 'first.tif'), path.join(out_dir, 'second.tif')]
+    _write_raster(files[0], first)
+    _write_raster(files[1], second)
+    return out_dir, files, first, second
+
+
+def test_build_stacked_vrt():
+    out_dir, files, first, second = _stack_inputs()
+    vrt_path = iutils.build_stacked_vrt(files, path.join(out_dir, 'stack.vrt'))
+    array, geo = _read_raster(vrt_path)
+    np.testing.assert_array_equal(np.concatenate([first, second]), array)
+    assert_equal(geo_transform, geo)
+
+    first_bands = iutils.build_stacked_vrt(files, '/vsimem/first_bands.vrt', all_bands=False)
+    array, _ = _read_raster(first_bands)
+    np.testing.assert_array_equal(np.concatenate([first[:1], second]), array)
+    gdal.Unlink(first_bands)
+
+    iutils.materialize_raster(vrt_path, path.join(out_dir, 'stack.tif'), block_size=16)
+    array, geo = _read_raster(path.join(out_dir, 'stack.tif'))
+    np.testing.assert_array_equal(np.concatenate([first, second]), array)
+    assert_equal(geo_transform, geo)
+
+
+def test_virtual_stacks_match_eager_stacks():
+    out_dir, files, first, second = _stack_inputs()
+    for stack, expected in [(iutils.stack_temporal_images, np.concatenate([first, second])),
+                            (iutils.stack_bands, np.concatenate([first[:1], second]))]:
+        virtual_path = stack(files, path.join(out_dir, stack.__name__ + '.vrt'), virtual=True)
+        eager_path = stack(files, path.join(out_dir, stack.__name__ + '.tif'))
+        virtual, virtual_geo = _read_raster(virtual_path)
+        eager, eager_geo = _read_raster(eager_path)
+        np.testing.assert_array_equal(expected, virtual)
+        np.testing.assert_array_equal(eager, virtual)
+        assert_equal(eager_geo, virtual_geo)
+
+
+def _clip_input():
+    out_dir = tempfile.mkdtemp()
+    # Positive values, so the no data value (-1) marks the pixels out of the polygons.
+    array = np.arange(2 * 10 * 12, dtype=np.float32).reshape(2, 10, 12) + 1
+    raster_path = path.join(out_dir, 'raster.tif')
+    _write_raster(raster_path, array)
+    return out_dir, raster_path, array
+
+
+def _l_shape():
+    # Rows 1 to 4 and columns 2 to 4 (aligned to the pixels), without rows 3 and 4 of column 4.
+    return shapely.geometry.box(1020., 1950., 1050., 1990.).difference(shapely.geometry.box(1040., 1950., 1050., 1970.))
+
+
+def _expected_l_shape_clip(array):
+    expected = array[:, 1:5, 2:5].copy()
+    expected[:, 2:4, 2] = -1
+    return expected
+
+
+def test_clip_img_by_network_output():
+    out_dir, raster_path, array = _clip_input()
+    clipped_path = path.join(out_dir, 'clipped.tif')
+    iutils.clip_img_by_network_output(raster_path, (4, 2), clipped_path)
+    clipped, geo = _read_raster(clipped_path)
+    np.testing.assert_array_equal(array[:, 1:9, 2:10], clipped)
+    np.testing.assert_allclose((1020., 10., 0., 1990., 0., -10.), geo)
+
+    # Onto itself.
+    iutils.clip_img_by_network_output(raster_path, (4, 2))
+    clipped, geo = _read_raster(raster_path)
+    np.testing.assert_array_equal(array[:, 1:9, 2:10], clipped)
+    np.testing.assert_allclose((1020., 10., 0., 1990., 0., -10.), geo)
+
+
+def test_clip_by_polygon():
+    out_dir, raster_path, array = _clip_input()
+    clipped_path = path.join(out_dir, 'clipped.tif')
+    geoms = geopandas.GeoDataFrame(geometry=[_l_shape()], crs='EPSG:' + str(epsg))
+    iutils.clip_by_polygon(raster_path, geoms, clipped_path, no_data=-1)
+    clipped, geo = _read_raster(clipped_path)
+    np.testing.assert_array_equal(_expected_l_shape_clip(array), clipped)
+    np.testing.assert_allclose((1020., 10., 0., 1990., 0., -10.), geo)
+
+
+def test_clip_by_aggregated_polygons_onto_itself():
+    out_dir, raster_path, array = _clip_input()
+    # The L shape split in two polygons, aggregated by the clip.
+    shape_path = path.join(out_dir, 'polygons.shp')
+    geoms = geopandas.GeoDataFrame(geometry=[shapely.geometry.box(1020., 1970., 1050., 1990.),
+                                             shapely.geometry.box(1020., 1950., 1040., 1970.)],
+                                   crs='EPSG:' + str(epsg))
+    geoms.to_file(shape_path)
+
+    iutils.clip_by_aggregated_polygons(raster_path, shape_path, raster_path, band_names=['a', 'b'], no_data=-1)
+    clipped, geo = _read_raster(raster_path)
+    np.testing.assert_array_equal(_expected_l_shape_clip(array), clipped)
+    np.testing.assert_allclose((1020., 10., 0., 1990., 0., -10.), geo)
+    assert_equal(['a', 'b'], [gdal.Open(raster_path).GetRasterBand(band).GetDescription() for band in [1, 2]])
+    assert_equal([], [name for name in os.listdir(out_dir) if name.startswith('.tmp_')])
@@ -1,6 +1,7 @@
 from nose.tools import *
 from os import path
 import sys
+from osgeo import gdal
 # import warnings
 
 sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
@@ -58,3 +59,15 @@ class TestPreprocessor():
         })
         assert_equal(8, new_raster.shape[2])
         assert_equal(7, self.preproc.get_position_index_band('func'))
+
+
+    def test_save_stacked_raster_tiled(self):
+        output_file = path.join(self.output_dir, 'stacked.tif')
+        self.preproc.save_stacked_raster(output_file, params={'block_size': 128})
+        assert_true(path.exists(output_file))
+
+        out_ds = gdal.Open(output_file)
+        assert_equal(7, out_ds.RasterCount)
+        assert_equal([128, 128], out_ds.GetRasterBand(1).GetBlockSize())
+        assert_equal('DEFLATE', out_ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'])
+        out_ds = None
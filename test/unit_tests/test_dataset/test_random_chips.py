@@ -0,0 +1,42 @@
+from nose.tools import *
+from os import path
+import sys
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.dataset.random_chips as rdmchips
+
+
+def _labels():
+    labels = np.zeros((100, 80), dtype=np.int32)
+    labels[:, 40:] = 1
+    labels[90:, :10] = 2
+    mask = np.zeros(labels.shape, dtype=bool)
+    mask[:5, :] = True
+    return np.ma.masked_array(labels, mask)
+
+
+def test_balanced_quotas_redistributes_surplus():
+    assert_equal([10, 45, 45], rdmchips.balanced_quotas(100, [10, 1000, 1000]))
+    assert_equal([3, 5], rdmchips.balanced_quotas(20, [3, 5]))
+
+
+def test_stratified_sample_respects_quotas_and_classes():
+    labels = _labels()
+    samples = rdmchips.stratified_sample(labels, [0, 1, 2], [30, 20, 15], block_rows=16, seed=7)
+
+    assert_equal((65, 2), samples.shape)
+    assert_equal(np.int32, samples.dtype)
+    assert_equal(len(np.unique(samples, axis=0)), 65)
+    sampled_labels = labels[samples[:, 0], samples[:, 1]]
+    assert_false(np.any(np.ma.getmaskarray(sampled_labels)))
+    assert_equal([30, 20, 15], np.bincount(sampled_labels.data, minlength=3).tolist())
+
+
+def test_stratified_sample_is_reproducible():
+    labels = _labels()
+    first = rdmchips.stratified_sample(labels, [None], [50], block_rows=7, seed=1)
+    second = rdmchips.stratified_sample(labels, [None], [50], block_rows=33, seed=1)
+    assert_true(np.array_equal(first, rdmchips.stratified_sample(labels, [None], [50], block_rows=7, seed=1)))
+    assert_equal(50, len(second))
+    assert_true(np.all(first[:, 0] >= 5))
@@ -0,0 +1,48 @@
+from nose.tools import *
+from os import path
+import sys
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.dataset.utils as dsutils
+
+
+def test_split_indexes_is_a_partition():
+    train, test, valid = dsutils.split_indexes(100, perc_test=20, perc_val=10, random_seed=0)
+    assert_equal((70, 20, 10), (len(train), len(test), len(valid)))
+    np.testing.assert_array_equal(np.arange(100), np.sort(np.concatenate([train, test, valid])))
+
+
+def test_block_split_keeps_blocks_together():
+    coords = [{'upper_row': row, 'lower_row': row + 50, 'left_col': col, 'right_col': col + 50}
+              for row in range(0, 400, 50) for col in range(0, 400, 50)]
+    block_ids = dsutils.chip_block_ids(coords, 100)
+    groups = dsutils.block_split(block_ids, [60, 20, 20], random_seed=1)
+    assert_equal(16, len(np.unique(block_ids)))
+    for block in np.unique(block_ids):
+        assert_equal(1, len(np.unique(groups[block_ids == block])))
+    assert_equal(set([0, 1, 2]), set(np.unique(groups)))
+
+
+def test_chip_block_ids_discards_chips_crossing_blocks():
+    # Chips of 64 pixels: the chips starting at 48 cross the border of the blocks at 100.
+    coords = [{'upper_row': row, 'lower_row': row + 64, 'left_col': col, 'right_col': col + 64}
+              for row in [0, 48, 100] for col in [0, 48, 100]]
+    block_ids = dsutils.chip_block_ids(coords, 100)
+    crossing = [coord['upper_row'] == 48 or coord['left_col'] == 48 for coord in coords]
+    np.testing.assert_array_equal(np.array(crossing), block_ids < 0)
+
+
+def test_discretize_values():
+    data = np.array([-1., 0.5, 0.51, 1.5, 2.2, 2.6, 7.])
+    np.testing.assert_array_equal([1, 1, 1, 1, 2, 3, 3], dsutils.discretize_values(data, 3, start_value=1))
+    np.testing.assert_array_equal([0, 0, 1, 1, 2, 3, 3], dsutils.discretize_values(data, 3))
+
+
+def test_grouping_lut():
+    class_names = ['cloud', 'deforestation', 'forest', 'river', 'lake']
+    classes_interest = ['non_class', 'forest', ['river', 'lake'], 'deforestation']
+    lut = dsutils.grouping_lut(class_names, classes_interest)
+    np.testing.assert_array_equal([0, 1, 4, 2, 3, 3], lut)
+    np.testing.assert_array_equal([[0, 3], [1, 4]], dsutils.remap_values(np.array([[0, 4], [1, 2]]), lut))
+    np.testing.assert_array_equal([1, 2, 3, 4, 5], dsutils.grouping_lut(class_names)[1:])
@@ -0,0 +1,36 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+import tensorflow as tf
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.dataset_loader as dsloader
+
+
+def test_tta_batch_stacks_the_variants():
+    images = tf.random.uniform([2, 8, 8, 3])
+    batch = dsloader.tta_batch(images, ['rot90', 'flip_left_right'])
+    assert_equal([6, 8, 8, 3], batch.shape.as_list())
+    np.testing.assert_array_equal(tf.image.rot90(images).numpy(), batch[2:4].numpy())
+
+
+def test_tta_merge_inverts_the_operations():
+    images = tf.random.uniform([2, 8, 8, 3])
+    tta_ops = list(dsloader.tta_operations.keys())
+    merged = dsloader.tta_merge(dsloader.tta_batch(images, tta_ops), tta_ops)
+    np.testing.assert_allclose(images.numpy(), merged.numpy(), rtol=1e-6)
+
+
+def test_tta_merge_needs_centered_outputs():
+    # A per-pixel model which loses one pixel at each side keeps the variants aligned. If it loses two pixels at
+    # the top and left and none at the bottom and right, the inverted variants are shifted from each other.
+    images = tf.random.uniform([1, 8, 8, 1])
+    tta_ops = ['flip_left_right', 'rot180']
+    centered = lambda batch: batch[:, 1:7, 1:7]
+    shifted = lambda batch: batch[:, 2:8, 2:8]
+    np.testing.assert_allclose(centered(images).numpy(),
+                               dsloader.tta_merge(centered(dsloader.tta_batch(images, tta_ops)), tta_ops).numpy(),
+                               rtol=1e-6)
+    misaligned = dsloader.tta_merge(shifted(dsloader.tta_batch(images, tta_ops)), tta_ops)
+    assert_greater(np.abs(shifted(images).numpy() - misaligned.numpy()).max(), 1e-3)
@@ -0,0 +1,20 @@
+from nose.tools import *
+from os import path
+import sys
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.distribution as distribution
+
+
+def test_local_cluster_config_with_parameter_server():
+    tf_config = distribution.local_cluster_config(3, 0, task_type='chief', num_ps=1)
+    assert_equal(['localhost:12345'], tf_config['cluster']['chief'])
+    assert_equal(2, len(tf_config['cluster']['worker']))
+    assert_equal(['localhost:12348'], tf_config['cluster']['ps'])
+    assert_equal(3, distribution.num_workers(tf_config))
+
+
+def test_scale_learning_rate():
+    assert_equal(0.001, distribution.scale_learning_rate(0.001, 4))
+    assert_almost_equal(0.004, distribution.scale_learning_rate(0.001, 4, 'linear'))
+    assert_almost_equal(0.002, distribution.scale_learning_rate(0.001, 4, 'sqrt'))
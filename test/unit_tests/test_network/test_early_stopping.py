@@ -0,0 +1,29 @@
+from nose.tools import *
+from os import path
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.early_stopping as early_stopping
+
+
+def test_early_stopping_patience_and_min_delta():
+    tracker = early_stopping.EarlyStopping('loss', patience=2, min_delta=.01)
+    assert_true(tracker.update(1., step=1))
+    assert_false(tracker.update(.995, step=2))
+    assert_false(tracker.should_stop())
+    assert_false(tracker.update(.999, step=3))
+    assert_true(tracker.should_stop())
+    assert_equal(1, tracker.best_step)
+
+
+def test_best_checkpoints_keeps_top_k():
+    model_dir = tempfile.mkdtemp()
+    best = early_stopping.BestCheckpoints(path.join(model_dir, 'best'), 'eval_metrics/accuracy', keep=2)
+    for step, accuracy in [(1, .5), (2, .7), (3, .6), (4, .4)]:
+        ckpt = path.join(model_dir, 'model.ckpt-' + str(step))
+        open(ckpt + '.index', 'w').close()
+        best.add(ckpt, accuracy, step)
+    kept = sorted(f for f in os.listdir(path.join(model_dir, 'best')) if f.endswith('.index'))
+    assert_equal(['model.ckpt-2.index', 'model.ckpt-3.index'], kept)
@@ -0,0 +1,72 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+import tempfile
+import tensorflow as tf
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.keras_layers as klayers
+import deepgeo.networks.keras_models as keras_models
+import deepgeo.networks.shape_inference as shape_inference
+
+params = {'num_classes': 2, 'bands': 10, 'num_masks': 2, 'dropout_rate': 0.5, 'l2_reg_rate': 0.0005}
+
+
+def test_output_size_matches_shape_inference():
+    chip_sizes = {'fcn': [64, 100], 'unet': [188, 300]}
+    for network in sorted(keras_models.predefModels):
+        for chip_size in chip_sizes['unet' if 'unet' in network else 'fcn']:
+            model = keras_models.build_model(network, dict(params, chip_size=chip_size))
+            assert_equal((None, shape_inference.output_size(network, chip_size),
+                          shape_inference.output_size(network, chip_size), params['num_classes']),
+                         tuple(model.output_shape))
+            tf.keras.backend.clear_session()
+
+
+def _small_model():
+    samples = tf.keras.Input(shape=[8, 8, 3], name='samples')
+    conv, pool = klayers.conv_pool_layer(samples, 4, params, name='1_1')
+    logits = tf.keras.layers.Conv2D(params['num_classes'], 1, name='logits')(pool)
+    return tf.keras.Model(inputs=samples, outputs=logits)
+
+
+def _write_estimator_checkpoint(model, checkpoint_path, skip=None):
+    # Variables named as in the estimator models (scope/layer/weight), with the optimizer slots and the global step.
+    values = {}
+    with tf.Graph().as_default():
+        for layer in model.layers:
+            for weight in layer.weights:
+                name = layer.name.replace('.', '/') + '/' + weight.name.split('/')[-1].split(':')[0]
+                if name == skip:
+                    continue
+                values[name] = np.random.rand(*weight.shape).astype(np.float32)
+                tf.compat.v1.get_variable(name, initializer=values[name])
+                tf.compat.v1.get_variable(name + '/Adam', initializer=np.zeros(weight.shape, dtype=np.float32))
+        tf.compat.v1.train.get_or_create_global_step()
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            tf.compat.v1.train.Saver().save(session, checkpoint_path)
+    return values
+
+
+def test_load_estimator_checkpoint():
+    model = _small_model()
+    model_dir = tempfile.mkdtemp()
+    values = _write_estimator_checkpoint(model, path.join(model_dir, 'model.ckpt'))
+    assert_in('Conv_layer_1_1/convolution_1_1/kernel', values)
+    assert_true(keras_models.is_estimator_checkpoint(tf.train.latest_checkpoint(model_dir)))
+
+    keras_models.load_estimator_checkpoint(model, model_dir)
+    layer = model.get_layer('Conv_layer_1_1.convolution_1_1')
+    np.testing.assert_array_equal(values['Conv_layer_1_1/convolution_1_1/kernel'], layer.kernel.numpy())
+    layer = model.get_layer('Conv_layer_1_1.batch_norm_1_1')
+    np.testing.assert_array_equal(values['Conv_layer_1_1/batch_norm_1_1/moving_variance'],
+                                  layer.moving_variance.numpy())
+
+
+def test_load_estimator_checkpoint_missing_variable():
+    model = _small_model()
+    checkpoint_path = path.join(tempfile.mkdtemp(), 'model.ckpt')
+    _write_estimator_checkpoint(model, checkpoint_path, skip='logits/bias')
+    assert_raises(ValueError, keras_models.load_estimator_checkpoint, model, checkpoint_path)
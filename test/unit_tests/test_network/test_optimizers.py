@@ -0,0 +1,76 @@
+from nose.tools import *
+from os import path
+import numpy as np
+import sys
+import tensorflow as tf
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.optimizers as optim
+
+params = {'epochs': 10, 'decay_steps': 100, 'decay_rate': 0.1, 'batch_size': 10, 'learning_rate_decay': True}
+
+
+def test_schedule_name():
+    assert_equal('exponential', optim.schedule_name(params))
+    assert_equal('constant', optim.schedule_name(dict(params, learning_rate_decay=False)))
+    assert_equal('cosine', optim.schedule_name(dict(params, lr_schedule='cosine')))
+
+
+def test_exponential():
+    assert_almost_equal(0.01, float(optim.exponential(0.1, 100., params)), places=6)
+
+
+def test_cosine():
+    cosine_params = dict(params, warmup_steps=10)
+    assert_almost_equal(0.01, float(optim.cosine(0.1, 0., cosine_params)), places=6)
+    assert_almost_equal(0.1, float(optim.cosine(0.1, 10., cosine_params)), places=6)
+    assert_almost_equal(0.05, float(optim.cosine(0.1, 505., cosine_params)), places=6)
+    assert_almost_equal(0., float(optim.cosine(0.1, 1000., cosine_params)), places=6)
+
+
+def test_one_cycle():
+    assert_almost_equal(0.004, float(optim.one_cycle(0.1, 0., params)), places=6)
+    assert_almost_equal(0.1, float(optim.one_cycle(0.1, 300., params)), places=6)
+    assert_almost_equal(0.00001, float(optim.one_cycle(0.1, 1000., params)), places=6)
+
+
+def test_warmup_linear():
+    large_batch = dict(params, global_batch_size=40)
+    assert_almost_equal(0.1, float(optim.warmup_linear(0.1, 0., large_batch)), places=6)
+    assert_almost_equal(0.25, float(optim.warmup_linear(0.1, 50., large_batch)), places=6)
+    assert_almost_equal(0.4, float(optim.warmup_linear(0.1, 100., large_batch)), places=6)
+    assert_almost_equal(0., float(optim.warmup_linear(0.1, 1000., large_batch)), places=6)
+
+
+@raises(ValueError)
+def test_schedule_needs_epochs():
+    optim.cosine(0.1, 0., dict(params, epochs=None))
+
+
+def test_keras_optimizers():
+    schedule = optim.StepSchedule(optim.cosine, 0.1, params)
+    for optimizer in [optim.adam, optim.adamw, optim.sgd_momentum, optim.lamb]:
+        assert_is_not_none(optimizer(schedule, params, 'keras'))
+    assert_almost_equal(0.1, float(schedule(0)), places=6)
+
+
+def test_adamw_estimator_mirrored():
+    # Two logical CPUs, so the step runs in two replicas (if TF is not initialized yet by other tests).
+    try:
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * 2)
+    except RuntimeError:
+        pass
+    devices = [device.name for device in tf.config.list_logical_devices('CPU')]
+
+    with tf.Graph().as_default():
+        strategy = tf.distribute.MirroredStrategy(devices)
+        with strategy.scope():
+            var = tf.compat.v1.get_variable('w', initializer=tf.constant([1., 2.]))
+            optimizer = optim.adamw(0.1, {'weight_decay': 0.5})
+            train_op = strategy.extended.call_for_each_replica(lambda: optimizer.minimize(tf.reduce_sum(var * 3.)))
+            with tf.compat.v1.Session() as session:
+                session.run(tf.compat.v1.global_variables_initializer())
+                session.run(train_op)
+                # Decayed once by 0.1 * 0.5, and then moved by the learning rate (first Adam step).
+                np.testing.assert_allclose([0.85, 1.8], session.run(var), rtol=1e-5)
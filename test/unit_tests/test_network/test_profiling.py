@@ -0,0 +1,64 @@
+from nose.tools import *
+from os import path
+import sys
+import tempfile
+import tensorflow as tf
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.profiling as profiling
+
+
+def test_step_profiler_report():
+    out_dir = tempfile.mkdtemp()
+    profiler = profiling.StepProfiler(out_dir, batch_size=10)
+    profiler.record(1, input_wait=5., compute=5.)
+    for step in range(2, 6):
+        profiler.record(step, input_wait=.3, compute=.1, summary=.1)
+    report = profiler.summary()
+    assert_equal(5, report['steps'])
+    assert_almost_equal(.5, report['step_time_mean'])
+    assert_almost_equal(20., report['examples_per_sec'])
+    assert_almost_equal(.6, report['input_bound_ratio'])
+
+    profiler.write_report()
+    assert_true(path.exists(path.join(out_dir, 'profiling_report.csv')))
+    assert_true(path.exists(path.join(out_dir, 'profiling_steps.csv')))
+
+
+def test_step_profiler_report_without_input_wait():
+    profiler = profiling.StepProfiler(tempfile.mkdtemp(), batch_size=10)
+    for step in range(1, 4):
+        profiler.record(step, input_wait=None, compute=.5)
+    report = profiler.summary()
+    assert_is_none(report['input_wait_mean'])
+    assert_is_none(report['input_bound_ratio'])
+    assert_in('input_wait_note', report)
+    assert_almost_equal(.5, report['step_time_mean'])
+
+
+def test_step_profiler_report_with_sampled_input_wait():
+    profiler = profiling.StepProfiler(tempfile.mkdtemp(), batch_size=10)
+    profiler.record(1, input_wait=None, compute=5.)
+    profiler.record(2, input_wait=.2, compute=.2)
+    profiler.record(3, input_wait=None, compute=.6)
+    report = profiler.summary()
+    assert_almost_equal(.2, report['input_wait_mean'])
+    assert_almost_equal(.5, report['input_bound_ratio'])
+    assert_almost_equal(.5, report['step_time_mean'])
+    assert_in('1 of 2', report['input_wait_note'])
+
+
+def test_profiling_hook_traced_steps():
+    hook = profiling.ProfilingHook(profiling.StepProfiler(tempfile.mkdtemp(), 10), trace_every=10)
+    assert_equal([10, 20], [step for step in range(1, 25) if hook.traced(step)])
+    hook = profiling.ProfilingHook(profiling.StepProfiler(tempfile.mkdtemp(), 10, trace_steps=[5, 7]))
+    assert_equal([5, 6, 7], [step for step in range(1, 25) if hook.traced(step)])
+
+
+def test_input_wait_time():
+    run_metadata = tf.compat.v1.RunMetadata()
+    device = run_metadata.step_stats.dev_stats.add()
+    device.node_stats.add(node_name='IteratorGetNext', all_end_rel_micros=30000)
+    device.node_stats.add(node_name='MatMul', all_end_rel_micros=90000)
+    assert_almost_equal(.03, profiling.input_wait_time(run_metadata))
+    assert_is_none(profiling.input_wait_time(tf.compat.v1.RunMetadata()))
@@ -0,0 +1,45 @@
+from nose.tools import *
+from os import path
+import sys
+
+sys.path.insert(0, path.join(path.dirname(__file__), '..', '..', '..', 'src'))
+import deepgeo.networks.shape_inference as shape_inference
+
+
+def test_unet_output_size():
+    assert_equal(388, shape_inference.output_size('unet', 572))
+    assert_equal(shape_inference.output_size('unet', 572), shape_inference.output_size('unet_lf', 572))
+    assert_equal(shape_inference.output_size('unet', 572), shape_inference.output_size('mask_unet', 572))
+
+
+def test_fcn_output_size():
+    for network in ['fcn1s', 'fcn2s', 'fcn4s', 'fcn8s', 'fcn32s']:
+        assert_equal(286, shape_inference.output_size(network, 286))
+
+
+def test_invalid_chip_size():
+    assert_raises(ValueError, shape_inference.output_size, 'unet', 100)
+    assert_raises(ValueError, shape_inference.output_size, 'resnet', 572)
+
+
+def test_strict_chip_size():
+    # The pooling layers of the U-Net get odd sizes with chips of 256, 286, 320 and 512, so the output is shifted.
+    for chip_size in [256, 286, 320, 512]:
+        assert_raises(ValueError, shape_inference.output_size, 'unet', chip_size, True)
+    assert_equal(116, shape_inference.output_size('unet', 300, True))
+    assert_raises(ValueError, shape_inference.output_size, 'fcn8s', 250, True)
+
+
+def test_tiling():
+    tiling = shape_inference.tiling('unet', 572)
+    assert_equal(184, tiling['overlap'])
+    assert_equal(92, tiling['border_loss'])
+    assert_equal(388, tiling['stride'])
+    assert_equal(0, shape_inference.tiling('fcn8s', 256)['overlap'])
+    assert_raises(ValueError, shape_inference.tiling, 'unet', 256)
+
+
+def test_valid_chip_sizes():
+    assert_equal([188, 204, 220], shape_inference.valid_chip_sizes('unet', 180, 230))
+    assert_equal(252, shape_inference.nearest_chip_size('unet', 256))
+    assert_equal((556, 372), shape_inference.largest_chip_size('unet', 571))